@@ -0,0 +1,71 @@
+"""
+Benchmarks gen_utils.convert_to_python_obj against the previous recursive implementation on a recorded efetch
+payload (eg. 10,000 PubMed articles saved from an Entrez efetch request with rettype="xml").
+
+Usage:
+    python benchmarks/bench_convert_to_python_obj.py path/to/efetch_payload.xml [--repeats 3]
+"""
+import argparse
+import time
+from Bio import Entrez
+from pregpk import gen_utils
+
+
+# Fields of each article used by entrez.utilities; used to benchmark pruning with keep_keys
+ENTREZ_KEEP_KEYS = {'PubmedArticle', 'MedlineCitation', 'PMID', 'Article', 'ArticleTitle', 'Abstract', 'AbstractText',
+                    'AuthorList', 'LastName', 'Initials', 'CollectiveName', 'AffiliationInfo', 'Affiliation',
+                    'MeshHeadingList', 'DescriptorName', 'Language', 'PublicationTypeList', 'Journal',
+                    'JournalIssue', 'PubDate', 'Year', 'Month', 'Day', 'MedlineDate', 'ISOAbbreviation', 'Title',
+                    'MedlineJournalInfo', 'MedlineTA', 'ELocationID', 'PubmedData', 'ArticleIdList'}
+
+
+def recursive_reference(obj):
+    # Previous implementation of gen_utils.convert_to_python_obj (with tuples materialized), for comparison
+    if isinstance(obj, bool):
+        return bool(obj)
+    elif isinstance(obj, str):
+        return str(obj)
+    elif isinstance(obj, int):
+        return int(obj)
+    elif isinstance(obj, dict):
+        return {recursive_reference(key): recursive_reference(val) for key, val in obj.items()}
+    elif isinstance(obj, list):
+        return [recursive_reference(i) for i in obj]
+    elif isinstance(obj, tuple):
+        return tuple(recursive_reference(i) for i in obj)
+    return obj
+
+
+def best_time(func, repeats):
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('payload', help='path to recorded efetch XML payload')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    with open(args.payload, 'rb') as payload_file:
+        response = Entrez.read(payload_file)
+    print(f"Loaded {len(response['PubmedArticle'])} articles from {args.payload}\n")
+
+    if recursive_reference(response) != gen_utils.convert_to_python_obj(response):
+        raise RuntimeError('convert_to_python_obj output differs from recursive reference implementation.')
+
+    t_ref = best_time(lambda: recursive_reference(response), args.repeats)
+    t_new = best_time(lambda: gen_utils.convert_to_python_obj(response), args.repeats)
+    t_pruned = best_time(lambda: gen_utils.convert_to_python_obj(response, keep_keys=ENTREZ_KEEP_KEYS), args.repeats)
+
+    print(f"{'Recursive (previous):':<30}{t_ref:.3f} s")
+    print(f"{'Stack + dispatch table:':<30}{t_new:.3f} s ({t_ref / t_new:.2f}x)")
+    print(f"{'Stack + dispatch + keep_keys:':<30}{t_pruned:.3f} s ({t_ref / t_pruned:.2f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+Benchmarks CountryParser.countries_from_affiliation against the previous implementation (patterns looked up in the
+regex cache on every call and linear country_dict scans) on a corpus of author affiliations, checking that both
+(and the memoized parser) return the same countries.
+
+Usage:
+    python benchmarks/bench_country_parser.py [affiliations.txt] [--repeats 3]
+
+affiliations.txt has one affiliation per line (eg. the 'affiliations' of harvested Entrez records); a small built-in
+sample of real affiliation formats is used if it isn't given.
+"""
+import argparse
+import re
+import time
+from pregpk.countries import CountryParser, AffiliationMemo
+
+
+SAMPLE_AFFILIATIONS = [
+    "Department of Pharmaceutics, University of Washington, Seattle, WA, USA.",
+    "Division of Clinical Pharmacology, Department of Medicine, Vanderbilt University Medical Center, Nashville, "
+    "Tennessee.",
+    "Department of Clinical Pharmacy, Leiden University Medical Center, Leiden, The Netherlands.",
+    "Institute of Pharmaceutical Science, King's College London, London, UK.",
+    "Department of Obstetrics and Gynecology, Charite - Universitatsmedizin Berlin, Berlin, Germany.",
+    "Graduate School of Pharmaceutical Sciences, The University of Tokyo, Tokyo, Japan.",
+    "Center for Drug Evaluation and Research, U.S. Food and Drug Administration, Silver Spring, MD 20993, USA.",
+    "Faculty of Pharmacy, Universidade de Sao Paulo, Sao Paulo, SP, Brazil.",
+    "School of Pharmacy, Fudan University, Shanghai 201203, China; Shanghai Key Laboratory, Shanghai, China.",
+    "Department of Pediatrics, University of Toronto, Toronto, ON, Canada.",
+    "Pharmacometrics, Certara, Princeton, New Jersey.",
+    "Department of Pharmacology, All India Institute of Medical Sciences, New Delhi 110029, IND.",
+    "Women's and Children's Hospital, Adelaide, SA, Australia.",
+    "Hospital Universitario La Paz, Madrid, Spain.",
+    "Department of Obstetrics, University of Oxford, Oxford OX3 9DU, U.K.",
+    "Unit of Clinical Pharmacology, Karolinska Institutet, Stockholm, Sweden.",
+    "Department of Medicine, Makerere University College of Health Sciences, Kampala, Uganda.",
+    "Division of Maternal-Fetal Medicine, Magee-Womens Hospital, Pittsburgh, PA 15213.",
+    "Pharmacy Department, Hopital Necker-Enfants Malades, APHP, Paris, France.",
+    "Clinical Research Unit, Centre Hospitalier Universitaire Vaudois, Lausanne, Switzerland.",
+]
+
+# Affiliations whose countries depend on their exact whitespace (a country name only matches after whitespace, so a
+# run of spaces or a line break between two names lets both match)
+WHITESPACE_AFFILIATIONS = [
+    "Joint Research Unit, Madrid, Spain  France.",
+    "Department of Medicine, Kampala, Uganda \nKenya.",
+    "Centre for Tropical Medicine, Bangkok, Thailand\t Laos.",
+]
+
+
+class ReferenceCountryParser(CountryParser):
+    # Previous implementation of the lookups in countries_from_affiliation, for comparison
+
+    def countries_from_affiliation(self, aff):
+        ctrs = []
+
+        ctrs.extend([self._scan_names(i) for i in re.findall(self.re_any_country_name, aff.lower())])
+        if ctrs:
+            return ctrs
+
+        ctrs.extend([self._scan_alpha_3(i) for i in re.findall(self.re_any_alpha_3, aff)])
+        if ctrs:
+            return ctrs
+
+        if re.findall(self.re_any_us_state_name, aff.lower()):
+            return ["united states"]
+
+        if re.findall(self.re_any_us_state_abbr, aff):
+            return ["united states"]
+
+        if re.findall(r"\s(UK|U.K)[\s.,;]", aff):
+            return ["united kingdom"]
+
+        return ctrs
+
+    def _scan_names(self, name):
+        for i_ctr, i_val in self.country_dict.items():
+            if name in i_val["names"]:
+                return i_ctr
+        return None
+
+    def _scan_alpha_3(self, a3):
+        for i_ctr, i_val in self.country_dict.items():
+            if a3 == i_val["alpha_3"]:
+                return i_ctr
+        return None
+
+
+def best_time(func, repeats):
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('affiliations', nargs='?', help='path to text file with one affiliation per line')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--copies', type=int, default=500, help='copies of the built-in sample to benchmark on')
+    args = parser.parse_args()
+
+    if args.affiliations:
+        with open(args.affiliations, 'r') as aff_file:
+            affiliations = [i.strip() for i in aff_file if i.strip()]
+    else:
+        affiliations = SAMPLE_AFFILIATIONS * args.copies
+    print(f"{len(affiliations)} affiliations ({len(set(affiliations))} unique)\n")
+
+    ref, new = ReferenceCountryParser(use_memo=False), CountryParser(use_memo=False)
+    for aff in set(affiliations):
+        if ref.countries_from_affiliation(aff) != new.countries_from_affiliation(aff):
+            raise RuntimeError(f'CountryParser output differs from reference implementation for "{aff}".')
+
+    t_ref = best_time(lambda: [ref.countries_from_affiliation(i) for i in affiliations], args.repeats)
+    t_new = best_time(lambda: [new.countries_from_affiliation(i) for i in affiliations], args.repeats)
+    if new.countries_from_affiliations(affiliations).tolist() != [new.countries_from_affiliation(i) for i in affiliations]:
+        raise RuntimeError('countries_from_affiliations output differs from countries_from_affiliation.')
+    t_batch = best_time(lambda: new.countries_from_affiliations(affiliations), args.repeats)
+    memo = AffiliationMemo()  # In memory only, so the persisted memo isn't used or filled
+    memoized = CountryParser(memo=memo)
+    if memoized.memo is not memo:
+        raise RuntimeError('CountryParser did not use the AffiliationMemo it was given.')
+    # Memoized results (on misses and on hits) must match the uncached ones, including for whitespace variants
+    variants = list(dict.fromkeys(v for aff in set(affiliations)
+                                  for v in (aff, aff.replace(' ', '  '), aff.replace(', ', ',\n'))))
+    variants += WHITESPACE_AFFILIATIONS + [re.sub(r"\s+", " ", aff) for aff in WHITESPACE_AFFILIATIONS]
+    check = CountryParser(memo=AffiliationMemo())
+    for _ in range(2):
+        for aff in variants:
+            if check.countries_from_affiliation(aff) != new.countries_from_affiliation(aff):
+                raise RuntimeError(f'Memoized CountryParser output differs from uncached output for "{aff}".')
+    t_memo = best_time(lambda: [memoized.countries_from_affiliation(i) for i in affiliations], args.repeats)
+
+    print(f"{'Previous:':<32}{t_ref:.3f} s ({len(affiliations) / t_ref:,.0f} affiliations/s)")
+    print(f"{'Compiled patterns + dicts:':<32}{t_new:.3f} s ({len(affiliations) / t_new:,.0f} affiliations/s, "
+          f"{t_ref / t_new:.2f}x)")
+    print(f"{'Compiled + affiliation memo:':<32}{t_memo:.3f} s ({len(affiliations) / t_memo:,.0f} affiliations/s, "
+          f"{t_ref / t_memo:.2f}x)")
+    print(f"{'Batch (deduplicated):':<32}{t_batch:.3f} s ({len(affiliations) / t_batch:,.0f} "
+          f"affiliations/s, {t_ref / t_batch:.2f}x)")
+    print(memoized.memo.report())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Benchmarks the Entrez and PubTator fetch layers end to end against a local ReplayServer, so that throughput, request
+counts and memory use can be measured (and regressions caught) without hitting NCBI. Articles are synthetic unless
+recorded efetch/biocjson responses are given.
+
+Usage:
+    python benchmarks/bench_fetch_layer.py [--n-articles 2000] [--invalid 50] [--latency 0.2] [--error-rate 0.01]
+                                           [--rate-limit 10] [--api-key KEY] [--efetch a.xml ...] [--pubtator b.json ...]
+"""
+import os
+import argparse
+import tempfile
+import time
+import tracemalloc
+import pregpk.entrez.client as entrez_client
+import pregpk.entrez.utilities as entrez_utils
+import pregpk.pubtator.client as pubtator_client
+import pregpk.pubtator.utilities as pubtator_utils
+from pregpk.pubtator.corpus import CorpusStore
+from pregpk.replay.server import ReplayCorpus, ReplayServer
+
+
+def run(name, func, server, n_pmids):
+    server.reset_counts()
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    counts = ', '.join(f"{key}={val}" for key, val in sorted(server.request_counts.items()))
+    print(f"{name:<28}{elapsed:8.2f} s {n_pmids / elapsed:9.1f} PMIDs/s {peak / 2 ** 20:8.1f} MiB peak "
+          f"{server.bytes_sent / 2 ** 20:8.1f} MiB sent  [{counts}]")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n-articles', type=int, default=2000, help='number of synthetic articles')
+    parser.add_argument('--invalid', type=int, default=50, help='number of requested PMIDs missing from the corpus')
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.1, help='maximum random seconds added to latency')
+    parser.add_argument('--error-rate', type=float, default=0., help='fraction of requests answered with HTTP 500')
+    parser.add_argument('--rate-limit', type=float, default=None, help='requests per second before HTTP 429')
+    parser.add_argument('--api-key', default=None, help='Entrez API key (raises the client rate limit to 10/s)')
+    parser.add_argument('--efetch', nargs='*', default=[], help='recorded efetch XML responses')
+    parser.add_argument('--pubtator', nargs='*', default=[], help='recorded PubTator biocjson responses')
+    parser.add_argument('--skip-pubtator', action='store_true')
+    args = parser.parse_args()
+
+    if args.efetch or args.pubtator:
+        corpus = ReplayCorpus.from_recordings(args.efetch, args.pubtator)
+    else:
+        corpus = ReplayCorpus.synthetic(args.n_articles)
+    pmids = corpus.pmids + [str(i) for i in range(1, args.invalid + 1)]
+    print(f"Serving {len(corpus.pmids)} articles; requesting {len(pmids)} PMIDs ({args.invalid} invalid)\n")
+
+    with ReplayServer(corpus, latency=args.latency, latency_jitter=args.jitter, error_rate=args.error_rate,
+                      rate_limit=args.rate_limit) as server:
+        entrez_client.base_url = server.entrez_url
+        pubtator_client.base_url = server.pubtator_url
+        email = 'benchmark@example.com'
+
+        run('Entrez harvest_from_pmids', lambda: entrez_utils.harvest_from_pmids(pmids, email, api_key=args.api_key),
+            server, len(pmids))
+        run('Entrez complete df', lambda: entrez_utils.get_complete_df_from_pmids(pmids, email, api_key=args.api_key),
+            server, len(pmids))
+        if not args.skip_pubtator:
+            run('PubTator complete df', lambda: pubtator_utils.get_complete_df_from_pmids(pmids), server, len(pmids))
+
+            with tempfile.TemporaryDirectory() as tmp_dir, CorpusStore(os.path.join(tmp_dir, 'corpus')) as store:
+                def harvest_to_corpus():
+                    return pubtator_utils.harvest_from_pmids(pmids, corpus=store)
+
+                _, _, failed = run('PubTator harvest to corpus', harvest_to_corpus, server, len(pmids))
+                size = store.size_on_disk()
+                run('PubTator re-harvest to corpus', harvest_to_corpus, server, len(pmids))
+                print(f"Corpus grew by {store.size_on_disk() - size} bytes when re-harvested")
+                if not failed:  # Otherwise PMIDs that failed the first time may be added
+                    assert store.size_on_disk() == size, "re-harvesting the same PMIDs grew the corpus"
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Plans a screening study on synthetic articles with prompt_testing.planning.plan_gpt_study and runs the planned prompts
+through gpt.utilities.run_gpt_study against a local OpenAIStubServer, checking that every planned index gets a
+classified result and comparing the plan's predicted wall time and input tokens with what was measured.
+
+Usage:
+    python benchmarks/bench_gpt_study.py [--n-articles 200] [--latency 0.2] [--max-in-flight 8] [--token-budget 1000]
+                                         [--model gpt-4] [--rate-limit 50]
+"""
+import argparse
+import random
+import time
+from pregpk.gpt.utilities import run_gpt_study
+from pregpk.prompt_testing.planning import plan_gpt_study
+from pregpk.replay.openai_stub import OpenAIStubServer
+
+
+PROMPT = "Answer 1 if the article reports PK data in pregnancy and 0 otherwise, then explain briefly."
+CLASS_KEY = {'0': False, '1': True}
+WORDS = ["pregnant", "women", "plasma", "concentration", "dose", "trimester", "clearance", "placenta", "cohort",
+         "outcome", "infant", "exposure", "study", "patients", "serum", "week", "gestation", "drug"]
+
+
+def synthetic_dataset(n_articles: int, seed: int = 0) -> dict:
+    rng = random.Random(seed)
+
+    def text(n_words):
+        return ' '.join(rng.choice(WORDS) for _ in range(n_words))
+
+    dataset = {}
+    for i in range(n_articles):
+        record = {"title": text(12), "abstract": text(rng.randint(100, 300))}
+        if rng.random() < 0.5:
+            record["abstract"] += " pharmacokinetics"
+        for sec in ("methods", "results", "discuss", "intro"):
+            if rng.random() < 0.7:
+                record[sec] = text(rng.randint(50, 800))
+        dataset[str(30000000 + i)] = record
+    return dataset
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n-articles', type=int, default=200, help='number of synthetic articles')
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds added to every response')
+    parser.add_argument('--max-in-flight', type=int, default=8, help='maximum number of concurrent requests')
+    parser.add_argument('--token-budget', type=int, default=1000, help='maximum number of tokens per query')
+    parser.add_argument('--model', default='gpt-4', help='model whose encoding and prices are used')
+    parser.add_argument('--rate-limit', type=float, default=None, help='requests per minute of the account')
+    args = parser.parse_args()
+
+    dataset = synthetic_dataset(args.n_articles)
+    gpt_params = {"version": args.model, "temperature": 0, "max_tokens": 10}
+    plan = plan_gpt_study(dataset, PROMPT, gpt_params, token_budget=args.token_budget,
+                          max_in_flight=args.max_in_flight, requests_per_minute=args.rate_limit, latency=args.latency)
+
+    with OpenAIStubServer(latency=args.latency) as server:
+        t0 = time.perf_counter()
+        results = run_gpt_study(plan["prompts"], "stub-key", gpt_params, class_key=CLASS_KEY,
+                                max_in_flight=args.max_in_flight, requests_per_minute=args.rate_limit,
+                                base_url=server.base_url)
+        elapsed = time.perf_counter() - t0
+
+    assert list(results) == list(plan["prompts"]), "results are not keyed by the planned indices"
+    n_errors = sum(res["gpt_pred"] == -1 for res in results.values())
+    assert n_errors == 0, f"{n_errors} responses could not be classified"
+
+    print(f"{'':<16}{'predicted':>12}{'measured':>12}")
+    print(f"{'wall time (s)':<16}{plan['wall_time']:12.1f}{elapsed:12.1f}")
+    print(f"{'requests':<16}{plan['n_prompts']:12d}{server.request_counts['/v1/chat/completions']:12d}")
+    print(f"{'max in flight':<16}{args.max_in_flight:12d}{server.max_in_flight:12d}")
+    print(f"{len(results)} results keyed by plan index "
+          f"({sum(res['gpt_pred'] is True for res in results.values())} classified as PK)")
+
+
+if __name__ == '__main__':
+    main()
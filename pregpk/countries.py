@@ -3,14 +3,128 @@ import json
 import re
 import requests
 import warnings
+import threading
+from collections import OrderedDict
+import pandas as pd
 from . import country_dict, us_state_dict
 
 
+DEFAULT_MEMO_PATH = os.path.join(os.path.expanduser('~'), '.pregpk', 'affiliation_countries.json')
+MEMO_VERSION = 1  # Increment when countries_from_affiliation changes, so memos from older versions are discarded
+
+# Module-level setting used by get_affiliation_memo() when creating the process-wide memo; None to not persist it
+affiliation_memo_path = DEFAULT_MEMO_PATH
+
+_memo = None
+_memo_lock = threading.Lock()
+
+
+class AffiliationMemo:
+    """
+    Bounded (least recently used) memo of affiliation -> countries results, keyed by the exact affiliation string
+    (the affiliation patterns are sensitive to whitespace, eg. a run of spaces between two country names lets both
+    match, so normalized keys wouldn't always give the uncached result). Institutional affiliations recur verbatim
+    thousands of times across a corpus, so during large harvests most lookups are hits. The memo can be persisted
+    between runs as JSON.
+    """
+
+    def __init__(self, path: str = None, maxsize: int = 200000):
+        """
+        :param path: string, path to JSON file the memo is loaded from (if it exists) and saved to; None to keep the
+            memo in memory only
+        :param maxsize: int, maximum number of affiliations stored
+        """
+        self.path = path
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._dirty = False
+
+        if path is not None and os.path.exists(path):
+            with open(path, 'r') as memo_file:
+                data = json.load(memo_file)
+            if data.get('version') == MEMO_VERSION:
+                self._entries.update(list(data['entries'].items())[-maxsize:])
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str):
+        """
+        :return: list of countries memoized for an affiliation, or None if it isn't in the memo
+        """
+        with self._lock:
+            ctrs = self._entries.get(key)
+            if ctrs is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return list(ctrs)
+
+    def put(self, key: str, ctrs: list):
+        with self._lock:
+            self._entries[key] = list(ctrs)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+            self._dirty = True
+
+    def save(self):
+        """
+        Writes the memo to its path (atomically), if it has a path and changed since it was loaded or last saved.
+        """
+        if self.path is None or not self._dirty:
+            return
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._lock:
+            data = {'version': MEMO_VERSION, 'entries': dict(self._entries)}
+            self._dirty = False
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as memo_file:
+            json.dump(data, memo_file)
+        os.replace(tmp_path, self.path)
+
+    def hit_rate(self) -> float:
+        n = self.hits + self.misses
+        return self.hits / n if n else 0.
+
+    def report(self) -> str:
+        return (f"Affiliation memo: {self.hits} hits, {self.misses} misses ({self.hit_rate():.1%} hit rate), "
+                f"{len(self)} affiliations stored")
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+
+def get_affiliation_memo() -> AffiliationMemo:
+    """
+    Returns the process-wide AffiliationMemo shared by every CountryParser (created on first use, and loaded from the
+    module-level affiliation_memo_path setting if it is not None).
+    """
+    global _memo
+    with _memo_lock:
+        if _memo is None or _memo.path != affiliation_memo_path:
+            _memo = AffiliationMemo(affiliation_memo_path)
+        return _memo
+
+
 class CountryParser:
 
-    def __init__(self):
+    def __init__(self, memo: AffiliationMemo = None, use_memo: bool = True):
+        """
+        :param memo: AffiliationMemo consulted by countries_from_affiliation; defaults to the process-wide memo
+        :param use_memo: boolean, whether to memoize countries_from_affiliation at all
+        """
         self.country_dict = country_dict
         self.us_state_dict = us_state_dict
+        self.memo = None
+        if use_memo:  # An empty memo is falsy (it has a __len__), so compare with None
+            self.memo = memo if memo is not None else get_affiliation_memo()
         # Define REs
         self.define_res()
 
@@ -27,80 +141,100 @@ class CountryParser:
     #     return states
 
     def define_res(self):
+        # Patterns are kept as strings (re_any_*) and compiled once (pattern_*), so matching doesn't go through the
+        # regex cache on every call. Reverse dicts make each name/code -> country lookup O(1); where several
+        # countries share a name or code, the first one in country_dict wins (as with a linear scan).
+
+        self.name_to_country = {}
+        self.alpha_3_to_country = {}
+        self.alpha_2_to_country = {}
+        for i_ctr, i_val in self.country_dict.items():
+            for name in i_val["names"]:
+                self.name_to_country.setdefault(name, i_ctr)
+            self.alpha_3_to_country.setdefault(i_val["alpha_3"], i_ctr)
+            self.alpha_2_to_country.setdefault(i_val["alpha_2"], i_ctr)
 
         all_ctr_names = []
         for ctr in self.country_dict.values():
             all_ctr_names.extend(ctr["names"])
-        self.re_any_country_name = f"\s({'|'.join(all_ctr_names)})[\s,.;]"
+        self.re_any_country_name = rf"\s({'|'.join(all_ctr_names)})[\s,.;]"
 
         all_alpha_3s = []
         for ctr in self.country_dict.values():
             all_alpha_3s.append(ctr["alpha_3"])
-        self.re_any_alpha_3 = f"\s({'|'.join(all_alpha_3s)})[\s,.;]"
+        self.re_any_alpha_3 = rf"\s({'|'.join(all_alpha_3s)})[\s,.;]"
 
         all_alpha_2s = []
         for ctr in self.country_dict.values():
             all_alpha_2s.append(ctr["alpha_2"])
-        self.re_any_alpha_2 = f"\s({'|'.join(all_alpha_2s)})[\s,.;]"
+        self.re_any_alpha_2 = rf"\s({'|'.join(all_alpha_2s)})[\s,.;]"
 
         all_us_state_names = []
         for st in self.us_state_dict.keys():
             all_us_state_names.append(st)
-        self.re_any_us_state_name = f"\s({'|'.join(all_us_state_names)})[\s,.;]"
+        self.re_any_us_state_name = rf"\s({'|'.join(all_us_state_names)})[\s,.;]"
 
         all_us_state_abbr = []
         for st_abbr in self.us_state_dict.values():
             all_us_state_abbr.append(st_abbr)
-        self.re_any_us_state_abbr = f"\s({'|'.join(all_us_state_abbr)})[\s,.;]"
+        self.re_any_us_state_abbr = rf"\s({'|'.join(all_us_state_abbr)})[\s,.;]"
+
+        self.re_uk = r"\s(UK|U.K)[\s.,;]"
+
+        self.pattern_country_name = re.compile(self.re_any_country_name)
+        self.pattern_alpha_3 = re.compile(self.re_any_alpha_3)
+        self.pattern_alpha_2 = re.compile(self.re_any_alpha_2)
+        self.pattern_us_state_name = re.compile(self.re_any_us_state_name)
+        self.pattern_us_state_abbr = re.compile(self.re_any_us_state_abbr)
+        self.pattern_uk = re.compile(self.re_uk)
 
         return
 
     def country_from_name(self, name):
-        for i_ctr, i_val in self.country_dict.items():
-            if name in i_val["names"]:
-                return i_ctr
-
-        return None
+        return self.name_to_country.get(name)
 
     def country_from_alpha_3(self, a3):
-        for i_ctr, i_val in self.country_dict.items():
-            if a3 == i_val["alpha_3"]:
-                return i_ctr
-
-        return None
+        return self.alpha_3_to_country.get(a3)
 
     def country_from_alpha_2(self, a2):
-        for i_ctr, i_val in self.country_dict.items():
-            if a2 == i_val["alpha_2"]:
-                return i_ctr
-
-        return None
+        return self.alpha_2_to_country.get(a2)
 
     def countries_from_affiliation(self, aff):
+        if self.memo is None:
+            return self._countries_from_affiliation(aff)
+
+        ctrs = self.memo.get(aff)
+        if ctrs is None:
+            ctrs = self._countries_from_affiliation(aff)
+            self.memo.put(aff, ctrs)
+        return ctrs
+
+    def _countries_from_affiliation(self, aff):
 
         ctrs = []
+        aff_lower = aff.lower()
 
         # Look for country names
-        ctr_name_match = re.findall(self.re_any_country_name, aff.lower())
-        ctrs.extend([self.country_from_name(i) for i in ctr_name_match])
+        ctr_name_match = self.pattern_country_name.findall(aff_lower)
+        ctrs.extend([self.name_to_country.get(i) for i in ctr_name_match])
         if ctrs:  # If identified using country name, stop here
             return ctrs
 
         # Look for 3-letter country abbreviations
-        ctr_alpha_3_match = re.findall(self.re_any_alpha_3, aff)
-        ctrs.extend([self.country_from_alpha_3(i) for i in ctr_alpha_3_match])
+        ctr_alpha_3_match = self.pattern_alpha_3.findall(aff)
+        ctrs.extend([self.alpha_3_to_country.get(i) for i in ctr_alpha_3_match])
         if ctrs:
             return ctrs
 
         # Look for state name
-        us_state_name_match = re.findall(self.re_any_us_state_name, aff.lower())
+        us_state_name_match = self.pattern_us_state_name.search(aff_lower)
         if us_state_name_match:
             ctrs.append("united states")
         if ctrs:
             return ctrs
 
         # Look for state abbreviation
-        us_state_abbr_match = re.findall(self.re_any_us_state_abbr, aff)
+        us_state_abbr_match = self.pattern_us_state_abbr.search(aff)
         if us_state_abbr_match:
             ctrs.append("united states")
         if ctrs:
@@ -120,7 +254,7 @@ class CountryParser:
         # "GBR") in case we want to actually search for every alpha_2 in the future. However, for now, I think it's
         # better just to catch cases of "UK" and "U.K" specifically and disregard the rest.
         # Look for "UK" or "U.K":
-        uk_match = re.findall("\s(UK|U.K)[\s.,;]", aff)
+        uk_match = self.pattern_uk.search(aff)
         if uk_match:
             ctrs.append("united kingdom")
         if ctrs:
@@ -131,6 +265,51 @@ class CountryParser:
 
         return ctrs
 
+    def countries_from_affiliations(self, affs) -> pd.Series:
+        """
+        Batch version of countries_from_affiliation: each matching tier (country names, alpha-3 codes, US state names,
+        US state abbreviations, "UK"/"U.K") is run once over all affiliations not resolved by a previous tier, using
+        vectorized pandas string methods, with the same tier precedence as countries_from_affiliation. Duplicate
+        affiliations are only matched once. Since affiliations are independent, chunks of a large Series can be tagged
+        in parallel.
+        :param affs: pd.Series or list of affiliation strings
+        :return: pd.Series (with the index of affs) of lists of countries
+        """
+        affs = pd.Series(affs, dtype=object)
+        unique = pd.Series(affs.dropna().unique(), dtype=object)
+        ctrs = pd.Series([[] for _ in range(len(unique))], index=unique.index, dtype=object)
+
+        remaining = unique
+        tiers = [
+            (self.pattern_country_name, True, lambda m: [self.name_to_country.get(i) for i in m]),
+            (self.pattern_alpha_3, False, lambda m: [self.alpha_3_to_country.get(i) for i in m]),
+            (self.pattern_us_state_name, True, lambda m: ["united states"]),
+            (self.pattern_us_state_abbr, False, lambda m: ["united states"]),
+            (self.pattern_uk, False, lambda m: ["united kingdom"]),
+        ]
+        for pattern, lower, to_countries in tiers:
+            if remaining.empty:
+                break
+            matches = (remaining.str.lower() if lower else remaining).str.findall(pattern)
+            found = matches.str.len() > 0
+            ctrs[found[found].index] = matches[found].map(to_countries)
+            remaining = remaining[~found]
+
+        by_aff = dict(zip(unique, ctrs))
+        return affs.map(lambda aff: list(by_aff[aff]) if aff in by_aff else [])
+
+    def country_indicators(self, affs) -> pd.DataFrame:
+        """
+        Sparse indicator matrix of the countries found in each affiliation (see countries_from_affiliations).
+        :param affs: pd.Series or list of affiliation strings
+        :return: pd.DataFrame (with the index of affs) with one sparse boolean column per country found
+        """
+        ctrs = self.countries_from_affiliations(affs).explode().dropna()
+        indicators = pd.crosstab(ctrs.index, ctrs).astype(bool)
+        indicators = indicators.reindex(pd.Series(affs).index, fill_value=False)
+        indicators.columns.name = None
+        return indicators.astype(pd.SparseDtype(bool, False))
+
 
 def capitalize_name(name):
     split_name = name.split(' ')
@@ -0,0 +1,209 @@
+import io
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import requests
+from tqdm import tqdm
+from Bio import Entrez
+from pregpk.rate_limiting import TokenBucket, AdaptiveChunkSize, map_in_order
+
+
+EUTILS_BASE_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
+
+# Module-level settings (in the style of Bio.Entrez.email); used by get_client() when creating new clients
+base_url = EUTILS_BASE_URL
+max_workers = None  # Defaults to the per-second rate limit
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class EntrezClient:
+    """
+    Client for the Entrez E-utilities that keeps up to "max_workers" requests in flight while never exceeding NCBI's
+    rate limits (3 requests per second without an API key, 10 with one). Requests go through a pooled
+    requests.Session and responses are returned as file-like handles, so they can be parsed with Entrez.read as
+    with Bio.Entrez.
+    """
+
+    def __init__(self, email: str, api_key: str = None, max_workers: int = None, base_url: str = EUTILS_BASE_URL,
+                 max_tries: int = 3, tool: str = 'pregpk', timeout: float = 120.):
+        """
+        :param email: string, NCBI account email address for access to Entrez API
+        :param api_key: string, NCBI API key; increases the rate limit from 3 to 10 requests per second
+        :param max_workers: int, maximum number of requests in flight; defaults to the per-second rate limit
+        :param base_url: string, base URL of the E-utilities
+        :param max_tries: int, number of attempts for requests failing with HTTP 429/5xx, connection errors or
+            timeouts
+        :param tool: string, tool name sent to NCBI with every request
+        :param timeout: float, seconds to wait for a response (or between bytes of a streamed response), so a hung
+            connection fails (and is retried) instead of blocking its worker forever
+        """
+        self.email = email
+        self.api_key = api_key
+        self.rate = 10 if api_key else 3
+        self.max_workers = max_workers or self.rate
+        self.base_url = base_url if base_url.endswith('/') else base_url + '/'
+        self.max_tries = max_tries
+        self.tool = tool
+        self.timeout = timeout
+        self.limiter = TokenBucket(self.rate, capacity=1)  # No bursts, so no 1 s window exceeds the rate
+        self.session = requests.Session()
+        self.n_requests = 0
+        self._n_requests_lock = threading.Lock()
+
+    def request(self, endpoint: str, **params) -> bytes:
+        """
+        Sends a (rate limited) POST request to an E-utility and returns the raw response body.
+        :param endpoint: string, E-utility name (eg. 'efetch', 'esummary', 'esearch', 'epost')
+        :param params: E-utility parameters; lists are joined with commas
+        :return: bytes, response body
+        """
+        return self._send(endpoint, params).content
+
+    def stream(self, endpoint: str, **params):
+        """
+        Sends a (rate limited) POST request to an E-utility and returns the response body as a file-like stream, so
+        it can be parsed incrementally without holding the whole body in memory. The stream should be closed after
+        use to return the connection to the pool.
+        """
+        raw = self._send(endpoint, params, stream=True).raw
+        raw.decode_content = True  # Transparently decompress gzip responses
+        return raw
+
+    def _send(self, endpoint: str, params: dict, stream: bool = False) -> requests.Response:
+        data = {key: (','.join(map(str, val)) if isinstance(val, (list, tuple)) else val)
+                for key, val in params.items() if val is not None}
+        data.update({'tool': self.tool, 'email': self.email})
+        if self.api_key is not None:
+            data['api_key'] = self.api_key
+
+        for i in range(self.max_tries):
+            self.limiter.acquire()
+            with self._n_requests_lock:
+                self.n_requests += 1
+            try:
+                resp = self.session.post(f"{self.base_url}{endpoint}.fcgi", data=data, stream=stream,
+                                         timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if i >= self.max_tries - 1:
+                    raise
+            else:
+                # NCBI sometimes returns 429s even when the rate limit is honored; treat them as server errors
+                if resp.status_code != 429 and resp.status_code < 500:
+                    resp.raise_for_status()
+                    return resp
+                if i >= self.max_tries - 1:
+                    resp.raise_for_status()
+                resp.close()
+            time.sleep(2 ** i)
+
+    def handle(self, endpoint: str, **params) -> io.BytesIO:
+        return io.BytesIO(self.request(endpoint, **params))
+
+    def read(self, endpoint: str, **params):
+        """
+        Sends a request to an E-utility and parses the XML response with Entrez.read.
+        """
+        return Entrez.read(self.handle(endpoint, **params))
+
+    def efetch(self, **params) -> io.BytesIO:
+        return self.handle('efetch', **params)
+
+    def esummary(self, **params) -> io.BytesIO:
+        return self.handle('esummary', **params)
+
+    def esearch(self, **params) -> io.BytesIO:
+        return self.handle('esearch', **params)
+
+    def epost(self, ids: list, db: str = 'pubmed') -> tuple:
+        """
+        Uploads a list of UIDs to the Entrez history server.
+        :param ids: list of UIDs (eg. PMIDs)
+        :param db: string, Entrez database
+        :return: tuple (webenv, query_key) identifying the uploaded set on the history server
+        """
+        response = self.read('epost', db=db, id=ids)
+        return str(response['WebEnv']), str(response['QueryKey'])
+
+    def map_history_pages(self, func, total: int, chunk_size: AdaptiveChunkSize, max_tries: int = 3,
+                          progress_bar: bool = True) -> list:
+        """
+        Calls func(retstart, retmax) for consecutive pages covering elements [0, total) of a history server set, with
+        up to max_workers pages in flight. The size of each page is taken from chunk_size when it is dispatched, and
+        chunk_size is updated with the latency (or failure) of every page, so pages shrink when the server slows
+        down or fails and grow again when it recovers. Failed pages are split in halves and retried; a slow page
+        only holds up one worker.
+        :param func: callable taking (retstart, retmax) and making its requests through this client
+        :param total: int, number of elements in the history server set
+        :param chunk_size: AdaptiveChunkSize used to choose (and updated with) page sizes
+        :param max_tries: int, number of attempts for each element before the error is raised
+        :param progress_bar: boolean, whether to show a tqdm progress bar over elements
+        :return: list of func results, in retstart order
+        """
+        results = {}
+        retry_queue = deque()  # (retstart, retmax, n_tries)
+        next_start = 0
+        pbar = tqdm(total=total) if progress_bar else None
+
+        def timed_call(retstart, retmax):
+            t0 = time.monotonic()
+            return func(retstart, retmax), time.monotonic() - t0
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            in_flight = {}
+            while retry_queue or next_start < total or in_flight:
+                while len(in_flight) < self.max_workers and (retry_queue or next_start < total):
+                    if retry_queue:
+                        page = retry_queue.popleft()
+                    else:
+                        page = (next_start, min(chunk_size.size, total - next_start), 0)
+                        next_start += page[1]
+                    in_flight[executor.submit(timed_call, page[0], page[1])] = page
+
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    retstart, retmax, n_tries = in_flight.pop(future)
+                    try:
+                        result, latency = future.result()
+                    except Exception:
+                        chunk_size.record(retmax, 0, failed=True)
+                        if n_tries + 1 >= max_tries:
+                            raise
+                        if retmax > 1:  # Retry as two smaller pages
+                            half = retmax // 2
+                            retry_queue.extend([(retstart, half, n_tries + 1),
+                                                (retstart + half, retmax - half, n_tries + 1)])
+                        else:
+                            retry_queue.append((retstart, retmax, n_tries + 1))
+                        continue
+
+                    chunk_size.record(retmax, latency)
+                    results[retstart] = result
+                    if pbar is not None:
+                        pbar.update(retmax)
+
+        if pbar is not None:
+            pbar.close()
+
+        return [results[i] for i in sorted(results)]
+
+    def map(self, func, items: list, progress_bar: bool = True) -> list:
+        """
+        Applies func (which should make its requests through this client) to every element of items with up to
+        max_workers calls in flight, returning the results in input order.
+        """
+        return map_in_order(func, items, max_workers=self.max_workers, progress_bar=progress_bar)
+
+
+def get_client(email: str, api_key: str = None) -> EntrezClient:
+    """
+    Returns the process-wide EntrezClient for an email/API key pair (created on first use with the module-level
+    base_url and max_workers settings), so that every function sharing credentials also shares a rate limit.
+    """
+    key = (email, api_key, base_url, max_workers)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = EntrezClient(email, api_key=api_key, max_workers=max_workers, base_url=base_url)
+        return _clients[key]
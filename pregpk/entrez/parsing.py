@@ -0,0 +1,121 @@
+import xml.etree.ElementTree as ET
+from pregpk.countries import CountryParser
+
+
+# ISO 639-2 codes returned by efetch mapped onto the language names used by esummary "LangList"
+LANGUAGE_NAMES = {
+    'eng': 'English', 'jpn': 'Japanese', 'ita': 'Italian', 'chi': 'Chinese', 'ger': 'German', 'fre': 'French',
+    'rus': 'Russian', 'spa': 'Spanish', 'pol': 'Polish', 'por': 'Portuguese', 'dut': 'Dutch', 'kor': 'Korean',
+    'swe': 'Swedish', 'dan': 'Danish', 'nor': 'Norwegian', 'fin': 'Finnish', 'hun': 'Hungarian', 'cze': 'Czech',
+    'tur': 'Turkish', 'heb': 'Hebrew', 'ara': 'Arabic', 'gre': 'Greek', 'per': 'Persian', 'ukr': 'Ukrainian',
+}
+
+# Version of the record format built by record_from_article_element (including the countries interpreted from
+# affiliations); increment when the record layout or contents change, so records cached by older versions are
+# re-fetched (see record_cache.RecordCache)
+RECORD_VERSION = 1
+
+
+def iter_pubmed_records(source, country_parser: CountryParser = None):
+    """
+    Incrementally parses a PubMed efetch XML response, yielding one compact record per "PubmedArticle". Each article
+    element is cleared as soon as its record has been built, so memory use stays flat regardless of the number of
+    articles in the response.
+    :param source: file-like object (eg. efetch handle or streamed response) or path with efetch XML
+    :param country_parser: CountryParser used to interpret author affiliations; created if not given
+    :return: generator of record dicts (see record_from_article_element)
+    """
+    if country_parser is None:
+        country_parser = CountryParser()
+
+    context = ET.iterparse(source, events=('start', 'end'))
+    _, root = next(context)
+    if root.tag != 'PubmedArticleSet':
+        raise RuntimeError(f'Unexpected efetch response: root element is "{root.tag}", not "PubmedArticleSet".')
+
+    for event, elem in context:
+        if event != 'end':
+            continue
+        if elem.tag == 'PubmedArticle':
+            yield record_from_article_element(elem, country_parser=country_parser)
+            root.clear()  # Drop parsed articles (and the references to them held by root)
+        elif elem.tag == 'PubmedBookArticle':  # Not used by this module
+            root.clear()
+
+
+def record_from_article_element(article: ET.Element, country_parser: CountryParser = None) -> dict:
+    """
+    Builds a compact record from a "PubmedArticle" XML element, containing only the fields used by the summaries,
+    metadata and text functions in entrez.utilities.
+    :param article: "PubmedArticle" element of an efetch response
+    :param country_parser: CountryParser used to interpret author affiliations; created if not given
+    :return: dict with keys 'pmid', 'title', 'authors', 'pub_date', 'source', 'pub_types', 'doi', 'has_abstract',
+        'languages', 'mesh_terms', 'affiliations', 'pub_countries' and 'abstract'
+    """
+    if country_parser is None:
+        country_parser = CountryParser()
+
+    citation = article.find('MedlineCitation')
+    art = citation.find('Article')
+
+    authors = []
+    aff_set = set()
+    for auth in art.iterfind('AuthorList/Author'):
+        last_name = auth.findtext('LastName')
+        if last_name:
+            authors.append(f"{last_name} {auth.findtext('Initials', '')}".strip())
+        elif auth.find('CollectiveName') is not None:
+            authors.append(_text(auth.find('CollectiveName')))
+        # Some authors have AffiliationInfo and some don't, so they are checked one by one
+        aff_set.update(_text(i) for i in auth.iterfind('AffiliationInfo/Affiliation'))
+
+    aff_ctrs = set()
+    for aff in aff_set:
+        aff_ctrs.update(country_parser.countries_from_affiliation(aff))
+
+    pub_date = art.find('Journal/JournalIssue/PubDate')
+    if pub_date is None:
+        pub_date = ''
+    elif pub_date.find('MedlineDate') is not None:  # eg. "1998 Dec-1999 Jan"
+        pub_date = pub_date.findtext('MedlineDate')
+    else:
+        pub_date = ' '.join(pub_date.findtext(i) for i in ('Year', 'Month', 'Day') if pub_date.find(i) is not None)
+
+    source = citation.findtext('MedlineJournalInfo/MedlineTA') or art.findtext('Journal/ISOAbbreviation') or \
+        art.findtext('Journal/Title', '')
+
+    doi = ''
+    for i_id in art.iterfind('ELocationID'):
+        if i_id.get('EIdType') == 'doi':
+            doi = _text(i_id)
+            break
+    else:
+        for i_id in article.iterfind('PubmedData/ArticleIdList/ArticleId'):
+            if i_id.get('IdType') == 'doi':
+                doi = _text(i_id)
+                break
+
+    # Abstract is None (no text section) if there is no AbstractText, even if there is an (eg. empty) Abstract element
+    abstract_texts = list(art.iterfind('Abstract/AbstractText'))
+    abstract = " ".join(_text(i) for i in abstract_texts) if abstract_texts else None
+
+    return {
+        'pmid': citation.findtext('PMID'),
+        'title': _text(art.find('ArticleTitle')),
+        'authors': authors,
+        'pub_date': pub_date,
+        'source': source,
+        'pub_types': [_text(i) for i in art.iterfind('PublicationTypeList/PublicationType')],
+        'doi': doi,
+        'has_abstract': art.find('Abstract') is not None,
+        'languages': [LANGUAGE_NAMES.get(i.text, i.text) for i in art.iterfind('Language')],
+        'mesh_terms': [_text(i) for i in citation.iterfind('MeshHeadingList/MeshHeading/DescriptorName')],
+        'affiliations': sorted(aff_set),
+        'pub_countries': list(aff_ctrs),
+        'abstract': abstract,
+    }
+
+
+def _text(elem: ET.Element) -> str:
+    # Includes text inside inline markup (eg. <i>, <sup>) within the element
+    return ''.join(elem.itertext()) if elem is not None else ''
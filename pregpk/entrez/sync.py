@@ -0,0 +1,119 @@
+import os
+import json
+import datetime
+import pandas as pd
+from pregpk.record_cache import RecordCache
+from pregpk.entrez.utilities import pmids_from_history_search, get_complete_df_from_pmids
+
+
+DATE_FORMAT = '%Y/%m/%d'  # Entrez mindate/maxdate format
+
+
+class SyncState:
+    """
+    JSON file recording, for each PubMed query, the date of its last successful harvest, so that later syncs only
+    request records added or modified since then.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: string, path to JSON state file; existing state is loaded if the file exists
+        """
+        self.path = path
+        self.queries = {}  # query -> {'last_sync': 'YYYY/MM/DD', 'synced_at': ISO timestamp, 'n_pmids': int}
+
+        if os.path.exists(path):
+            with open(path, 'r') as state_file:
+                self.queries = json.load(state_file)
+
+    def last_sync(self, query: str):
+        """
+        :return: datetime.date of the last successful harvest of query, or None if it was never harvested
+        """
+        if query not in self.queries:
+            return None
+        return datetime.datetime.strptime(self.queries[query]['last_sync'], DATE_FORMAT).date()
+
+    def update(self, query: str, sync_date: datetime.date, n_pmids: int):
+        self.queries[query] = {'last_sync': sync_date.strftime(DATE_FORMAT),
+                               'synced_at': datetime.datetime.now().isoformat(timespec='seconds'),
+                               'n_pmids': n_pmids}
+        _atomic_write(self.path, lambda tmp_path: _dump_json(self.queries, tmp_path))
+
+
+def sync_pubmed_query(query: str, email: str, store_path: str, state_path: str, api_key: str = None,
+                      cache: RecordCache = None, overlap_days: int = 1, full: bool = False) -> pd.DataFrame:
+    """
+    Keeps a metadata store (the DataFrame returned by entrez.utilities.get_complete_df_from_pmids, pickled at
+    store_path) up to date with a PubMed query. The first sync (or full=True) harvests every PMID returned by the
+    query; later syncs only search for PMIDs added (datetype 'edat') or modified ('mdat') since the last successful
+    sync, fetch those records and merge them into the store, replacing previous versions of modified records. The
+    sync date is only saved after the store has been written, so an interrupted sync is simply repeated.
+    Note that PMIDs which stop matching the query (eg. retracted or re-indexed articles) are only dropped by a full
+    sync.
+    :param query: string with PubMed query
+    :param email: string, NCBI account email address for access to Entrez API
+    :param store_path: string, path to pickled metadata DataFrame (created on the first sync)
+    :param state_path: string, path to JSON file with the last sync date of each query (see SyncState)
+    :param api_key: string, NCBI API key to reduce time between multiple requests
+    :param cache: RecordCache used for the full harvest; records re-fetched by incremental syncs bypass it (and
+        overwrite it), since cached versions of modified records are stale
+    :param overlap_days: int, number of days before the last sync date to search from, to cover records indexed
+        late on the day of the last sync (duplicates are merged away)
+    :param full: boolean, whether to re-harvest every PMID returned by the query instead of syncing incrementally
+    :return: pd.DataFrame, updated metadata store
+    """
+    state = SyncState(state_path)
+    today = datetime.date.today()
+    last_sync = state.last_sync(query)
+
+    if full or last_sync is None or not os.path.exists(store_path):
+        print(f'\nFull sync of PubMed query "{query}"...')
+        pmids = pmids_from_history_search(query, email=email, api_key=api_key)
+        store = get_complete_df_from_pmids(pmids, email=email, api_key=api_key, cache=cache)
+
+    else:
+        mindate = (last_sync - datetime.timedelta(days=overlap_days)).strftime(DATE_FORMAT)
+        maxdate = today.strftime(DATE_FORMAT)
+        print(f'\nIncremental sync of PubMed query "{query}" ({mindate} - {maxdate})...')
+
+        changed_pmids = []
+        for datetype in ('edat', 'mdat'):  # Added and modified records
+            changed_pmids += pmids_from_history_search(query, email=email, api_key=api_key, datetype=datetype,
+                                                       mindate=mindate, maxdate=maxdate)
+        changed_pmids = list(dict.fromkeys(changed_pmids))
+
+        store = pd.read_pickle(store_path)
+        if changed_pmids:
+            refresh_cache = None
+            if cache is not None:
+                refresh_cache = RecordCache(cache.path, ttl_days=cache.ttl_days, mode='refresh',
+                                            compression_level=cache.compression_level)
+            changed = get_complete_df_from_pmids(changed_pmids, email=email, api_key=api_key, cache=refresh_cache)
+            if refresh_cache is not None:
+                refresh_cache.close()
+
+            n_new = len(changed.index.difference(store.index))
+            store = pd.concat([store.drop(index=store.index.intersection(changed.index)), changed], axis=0)
+            print(f"{n_new} new and {len(changed) - n_new} modified records merged into {store_path}.")
+        else:
+            print('No new or modified records.')
+
+    _atomic_write(store_path, store.to_pickle)
+    state.update(query, today, len(store))
+
+    return store
+
+
+def _dump_json(obj, path: str):
+    with open(path, 'w') as json_file:
+        json.dump(obj, json_file, indent=2)
+
+
+def _atomic_write(path: str, write):
+    # Writes to a temporary file first, so an interrupted write never leaves a truncated file at path
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
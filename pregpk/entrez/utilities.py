@@ -1,24 +1,181 @@
 import os
 import json
 import time
-from Bio import Entrez
-from tqdm import tqdm
+import threading
 import pandas as pd
 from pregpk import gen_utils
 from pregpk.countries import CountryParser
+from pregpk.record_cache import RecordCache
+from pregpk.harvest_journal import journaled_harvest
+from pregpk.rate_limiting import AdaptiveChunkSize
+from pregpk.entrez.client import get_client
+from pregpk.entrez.parsing import RECORD_VERSION, iter_pubmed_records
 
 
 def is_fill_invalid_option_allowed(fill_invalid_val):  # Must either be "remove" or falsey value
     return (fill_invalid_val == 'remove') or not fill_invalid_val
 
 
-def text_from_pmids(pmids: list, email: str, api_key: str = None, fill_invalid_pmids="remove") -> dict:
+def harvest_from_pmids(pmids: list, email: str, api_key: str = None, cache: RecordCache = None,
+                       journal_path: str = None, retry_dead_letters: bool = False) -> tuple:
+    """
+    Fetches every PMID from the Entrez API once and parses each returned article into a compact record. Validity,
+    summaries, metadata and text are all derived from these records, so a full run only downloads each article once.
+    Small lists are fetched with a single efetch; larger ones are uploaded with EPost and downloaded from the history
+    server in concurrent pages whose size adapts to the observed latency and error rate.
+    :param pmids: list of PMID strings to harvest from Entrez
+    :param email: string, NCBI account email address for access to Entrez API
+    :param api_key: string, NCBI API key to reduce time between multiple requests
+    :param cache: RecordCache consulted before making requests (and updated with fetched records); None to always
+        fetch from Entrez
+    :param journal_path: string, path to a harvest journal (see harvest_journal.journaled_harvest); if given, PMIDs
+        are fetched in small journaled chunks with retries, a chunk failing because of its data is bisected to isolate
+        bad PMIDs and an interrupted harvest (including one stopped by connection or server errors, which are raised)
+        resumes from the journal
+    :param retry_dead_letters: boolean, whether to retry PMIDs that could not be fetched (dead letters) in previous
+        runs with the same journal
+    :return: tuple (records, invalid_pmids, failed_pmids), where records is a dict mapping PMIDs onto record dicts
+        (see parsing.record_from_article_element), invalid_pmids is a list of inputted PMIDs not returned by Entrez
+        and failed_pmids is a dict mapping PMIDs that could not be fetched because of request errors (dead letters of
+        the journal) onto error messages. Failed PMIDs are not invalid: they are neither cached as invalid nor
+        removed by the functions below, and can be retried with retry_dead_letters.
+    """
+
+    print('\nLoading records for all articles using Entrez API...')
+    time.sleep(0.1)
+
+    client = get_client(email, api_key)
+    epost_min_pmids = 500  # Larger lists are uploaded with EPost and downloaded in adaptive pages
+    journal_chunk_size = 1000
+
+    pmids = list(dict.fromkeys(str(i) for i in pmids))  # Remove duplicates, preserve order
+    cp = CountryParser()
+
+    records = {}
+    failed_pmids = {}
+    to_fetch = pmids
+    if cache is not None:
+        records, _, to_fetch = cache.lookup('entrez', 'pubmed', 'record', pmids, version=RECORD_VERSION)
+        if not cache.fetch_allowed:
+            to_fetch = []
+
+    def fetch_chunk(i_pmids):
+        i_records = _fetch_records(client, country_parser=cp, id=i_pmids)
+        if cache is not None:
+            cache.store('entrez', 'pubmed', 'record', i_records, version=RECORD_VERSION)
+            cache.store_invalid('entrez', 'pubmed', 'record', [i for i in i_pmids if i not in i_records])
+        return i_records
+
+    if journal_path is not None and to_fetch:
+        journal_records, _, failed_pmids = journaled_harvest(to_fetch, fetch_chunk, journal_path,
+                                                             chunk_size=journal_chunk_size,
+                                                             max_workers=client.max_workers,
+                                                             retry_dead_letters=retry_dead_letters)
+        records.update(journal_records)
+    elif len(to_fetch) > epost_min_pmids:
+        records.update(_records_via_epost(client, to_fetch, country_parser=cp, cache=cache))
+    elif to_fetch:
+        records.update(fetch_chunk(to_fetch))
+
+    if cache is not None:
+        print(cache.report())
+    if cp.memo is not None and to_fetch:
+        print(cp.memo.report())
+        cp.memo.save()
+
+    records = {i: records[i] for i in pmids if i in records}  # Input order, whether cached or fetched
+    invalid_pmids = [i for i in pmids if i not in records and i not in failed_pmids]
+
+    return records, invalid_pmids, failed_pmids
+
+
+def _fetch_records(client, country_parser: CountryParser, **params) -> dict:
+    # Response is parsed as it streams in, one compact record per article
+    handle = client.stream('efetch', db="pubmed", rettype="xml", retmode="xml", **params)
+    try:
+        return {record['pmid']: record for record in iter_pubmed_records(handle, country_parser=country_parser)}
+    finally:
+        handle.close()
+
+
+def _records_via_epost(client, pmids: list, country_parser: CountryParser, cache: RecordCache = None,
+                       max_pmids_per_post: int = 100000) -> dict:
+    """
+    Fetches records by uploading PMIDs to the Entrez history server with EPost and downloading them with efetch in
+    pages (retstart/retmax) whose size adapts to observed latency and errors (see EntrezClient.map_history_pages).
+    PMIDs not returned are only stored as invalid in the cache once every page of their upload has been fetched.
+    """
+    chunk_size = AdaptiveChunkSize(initial=1000, min_size=50, max_size=9999, target_latency=10.)
+
+    records = {}
+    for i_pmids in gen_utils.split_list(pmids, max_pmids_per_post):
+        webenv, query_key = client.epost(i_pmids)
+
+        def fetch_page(retstart, retmax):
+            page_records = _fetch_records(client, country_parser=country_parser, WebEnv=webenv,
+                                          query_key=query_key, retstart=retstart, retmax=retmax)
+            if cache is not None:
+                cache.store('entrez', 'pubmed', 'record', page_records, version=RECORD_VERSION)
+            return page_records
+
+        for page_records in client.map_history_pages(fetch_page, total=len(i_pmids), chunk_size=chunk_size):
+            records.update(page_records)
+
+        if cache is not None:
+            cache.store_invalid('entrez', 'pubmed', 'record', [i for i in i_pmids if i not in records])
+
+    return records
+
+
+def text_from_record(record: dict) -> dict:
+    """
+    Returns the sections of text available in a harvested record (see harvest_from_pmids).
+    :param record: dict returned by parsing.record_from_article_element
+    :return: dict mapping section names onto text, eg. {'abstract': 'We present a review of current literature.'}
+    """
+    if record['abstract'] is None:
+        return {}
+    return {'abstract': record['abstract']}
+
+
+def summary_from_record(record: dict) -> dict:
+    """
+    Returns a harvested record (see harvest_from_pmids) in the format of an Entrez esummary, along with the
+    "mesh_terms" and "pub_countries" fields added by this module. Only the esummary fields used by this module are
+    included; the other fields of a full esummary (EPubDate, LastAuthor, Volume, Issue, Pages, NlmUniqueID, ISSN, ESSN,
+    RecordStatus, PubStatus, ArticleIds, ELocationID, History, References, PmcRefCount, FullJournalName and SO) are
+    not.
+    :param record: dict returned by parsing.record_from_article_element
+    :return: dict with esummary-style keys ('Id', 'Title', 'AuthorList', 'PubDate', etc.)
+    """
+    return {
+        'Id': record['pmid'],
+        'Title': record['title'],
+        'AuthorList': record['authors'],
+        'PubDate': record['pub_date'],
+        'Source': record['source'],
+        'PubTypeList': record['pub_types'],
+        'DOI': record['doi'],
+        'HasAbstract': int(record['has_abstract']),
+        'LangList': record['languages'],
+        'mesh_terms': record['mesh_terms'],
+        'pub_countries': record['pub_countries'],
+    }
+
+
+def text_from_pmids(pmids: list, email: str, api_key: str = None, fill_invalid_pmids="remove",
+                    cache: RecordCache = None, journal_path: str = None, retry_dead_letters: bool = False) -> dict:
     """
     Fetches all text available from Entrez API for a list of PMIDs. Returned text is split into sections (title,
     abstract, methods, etc.), although usually Entrez only returns article titles and abstracts.
     :param pmids: list of PMID strings to obtain texts from Entrez
     :param email: string, NCBI account email address for access to Entrez API
     :param api_key: string, NCBI API key to reduce time between multiple requests
+    :param cache: RecordCache consulted before making requests; None to always fetch from Entrez
+    :param journal_path: string, path to a harvest journal to resume from and record progress in (see
+        harvest_from_pmids); None to harvest without a journal
+    :param retry_dead_letters: boolean, whether to retry PMIDs that could not be fetched in previous runs with the same
+        journal (see harvest_from_pmids)
     :return: nested dict where PMIDs (keys) map onto a dictionary containing sections of text returned from Entrez.
         eg. {'1234': {'title': 'Review of Current Literature', 'abstract':'We present a review of current literature.'},
              '0111': {'title': 'Effects of chemotherapy'}}
@@ -27,66 +184,50 @@ def text_from_pmids(pmids: list, email: str, api_key: str = None, fill_invalid_p
     if not is_fill_invalid_option_allowed(fill_invalid_pmids):
         raise ValueError('fill_invalid_pmid must be either "remove" or a falsey value, like None or {}')
 
-    print('\nLoading abstracts for all articles using Entrez API...')
-    time.sleep(0.1)
-
-    Entrez.email = email
-    if api_key is not None:
-        Entrez.api_key = api_key
-    max_pmids_per_call = 9999
-
-    split_pmids = gen_utils.split_list(pmids, max_pmids_per_call)
-
-    texts = {}
-    for i_pmids in tqdm(split_pmids):
-        i_handle = Entrez.efetch(db="pubmed", id=gen_utils.comma_sep_str_from_list(i_pmids),
-                                 rettype="xml", retmode="text")
-        i_responses = Entrez.read(i_handle)
-        i_responses = gen_utils.convert_to_python_obj(i_responses)
-        i_handle.close()
+    records, invalid_pmids, _ = harvest_from_pmids(pmids, email=email, api_key=api_key, cache=cache,
+                                                   journal_path=journal_path, retry_dead_letters=retry_dead_letters)
 
-        for article in i_responses['PubmedArticle']:
-            try:
-                abstract = article['MedlineCitation']['Article']['Abstract']['AbstractText']
-                abstract = " ".join(abstract)
-                art_text = {'abstract': abstract}
-            except KeyError:
-                art_text = {}
+    return _texts_from_records(records, invalid_pmids, fill_invalid_pmids)
 
-            texts[article['MedlineCitation']['PMID']] = art_text
 
-    invalid_pmids = set(pmids) - set(texts.keys())
+def _texts_from_records(records: dict, invalid_pmids: list, fill_invalid_pmids="remove") -> dict:
+    texts = {pmid: text_from_record(record) for pmid, record in records.items()}
     if invalid_pmids and fill_invalid_pmids != "remove":
         texts.update({i: fill_invalid_pmids for i in invalid_pmids})
 
     return texts
 
 
-def pmids_from_pubmed_query(query: str, email: str, api_key: str = None, free_articles_only: bool = False) -> list:
+def pmids_from_pubmed_query(query: str, email: str, api_key: str = None, free_articles_only: bool = False,
+                            use_history: bool = False, resume_path: str = None) -> list:
     """
     Fetches all PMIDs returned by a PubMed search query.
     :param query: string with PubMed query
     :param email: string, NCBI account email address for access to Entrez API
     :param api_key: string, NCBI API key to reduce time between multiple requests
     :param free_articles_only: boolean, whether to return only PMIDs containing free full texts
+    :param use_history: boolean, whether to store the search on the Entrez history server and page through it in
+        parallel (see pmids_from_history_search) instead of re-querying by publication year
+    :param resume_path: string, path to JSON file where history search progress is saved (only with use_history)
     :return: list containing PMIDs returned by PubMed search of inputted query
     """
 
     print('\nGetting PMIDs returned by query through Entrez API...')
 
-    Entrez.email = email
-    if api_key is not None:
-        Entrez.api_key = api_key
+    client = get_client(email, api_key)
 
     if free_articles_only:
         query = query + ' AND "freetext"[filter]'
         # query = query + ' AND "free only pmc"[filter]'
 
+    if use_history:
+        pmids = pmids_from_history_search(query, email=email, api_key=api_key, resume_path=resume_path)
+        print(f"{len(pmids)} PMIDs returned from PubMed query.")
+        return pmids
+
     # Conducts first API search
-    handle = Entrez.esearch(db='pubmed', term=query, retmax=10000, sort='pub_date', datetype='pdat')
-    response = Entrez.read(handle)
+    response = client.read('esearch', db='pubmed', term=query, retmax=10000, sort='pub_date', datetype='pdat')
     response = gen_utils.convert_to_python_obj(response)
-    handle.close()
 
     # Checking whether total number of PMIDs from search is above or below 9,999 API limit
     total = int(response['Count'])
@@ -97,14 +238,12 @@ def pmids_from_pubmed_query(query: str, email: str, api_key: str = None, free_ar
 
     while len(pmids) < total:
         # Iteratively adds 9,999 more PMIDs to our PMID list until we reach the "total" value (total PMIDs in the search)
-        oldest_returned_date = Entrez.read(Entrez.esummary(db='pubmed', id=pmids[-1], retmode='text'))[0]['PubDate'][
+        oldest_returned_date = client.read('esummary', db='pubmed', id=pmids[-1], retmode='xml')[0]['PubDate'][
                     :4]  # String with YYYY
 
-        i_handle = Entrez.esearch(db='pubmed', term=query, retmax=10000, sort='pub_date', datetype='pdat',
-                                  mindate=0000, maxdate=oldest_returned_date)
-        i_response = Entrez.read(i_handle)
+        i_response = client.read('esearch', db='pubmed', term=query, retmax=10000, sort='pub_date', datetype='pdat',
+                                 mindate=0000, maxdate=oldest_returned_date)
         i_response = gen_utils.convert_to_python_obj(i_response)
-        i_handle.close()
 
         i_pmids = i_response['IdList']
         pmids += i_pmids[i_pmids.index(pmids[-1]) + 1:]
@@ -114,31 +253,150 @@ def pmids_from_pubmed_query(query: str, email: str, api_key: str = None, free_ar
     return pmids
 
 
-def summaries_from_pmids(pmids: list, email: str, api_key: str = None, fill_invalid_pmids='remove') -> dict:
+def pmids_from_history_search(query: str, email: str, api_key: str = None, page_size: int = 10000,
+                              resume_path: str = None, datetype: str = 'pdat', mindate: str = None,
+                              maxdate: str = None, progress_bar: bool = True) -> list:
+    """
+    Fetches all PMIDs returned by a PubMed search query using the Entrez history server. The search is run once with
+    usehistory='y' and the stored result set (sorted by publication date) is then downloaded in pages of page_size
+    PMIDs with efetch (rettype='uilist'), with pages requested in parallel under the client's rate limit. A query
+    returning N PMIDs therefore costs 1 + ceil(N / page_size) requests and returns PMIDs in a deterministic order.
+    :param query: string with PubMed query
+    :param email: string, NCBI account email address for access to Entrez API
+    :param api_key: string, NCBI API key to reduce time between multiple requests
+    :param page_size: int, number of PMIDs per page (max. 10,000)
+    :param resume_path: string, path to JSON file where the history session and completed pages are saved after each
+        page; if it exists (for the same query), only missing pages are fetched. Note that NCBI expires history
+        sessions after a few hours of inactivity.
+    :param datetype: string, date field used by mindate and maxdate ('pdat' publication, 'edat' Entrez (added) or
+        'mdat' modification date)
+    :param mindate: string, only return PMIDs with datetype on or after this date ("YYYY", "YYYY/MM" or "YYYY/MM/DD")
+    :param maxdate: string, only return PMIDs with datetype on or before this date; required with mindate
+    :param progress_bar: boolean, whether to show a progress bar while pages are fetched
+    :return: list containing PMIDs returned by PubMed search of inputted query
+    """
+    client = get_client(email, api_key)
+
+    date_params = {'datetype': datetype}
+    if mindate is not None or maxdate is not None:
+        date_params.update(mindate=mindate or '1800', maxdate=maxdate or '3000')
+
+    state = None
+    if resume_path is not None and os.path.exists(resume_path):
+        with open(resume_path, 'r') as resume_file:
+            state = json.load(resume_file)
+        if state.get('query') != query or state.get('page_size') != page_size or \
+                state.get('date_params', {'datetype': 'pdat'}) != date_params:
+            state = None  # Progress saved for a different search
+
+    if state is None:
+        response = client.read('esearch', db='pubmed', term=query, retmax=0, sort='pub_date', usehistory='y',
+                               **date_params)
+        state = {'query': query, 'page_size': page_size, 'date_params': date_params, 'count': int(response['Count']),
+                 'webenv': str(response['WebEnv']), 'query_key': str(response['QueryKey']), 'pages': {}}
+    else:
+        print(f"Resuming history search: {len(state['pages'])} pages already fetched.")
+
+    state_lock = threading.Lock()
+
+    def save_state():
+        if resume_path is not None:
+            with open(resume_path, 'w') as resume_file:
+                json.dump(state, resume_file)
+
+    def fetch_page(retstart):
+        text = client.request('efetch', db='pubmed', WebEnv=state['webenv'], query_key=state['query_key'],
+                              rettype='uilist', retmode='text', retstart=retstart, retmax=page_size)
+        page = text.decode('utf-8').split()
+        if not all(i.isdigit() for i in page):
+            raise RuntimeError(f"Unexpected response for PMIDs {retstart}-{retstart + page_size} from history server; "
+                               f"the history session may have expired (delete {resume_path} to restart).")
+        with state_lock:
+            state['pages'][str(retstart)] = page
+            save_state()
+        return page
+
+    save_state()
+    missing_retstarts = [i for i in range(0, state['count'], page_size) if str(i) not in state['pages']]
+    client.map(fetch_page, missing_retstarts, progress_bar=progress_bar)
+
+    pmids = []
+    for retstart in range(0, state['count'], page_size):
+        pmids += state['pages'][str(retstart)]
+
+    return list(dict.fromkeys(pmids))  # Guard against duplicates if the result set changed between pages
+
+
+def harvest_from_queries(queries: list, email: str, api_key: str = None, free_articles_only: bool = False,
+                         cache: RecordCache = None, journal_path: str = None,
+                         retry_dead_letters: bool = False) -> tuple:
+    """
+    Runs several PubMed queries (eg. one per drug) and harvests the union of their results. The searches run
+    concurrently under the client's shared rate limit, PMIDs returned by more than one query are deduplicated and every
+    unique record is fetched only once (see harvest_from_pmids).
+    :param queries: list of strings with PubMed queries
+    :param email: string, NCBI account email address for access to Entrez API
+    :param api_key: string, NCBI API key to reduce time between multiple requests
+    :param free_articles_only: boolean, whether to return only PMIDs containing free full texts
+    :param cache: RecordCache consulted before making requests; None to always fetch from Entrez
+    :param journal_path: string, path to a harvest journal to resume from and record progress in (see
+        harvest_from_pmids); None to harvest without a journal
+    :param retry_dead_letters: boolean, whether to retry PMIDs that could not be fetched in previous runs with the same
+        journal (see harvest_from_pmids)
+    :return: tuple (records, invalid_pmids, failed_pmids, membership), where records, invalid_pmids and failed_pmids
+        are as returned by harvest_from_pmids for the union of all queries' PMIDs and membership is a dict mapping
+        each query onto the list of PMIDs it returned.
+    """
+
+    print(f'\nGetting PMIDs returned by {len(queries)} queries through Entrez API...')
+
+    client = get_client(email, api_key)
+    queries = list(dict.fromkeys(queries))
+
+    def search(query):
+        if free_articles_only:
+            query = query + ' AND "freetext"[filter]'
+        return pmids_from_history_search(query, email=email, api_key=api_key, progress_bar=False)
+
+    membership = dict(zip(queries, client.map(search, queries)))
+
+    pmids = list(dict.fromkeys(i for i_pmids in membership.values() for i in i_pmids))
+    n_total = sum(len(i) for i in membership.values())
+    print(f"{n_total} PMIDs returned by queries, {len(pmids)} unique.")
+
+    records, invalid_pmids, failed_pmids = harvest_from_pmids(pmids, email=email, api_key=api_key, cache=cache,
+                                                              journal_path=journal_path,
+                                                              retry_dead_letters=retry_dead_letters)
+
+    return records, invalid_pmids, failed_pmids, membership
+
+
+def summaries_from_pmids(pmids: list, email: str, api_key: str = None, fill_invalid_pmids='remove',
+                         cache: RecordCache = None, journal_path: str = None, retry_dead_letters: bool = False) -> dict:
     # TODO: If you end up merging this module with the original entrez_utils, this function actually changed a fair bit
     #  in order to add author affiliation country and MeSH terms.
     """
-    Returns Entrez esummaries for a list of PMIDs as a nested dict.
+    Returns Entrez esummary-style summaries for a list of PMIDs as a nested dict. Summaries are derived from a single
+    efetch of each article (see harvest_from_pmids and summary_from_record).
     :param pmids: list of PMIDs
     :param email: string, NCBI account email address for access to Entrez API
     :param api_key: string, NCBI API key to reduce time between multiple requests
-    :return: nested dict with Entrez summaries for each of the queries PMIDs
+    :param cache: RecordCache consulted before making requests; None to always fetch from Entrez
+    :param journal_path: string, path to a harvest journal to resume from and record progress in (see
+        harvest_from_pmids); None to harvest without a journal
+    :param retry_dead_letters: boolean, whether to retry PMIDs that could not be fetched in previous runs with the same
+        journal (see harvest_from_pmids)
+    :return: nested dict with Entrez summaries for each of the queries PMIDs (with the esummary fields listed in
+        summary_from_record only)
         eg. {'1234': returned Entrez esummary json/dict,
              '0111': returned Entrez esummary json/dict}
     """
-    Entrez.email = email
-    if api_key is not None:
-        Entrez.api_key = api_key
-    max_pmids_per_call = 9999
-
-    cp = CountryParser()
 
     if not is_fill_invalid_option_allowed(fill_invalid_pmids):
         raise ValueError('fill_invalid_pmid must be either "remove" or a falsey value, like None or {}')
 
-    # Check whether PMIDs are valid for Entrez API
-    pmids, invalid_pmids = remove_invalid_pmids(pmids=pmids, email=email, api_key=api_key,
-                                                verbose=False, return_invalid=True)
+    records, invalid_pmids, _ = harvest_from_pmids(pmids, email=email, api_key=api_key, cache=cache,
+                                                   journal_path=journal_path, retry_dead_letters=retry_dead_letters)
 
     if invalid_pmids:
         print("The following inputted PMIDs are invalid and will not return summaries/metadata:")
@@ -146,66 +404,30 @@ def summaries_from_pmids(pmids: list, email: str, api_key: str = None, fill_inva
             print(f"\t- {i}")
         print('')
 
-    split_pmids = gen_utils.split_list(pmids, max_pmids_per_call)
-
-    summaries = {}
-    for i_pmids in split_pmids:
-        i_handle = Entrez.esummary(db='pubmed', id=gen_utils.comma_sep_str_from_list(i_pmids), retmode='xml')
-        i_resp = Entrez.read(i_handle)
-        i_resp = gen_utils.convert_to_python_obj(i_resp)
-        i_handle.close()
-
-        i_summaries = {i['Id']: i for i in i_resp}  # Populates our "summaries" dictionary with the returned metadata
-
-        i_handle = Entrez.efetch(db='pubmed', id=gen_utils.comma_sep_str_from_list(i_pmids), retmode='xml')
-        i_resp = Entrez.read(i_handle)
-        i_resp = gen_utils.convert_to_python_obj(i_resp)
-
-        for art in i_resp['PubmedArticle']:  # For each article returned in the sub-list of PMIDs
-
-            # Try to get the list of MeSH terms (if available)
-            art_pmid = art['MedlineCitation']['PMID']
-            try:
-                mesh_terms = [i['DescriptorName'] for i in art["MedlineCitation"]['MeshHeadingList']]
-            except KeyError:
-                mesh_terms = []
-
-            # Try to get a list of affiliations (if available) and interpret information using CountryParser
-            aff_set = set()
-            # Better to have two try-except statements because sometimes there are some authors with AffiliationInfo
-            # and some without; using only one try-except statement would ignore the authors with data
-            try:
-                for auth in art["MedlineCitation"]["Article"]["AuthorList"]:
-                    try:
-                        aff_set.update([i['Affiliation'] for i in auth["AffiliationInfo"]])
-                    except (KeyError, IndexError):
-                        pass
-            except KeyError:
-                pass
-
-            aff_ctrs = set()
-            for aff in aff_set:
-                aff_ctrs.update(cp.countries_from_affiliation(aff))
-            aff_ctrs = list(set(aff_ctrs))
-
-            # Updates the metadata for PMID "art_pmid"
-            i_summaries[art_pmid].update({"mesh_terms": mesh_terms, "pub_countries": aff_ctrs})
-
-        summaries.update(i_summaries)
+    return _summaries_from_records(records, invalid_pmids, fill_invalid_pmids)
 
+
+def _summaries_from_records(records: dict, invalid_pmids: list, fill_invalid_pmids='remove') -> dict:
+    summaries = {pmid: summary_from_record(record) for pmid, record in records.items()}
     if fill_invalid_pmids != 'remove':
         summaries.update({i: fill_invalid_pmids for i in invalid_pmids})  # Fill in invalid PMIDs
 
     return summaries
 
 
-def metadata_from_pmids(pmids: list, email: str, api_key: str = None, fill_invalid_pmids='remove') -> dict:
+def metadata_from_pmids(pmids: list, email: str, api_key: str = None, fill_invalid_pmids='remove',
+                        cache: RecordCache = None, journal_path: str = None, retry_dead_letters: bool = False) -> dict:
     # TODO: If you end up merging this module with the original entrez_utils, this function actually changed a fair bit
     #  in order to add author affiliation country and MeSH terms.
     """
     :param pmids: list of PMIDs
     :param email: string, NCBI account email address for access to Entrez API
     :param api_key: string, NCBI API key to reduce time between multiple requests
+    :param cache: RecordCache consulted before making requests; None to always fetch from Entrez
+    :param journal_path: string, path to a harvest journal to resume from and record progress in (see
+        harvest_from_pmids); None to harvest without a journal
+    :param retry_dead_letters: boolean, whether to retry PMIDs that could not be fetched in previous runs with the same
+        journal (see harvest_from_pmids)
     :return: nested dict with article metadata returned by Entrez API
         eg. {
             '1234': {'title': 'Review of Current Literature',
@@ -215,6 +437,8 @@ def metadata_from_pmids(pmids: list, email: str, api_key: str = None, fill_inval
                       ...},
             '0111': {...}
              }
+        The 'metadata' field holds the esummary-style summary of each article, which only has the esummary fields
+        listed in summary_from_record.
     """
 
     print('\nLoading metadata from Entrez API...')
@@ -222,16 +446,16 @@ def metadata_from_pmids(pmids: list, email: str, api_key: str = None, fill_inval
     if not is_fill_invalid_option_allowed(fill_invalid_pmids):
         raise ValueError('fill_invalid_pmid must be either "remove" or a falsey value, like {}')
 
-    summaries = summaries_from_pmids(pmids, email, api_key, fill_invalid_pmids=fill_invalid_pmids)
-    # Clean data (inc. add defaults for fields that might not exist for some articles)
-    for pmid, article in summaries.items():
-        if article and (
-                'DOI' not in article):  # Falsey value means invalid PMID but given default falsey value (like {})
-            article['DOI'] = ''
+    summaries = summaries_from_pmids(pmids, email, api_key, fill_invalid_pmids=fill_invalid_pmids, cache=cache,
+                                     journal_path=journal_path, retry_dead_letters=retry_dead_letters)
+
+    return _metadata_from_summaries(summaries, fill_invalid_pmids)
 
+
+def _metadata_from_summaries(summaries: dict, fill_invalid_pmids='remove') -> dict:
     metadata = {}
     for pmid, article in summaries.items():
-        if article:
+        if article:  # Falsey value means invalid PMID but given default falsey value (like {})
             metadata[pmid] = {
                 'title': article['Title'],
                 'authors': article['AuthorList'],
@@ -255,32 +479,17 @@ def metadata_from_pmids(pmids: list, email: str, api_key: str = None, fill_inval
     return metadata
 
 
-def remove_invalid_pmids(pmids: list, email: str, api_key: str = None, verbose=False, return_invalid=False):
-
-    Entrez.email = email
-    if api_key is not None:
-        Entrez.api_key = api_key
-    max_pmids_per_call = 9999
+def remove_invalid_pmids(pmids: list, email: str, api_key: str = None, verbose=False, return_invalid=False,
+                         cache: RecordCache = None, journal_path: str = None, retry_dead_letters: bool = False):
 
-    split_pmids = gen_utils.split_list(pmids, max_pmids_per_call)
-    returned_pmids = []
-    for i_pmids in split_pmids:
-        i_handle = Entrez.efetch(db="pubmed", id=gen_utils.comma_sep_str_from_list(i_pmids),
-                                 rettype="xml", retmode="text")
-        i_responses = Entrez.read(i_handle)
-        i_responses = gen_utils.convert_to_python_obj(i_responses)
-        i_handle.close()
-
-        returned_pmids += [i['MedlineCitation']['PMID'] for i in i_responses['PubmedArticle']]
-
-    removed_pmids = list(set(pmids) - set(returned_pmids))
+    records, removed_pmids, failed_pmids = harvest_from_pmids(pmids, email=email, api_key=api_key, cache=cache,
+                                                              journal_path=journal_path,
+                                                              retry_dead_letters=retry_dead_letters)
+    # PMIDs that failed because of request errors are kept, since they can't be confirmed as invalid
+    returned_pmids = [i for i in dict.fromkeys(str(i) for i in pmids) if i in records or i in failed_pmids]
 
     if verbose:
-        if removed_pmids:
-            print("\nFollowing PMIDs are not found on Entrez API and were removed:")
-            for i in removed_pmids:
-                print(f"\t- {i}")
-            print('')
+        _print_removed_pmids(removed_pmids)
 
     if return_invalid:
         return returned_pmids, removed_pmids
@@ -288,20 +497,27 @@ def remove_invalid_pmids(pmids: list, email: str, api_key: str = None, verbose=F
         return returned_pmids
 
 
-def get_and_parse_metadata_from_entrez(df, email, api_key=None):
+def _print_removed_pmids(removed_pmids: list):
+    if removed_pmids:
+        print("\nFollowing PMIDs are not found on Entrez API and were removed:")
+        for i in removed_pmids:
+            print(f"\t- {i}")
+        print('')
+
+
+def get_and_parse_metadata_from_entrez(df, email, api_key=None, cache=None):
     # TODO: If we end up joining this with the automation project, this is redundant and should just use
     #  entrez_utils.metadata_from_pmids() instead
 
     # TODO: Check out the above? Did I not need to merge this?
 
     pmids = list(dict.fromkeys(df['pmid'].to_list()).keys())
-    metadata = metadata_from_pmids(pmids, email=email, api_key=api_key)
+    metadata = metadata_from_pmids(pmids, email=email, api_key=api_key, cache=cache)
 
     known_langs = gen_utils.load_csv_to_list(os.path.join('standard_values', 'languages.csv'))
     lang_to_col_name = {i: f"is_{i}" for i in known_langs}
     with open(os.path.join("col_name_indexes", "lang_to_col_name.json"), "w") as lang_json:
         json.dump(lang_to_col_name, lang_json)
-    lang_df = pd.DataFrame(False, index=df.index, columns=lang_to_col_name.values())
 
     all_ctrs = set()
     for md in metadata.values():
@@ -309,48 +525,76 @@ def get_and_parse_metadata_from_entrez(df, email, api_key=None):
     ctr_to_col_name = {i: f"from_{i.replace(' ', '_')}" for i in all_ctrs}
     with open(os.path.join("col_name_indexes", "ctr_to_col_name.json"), "w") as ctr_json:
         json.dump(ctr_to_col_name, ctr_json)
-    ctr_df = pd.DataFrame(False, index=df.index, columns=ctr_to_col_name.values())
 
+    # Metadata as a frame indexed by PMID, joined onto df's "pmid" column below (instead of one scan per PMID)
+    md_df = pd.DataFrame({
+        'title': [md['title'] for md in metadata.values()],
+        'pub_year': [md['pub_year'] for md in metadata.values()],
+        'journal': [md['source'] for md in metadata.values()],  # Full names also available in metadata dict
+        'languages': [[i.lower() for i in md['metadata']['LangList']] for md in metadata.values()],
+        'pub_countries': [md['pub_countries'] for md in metadata.values()],
+        'mesh_terms': [md['mesh_terms'] for md in metadata.values()],
+    }, index=pd.Index(list(metadata.keys()), name='pmid'))
+
+    # OHE languages and countries, built in one shot from exploded lists
+    lang_df = _one_hot_from_lists(md_df['languages'], lang_to_col_name, df['pmid'])
+    ctr_df = _one_hot_from_lists(md_df['pub_countries'], ctr_to_col_name, df['pmid'])
     df = pd.concat([df, lang_df, ctr_df], axis=1)
-    df["mesh_terms"] = [[]]*len(df)
 
-    for pmid, md in metadata.items():
-        idxs = df[df['pmid'] == pmid].index
+    # List MeSH terms (one list per row, so rows never share the same list object)
+    mesh_terms = df['pmid'].map(md_df['mesh_terms'])
+    df["mesh_terms"] = [list(i) if isinstance(i, list) else [] for i in mesh_terms]
+
+    has_md = df['pmid'].isin(md_df.index)
+    for col in ['title', 'pub_year', 'journal']:
+        new_vals = df['pmid'].map(md_df[col])
+        df[col] = new_vals.where(has_md, df[col]) if col in df.columns else new_vals
 
-        df.loc[idxs, 'title'] = md['title']
-        df.loc[idxs, 'pub_year'] = md['pub_year']
-        df.loc[idxs, 'journal'] = md['source']  # Full names also available in metadata dict
+    # TODO: things below
+    # df['authors'] = ...
 
-        for lang in md['metadata']['LangList']:
-            if lang.lower() in known_langs:
-                df.loc[idxs, lang_to_col_name[lang.lower()]] = True
+    # df['pub_year'] = df['pub_year'].astype(int)
+
+    return df
 
-        # OHE countries
-        for ctr in md['pub_countries']:
-            df.loc[idxs, ctr_to_col_name[ctr]] = True
 
-        # List MeSH terms
-        for idx in idxs:
-            df.at[idx, "mesh_terms"] = md["mesh_terms"]
+def _one_hot_from_lists(lists: pd.Series, val_to_col_name: dict, pmids: pd.Series) -> pd.DataFrame:
+    """
+    One-hot encodes a Series of lists (indexed by PMID) into boolean columns, aligned onto the rows of a "pmid"
+    column. Values not in val_to_col_name are ignored; rows whose PMID isn't in lists are all False.
+    :param lists: pandas.Series indexed by PMID, with list values (eg. languages of each article)
+    :param val_to_col_name: dict mapping list values onto the names of their OHE columns
+    :param pmids: pandas.Series with the PMID of each row of the returned DataFrame
+    :return: pandas.DataFrame with the same index as pmids and one boolean column per value of val_to_col_name
+    """
+    exploded = lists.explode()
+    exploded = exploded[exploded.isin(list(val_to_col_name.keys()))]
 
+    ohe = pd.DataFrame(False, index=lists.index.unique(), columns=list(val_to_col_name.keys()))
+    if len(exploded):
+        hits = pd.crosstab(exploded.index, exploded.to_numpy()).astype(bool)
+        ohe.loc[hits.index, hits.columns] = hits
 
-        # TODO: things below
-        # df.loc[idxs, 'authors'] = md['']
+    ohe = ohe.reindex(pmids.to_numpy(), fill_value=False).rename(columns=val_to_col_name)
+    ohe.index = pmids.index
 
-    # df['pub_year'] = df['pub_year'].astype(int)
+    return ohe
 
-    return df
 
+def get_complete_df_from_pmids(pmids:list, email: str, api_key: str=None, cache: RecordCache = None,
+                               journal_path: str = None, retry_dead_letters: bool = False):
 
-def get_complete_df_from_pmids(pmids:list, email: str, api_key: str=None):
+    # Single harvest; validity, metadata and text are all views over the same records
+    records, invalid_pmids, _ = harvest_from_pmids(pmids, email=email, api_key=api_key, cache=cache,
+                                                   journal_path=journal_path, retry_dead_letters=retry_dead_letters)
+    _print_removed_pmids(invalid_pmids)
 
-    pmids, invalid_pmids = remove_invalid_pmids(pmids, email=email, api_key=api_key, verbose=True, return_invalid=True)
-    metadata = metadata_from_pmids(pmids, email=email, api_key=api_key)
-    text = text_from_pmids(pmids, email=email, api_key=api_key)
+    pmids = list(records.keys())
+    metadata = _metadata_from_summaries(_summaries_from_records(records, invalid_pmids))
+    text = _texts_from_records(records, invalid_pmids)
 
     pmids = pd.DataFrame(data={'pmid': pmids}, index=pmids)
     metadata = pd.DataFrame.from_dict(metadata, orient='index')
     text = pd.DataFrame(data={'text': list(text.values())}, index=list(text.keys()))
 
     return pd.concat([pmids, metadata, text], axis=1, join='outer')
-
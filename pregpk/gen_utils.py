@@ -53,27 +53,74 @@ def comma_sep_str_from_list(pmid_list:list) -> str:
     return ','.join(map(str, pmid_list))
 
 
-def convert_to_python_obj(obj: Any) -> Any:
+def convert_to_python_obj(obj: Any, keep_keys: set = None) -> Any:
     """
     Converts a non-python native object which is an instance of a python object (string, list, dict, etc.) to a
-    python-native type.
+    python-native type. Nested containers are converted iteratively (with an explicit stack instead of recursion) and
+    the conversion used for each type is looked up in a dispatch table, so large Bio.Entrez responses are converted
+    without one isinstance chain and function call per node.
     :param obj: Any type, but must be an instance of a python-native object (bool, str, int, list, etc.)
+    :param keep_keys: set of dict keys to keep; if given, dict entries (at any depth) whose keys are not in keep_keys
+        are dropped without being converted, pruning unused subtrees
     :return: Python-native object version of inputted object.
     """
-    if isinstance(obj, bool):
-        obj = convert_to_python_bool(obj)
-    elif isinstance(obj, str):
-        obj = convert_to_python_str(obj)
-    elif isinstance(obj, int):
-        obj = convert_to_python_int(obj)
-    elif isinstance(obj, dict):
-        obj = convert_to_python_dict(obj)
-    elif isinstance(obj, list):
-        obj = convert_to_python_list(obj)
-    elif isinstance(obj, tuple):
-        obj = convert_to_python_tuple(obj)
-
-    return obj
+    kind = _python_kind(type(obj))
+    if kind not in _CONTAINER_KINDS:
+        return _SCALAR_CONVERTERS[kind](obj) if kind is not None else obj
+
+    root = {} if kind is dict else []
+    stack = [(obj, root)]
+    tuple_fixups = []  # (parent, key, list) for tuples, which are built as lists and converted once filled
+    kind_cache, scalars = _KIND_CACHE, _SCALAR_CONVERTERS
+
+    while stack:
+        src, dst = stack.pop()
+        is_dict = type(dst) is dict
+        for key, val in (src.items() if is_dict else enumerate(src)):
+            if is_dict:
+                if keep_keys is not None and key not in keep_keys:
+                    continue
+                key_type = type(key)
+                if key_type is not str:
+                    key_kind = kind_cache[key_type] if key_type in kind_cache else _python_kind(key_type)
+                    key = scalars[key_kind](key) if key_kind in scalars else key
+
+            val_type = type(val)
+            val_kind = kind_cache[val_type] if val_type in kind_cache else _python_kind(val_type)
+            if val_kind is str:  # Most common case by far (eg. Bio.Entrez StringElement)
+                val = str(val)
+            elif val_kind is dict or val_kind is list or val_kind is tuple:
+                new_val = {} if val_kind is dict else []
+                stack.append((val, new_val))
+                if val_kind is tuple:
+                    tuple_fixups.append((dst, key, new_val))
+                val = new_val
+            elif val_kind is not None:
+                val = scalars[val_kind](val)
+
+            if is_dict:
+                dst[key] = val
+            else:
+                dst.append(val)
+
+    # Fixups were registered parent-first, so reversing converts inner tuples before the tuples containing them
+    for parent, key, lst in reversed(tuple_fixups):
+        parent[key] = tuple(lst)
+
+    return tuple(root) if kind is tuple else root
+
+
+def _python_kind(obj_type: type):
+    """
+    Returns the python-native type (bool, str, int, dict, list or tuple) that obj_type is a subclass of, or None.
+    Results are cached per type, so subclasses (eg. Bio.Entrez StringElement) only walk their MRO once.
+    """
+    try:
+        return _KIND_CACHE[obj_type]
+    except KeyError:
+        kind = next((i for i in obj_type.__mro__ if i in _NATIVE_KINDS), None)
+        _KIND_CACHE[obj_type] = kind
+        return kind
 
 
 def convert_to_python_bool(obj):
@@ -109,7 +156,7 @@ def convert_to_python_dict(obj):
     :param obj: object where type is an instance of dict
     :return: python native dict
     """
-    return {convert_to_python_obj(key): convert_to_python_obj(val) for key, val in obj.items()}
+    return convert_to_python_obj(dict(obj))
 
 
 def convert_to_python_list(obj):
@@ -118,7 +165,7 @@ def convert_to_python_list(obj):
     :param obj: object where type is an instance of list
     :return: python native list
     """
-    return [convert_to_python_obj(i) for i in obj]
+    return convert_to_python_obj(list(obj))
 
 
 def convert_to_python_tuple(obj):
@@ -127,7 +174,18 @@ def convert_to_python_tuple(obj):
     :param obj: object where type is an instance of tuple
     :return: python native tuple
     """
-    return (convert_to_python_obj(i) for i in obj)
+    return convert_to_python_obj(tuple(obj))
+
+
+# bool comes before int in bool's MRO, so booleans are not converted to integers
+_SCALAR_CONVERTERS = {
+    bool: convert_to_python_bool,
+    str: convert_to_python_str,
+    int: convert_to_python_int,
+}
+_CONTAINER_KINDS = {dict, list, tuple}
+_NATIVE_KINDS = set(_SCALAR_CONVERTERS) | _CONTAINER_KINDS
+_KIND_CACHE = {}
 
 
 def set_default_dict(d:dict, default:dict) -> dict:
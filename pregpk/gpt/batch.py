@@ -0,0 +1,127 @@
+import os
+import json
+from openai import OpenAI
+from pregpk.gpt.utilities import gpt_params_with_defaults, checked_class_key, result_from_response
+
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+MAX_REQUESTS_PER_FILE = 50000  # OpenAI's limit of requests per batch input file
+CUSTOM_ID_PREFIX = "pmid-"
+
+
+def custom_id_from_pmid(pmid) -> str:
+    return f"{CUSTOM_ID_PREFIX}{pmid}"
+
+
+def pmid_from_custom_id(custom_id: str) -> str:
+    return custom_id[len(CUSTOM_ID_PREFIX):] if custom_id.startswith(CUSTOM_ID_PREFIX) else custom_id
+
+
+def write_batch_requests(prompts: dict, path: str, gpt_params=None,
+                         max_requests_per_file: int = MAX_REQUESTS_PER_FILE) -> list:
+    """
+    Writes chat completion requests as JSONL input files of the OpenAI Batch API, to screen many articles in one job
+    (at a lower price than synchronous requests, see run_gpt_study) instead of one request at a time. Each request's
+    custom_id is derived from the PMID of its article, so results can be matched back with read_batch_results.
+    :param prompts: dict (or pandas.Series) mapping PMIDs onto messages (list of dicts, as in run_gpt_study's prompts)
+    :param path: string, path of JSONL file; if there are more than max_requests_per_file prompts, requests are split
+        into several files, numbered before the extension (eg. "requests_001.jsonl", "requests_002.jsonl", ...)
+    :param gpt_params: dictionary with any ChatGPT parameters to change from default values (as in run_gpt_study)
+    :param max_requests_per_file: int, maximum number of requests per file
+    :return: list of strings, paths of written files
+    """
+    gpt_params = gpt_params_with_defaults(gpt_params)
+    prompts = list(prompts.items())
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    n_files = max(1, -(-len(prompts) // max_requests_per_file))
+    root, ext = os.path.splitext(path)
+    paths = [path] if n_files == 1 else [f"{root}_{i + 1:03d}{ext}" for i in range(n_files)]
+
+    for i_file, file_path in enumerate(paths):
+        with open(file_path, 'w') as request_file:
+            for pmid, messages in prompts[i_file * max_requests_per_file:(i_file + 1) * max_requests_per_file]:
+                if isinstance(messages, dict):
+                    messages = [messages]
+                request = {"custom_id": custom_id_from_pmid(pmid),
+                           "method": "POST",
+                           "url": BATCH_ENDPOINT,
+                           "body": {"model": gpt_params["version"],
+                                    "temperature": gpt_params["temperature"],
+                                    "max_tokens": gpt_params["max_tokens"],
+                                    "messages": messages}}
+                request_file.write(json.dumps(request) + '\n')
+
+    return paths
+
+
+def read_batch_results(paths, class_key=None, class_error_val=-1) -> dict:
+    """
+    Reads the JSONL output (and error) files of OpenAI Batch API jobs written with write_batch_requests, classifying
+    responses as in run_gpt_study.
+    :param paths: string or list of strings, paths of batch output/error files
+    :param class_key: dict defining classes of response prefixes (as in run_gpt_study)
+    :param class_error_val: any, class for responses not starting with a key of class_key, and for failed requests
+    :return: dict mapping PMIDs onto results with "gpt_pred" (if class_key is given) and "gpt_response"; failed
+        requests have a "gpt_response" of None and the error message in "gpt_error"
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    class_key = checked_class_key(class_key)
+
+    results = {}
+    for path in paths:
+        with open(path, 'r') as result_file:
+            for line in result_file:
+                if not line.strip():
+                    continue
+                line = json.loads(line)
+                pmid = pmid_from_custom_id(line["custom_id"])
+                response = line.get("response") or {}
+
+                if line.get("error") or response.get("status_code") != 200:
+                    error = line.get("error") or response.get("body", {}).get("error") or {}
+                    results[pmid] = {"gpt_pred": class_error_val} if class_key is not None else {}
+                    results[pmid]["gpt_response"] = None
+                    results[pmid]["gpt_error"] = error.get("message", f"HTTP {response.get('status_code')}")
+                    continue
+
+                ret = response["body"]["choices"][0]["message"]["content"]
+                results[pmid] = result_from_response(ret, class_key, class_error_val)
+
+    return results
+
+
+def submit_batch(request_path: str, chatgpt_api_key: str, base_url: str = None) -> str:
+    """
+    Uploads a batch input file (see write_batch_requests) and starts a batch job with a 24h completion window.
+    :return: string, ID of batch job
+    """
+    client = OpenAI(api_key=chatgpt_api_key, base_url=base_url)
+    with open(request_path, 'rb') as request_file:
+        input_file = client.files.create(file=request_file, purpose="batch")
+    batch = client.batches.create(input_file_id=input_file.id, endpoint=BATCH_ENDPOINT, completion_window="24h")
+    return batch.id
+
+
+def download_batch_results(batch_id: str, output_path: str, chatgpt_api_key: str, base_url: str = None) -> list:
+    """
+    Downloads the output (and error) files of a finished batch job, to be read with read_batch_results.
+    :param output_path: string, path of output JSONL file; errors are written to "<output_path root>_errors.jsonl"
+    :return: list of strings, paths of written files (empty if the batch job hasn't finished yet)
+    """
+    client = OpenAI(api_key=chatgpt_api_key, base_url=base_url)
+    batch = client.batches.retrieve(batch_id)
+    if batch.status != "completed":
+        print(f"Batch {batch_id} is {batch.status}.")
+        return []
+
+    root, ext = os.path.splitext(output_path)
+    paths = []
+    for file_id, path in ((batch.output_file_id, output_path), (batch.error_file_id, f"{root}_errors{ext}")):
+        if file_id:
+            with open(path, 'wb') as out_file:
+                out_file.write(client.files.content(file_id).content)
+            paths.append(path)
+    return paths
@@ -0,0 +1,138 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.pregpk', 'gpt_response_cache.sqlite')
+
+
+class ResponseCache:
+    """
+    Persistent on-disk cache of chat completion responses, stored in an SQLite database and keyed by a hash of the
+    request (model, temperature, max_tokens and messages), so re-running a study (eg. after a crash, or comparing a
+    new prompt on the same articles) doesn't pay for identical requests again. Token usage and cost are stored with
+    each response, so hits can be accounted as cost saved.
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH):
+        """
+        :param path: string, path to SQLite database file (created if it doesn't exist)
+        """
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.cost_saved = 0.
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS responses ("
+                           "key TEXT PRIMARY KEY, model TEXT, temperature REAL, max_tokens INTEGER, messages TEXT, "
+                           "response TEXT, prompt_tokens INTEGER, completion_tokens INTEGER, cost REAL, "
+                           "created_at REAL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_model ON responses (model, created_at)")
+        self._conn.commit()
+
+    @staticmethod
+    def key(model: str, temperature: float, max_tokens: int, messages) -> str:
+        """
+        :return: string, SHA-256 hex digest identifying a request
+        """
+        request = json.dumps({'model': model, 'temperature': float(temperature), 'max_tokens': int(max_tokens),
+                              'messages': messages}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+    def lookup(self, key: str):
+        """
+        :return: cached response string for a request key, or None if it isn't cached
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT response, cost FROM responses WHERE key=?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.cost_saved += row[1] or 0.
+        return row[0]
+
+    def store(self, key: str, model: str, temperature: float, max_tokens: int, messages, response: str,
+              prompt_tokens: int = None, completion_tokens: int = None, cost: float = None):
+        """
+        Stores (or overwrites) the response to a request.
+        :param cost: float, cost (in USD) of the request; None if unknown
+        """
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                               (key, model, float(temperature), int(max_tokens), json.dumps(messages), response,
+                                prompt_tokens, completion_tokens, cost, time.time()))
+            self._conn.commit()
+
+    @staticmethod
+    def _where(model: str = None, before: float = None, after: float = None) -> tuple:
+        clauses, params = [], []
+        if model is not None:
+            clauses.append("model=?")
+            params.append(model)
+        if before is not None:
+            clauses.append("created_at<?")
+            params.append(before)
+        if after is not None:
+            clauses.append("created_at>=?")
+            params.append(after)
+        return (f" WHERE {' AND '.join(clauses)}" if clauses else ""), params
+
+    def prune(self, model: str = None, before: float = None) -> int:
+        """
+        Deletes cached responses.
+        :param model: string, only delete responses of this model; None for every model
+        :param before: float, only delete responses stored before this time (Unix timestamp, eg. time.time() - 30 *
+            86400); None for any time
+        :return: int, number of deleted responses
+        """
+        where, params = self._where(model=model, before=before)
+        with self._lock:
+            n = self._conn.execute(f"DELETE FROM responses{where}", params).rowcount
+            self._conn.commit()
+        return n
+
+    def export(self, path: str, model: str = None, before: float = None, after: float = None) -> int:
+        """
+        Exports cached responses (with their requests) as JSON lines.
+        :param path: string, path to JSON-lines file
+        :param model: string, only export responses of this model; None for every model
+        :param before: float, only export responses stored before this time (Unix timestamp); None for any time
+        :param after: float, only export responses stored at or after this time (Unix timestamp); None for any time
+        :return: int, number of exported responses
+        """
+        where, params = self._where(model=model, before=before, after=after)
+        with self._lock:
+            rows = self._conn.execute(f"SELECT key, model, temperature, max_tokens, messages, response, "
+                                      f"prompt_tokens, completion_tokens, cost, created_at FROM responses{where} "
+                                      f"ORDER BY created_at", params).fetchall()
+        with open(path, 'w') as export_file:
+            for row in rows:
+                entry = dict(zip(('key', 'model', 'temperature', 'max_tokens', 'messages', 'response',
+                                  'prompt_tokens', 'completion_tokens', 'cost', 'created_at'), row))
+                entry['messages'] = json.loads(entry['messages'])
+                export_file.write(json.dumps(entry) + '\n')
+        return len(rows)
+
+    def hit_rate(self) -> float:
+        n = self.hits + self.misses
+        return self.hits / n if n else 0.
+
+    def report(self) -> str:
+        return (f"GPT response cache: {self.hits} hits, {self.misses} misses ({self.hit_rate():.1%} hit rate), "
+                f"${self.cost_saved:.4f} saved")
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.cost_saved = 0.
+
+    def close(self):
+        self._conn.close()
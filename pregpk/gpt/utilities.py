@@ -1,20 +1,42 @@
 import os
+import time
+import random
 import tiktoken
 import warnings
-from tqdm import tqdm
+import functools
+import openai
 from openai import OpenAI
 from pregpk import gen_utils
+from pregpk.rate_limiting import MinuteBudget, map_in_order
+from pregpk.gpt.cache import ResponseCache
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(gpt_model: str = "gpt-4") -> tiktoken.Encoding:
+    # Encoders are built once per model (building one parses its whole BPE vocabulary)
+    return tiktoken.encoding_for_model(gpt_model)
 
 
 def num_tokens_from_string(string: str, gpt_model: str="gpt-4") -> int:
-    encoding = tiktoken.encoding_for_model(gpt_model)
+    encoding = get_encoding(gpt_model)
     num_tokens = len(encoding.encode(string))
     return num_tokens
 
 
+def num_tokens_from_batch(strings, gpt_model: str = "gpt-4", num_threads: int = 8) -> list:
+    """
+    Counts the tokens of many strings at once, encoding them in parallel with tiktoken's encode_batch.
+    :param strings: list of strings
+    :param gpt_model: string, model whose encoding is used
+    :param num_threads: int, number of threads used for encoding
+    :return: list of ints, number of tokens of each string
+    """
+    return [len(i) for i in get_encoding(gpt_model).encode_batch(list(strings), num_threads=num_threads)]
+
+
 def num_tokens_from_list(obj, gpt_model:str):
     # TODO: maybe add functionality for nested lists through recursion
-    return [num_tokens_from_string(i, gpt_model) for i in obj]
+    return num_tokens_from_batch(obj, gpt_model)
 
 
 def cost_per_token(gpt_version:str, output:bool=False) -> float:
@@ -40,25 +62,95 @@ def cost_per_token(gpt_version:str, output:bool=False) -> float:
     return float('inf')
 
 
-def run_gpt_study(prompts, chatgpt_api_key, gpt_params=None, class_key=None, class_error_val=-1):
+def run_gpt_study(prompts, chatgpt_api_key, gpt_params=None, class_key=None, class_error_val=-1, max_in_flight=1,
+                  requests_per_minute=None, tokens_per_minute=None, max_tries=6, base_url=None, cache=None,
+                  cache_nonzero_temperature=False):
     """
-    prompts: list of inputs for OpenAI's "prompt" field. Inputs themselves must be dicts or list of dicts
+    prompts: list of inputs for OpenAI's "prompt" field, or dict (or pandas.Series) mapping indices onto them (eg.
+    the "prompts" of prompt_testing.planning.plan_gpt_study). Inputs themselves must be dicts or list of dicts
     chatgpt_api_key: string with ChatGPT API key
     gpt_params: dictionary with any ChatGPT parameters to change from default values
     (GPT-3.5, temperature=0.1, max_tokens=50)
     class_key: dict. If telling GPT to start message with a set of characters to define classifications, dict
     defining key for these classes (eg. '0': False, '1': True, '2': 'Maybe').
     class_error_val: any, returned class for when first character is not found in keys to class_key
+    max_in_flight: int, maximum number of concurrent requests (1 sends prompts one at a time)
+    requests_per_minute: float, requests-per-minute limit of the account/model; None for no limit
+    tokens_per_minute: float, tokens-per-minute limit of the account/model (requests are scheduled using
+    num_tokens_from_string estimates of prompt tokens plus max_tokens); None for no limit
+    max_tries: int, number of attempts for requests failing with HTTP 429/5xx or connection errors (retried with
+    exponential backoff, or after Retry-After if given)
+    base_url: string, base URL of an OpenAI-compatible API (eg. a local stub server); None for OpenAI
+    cache: gpt.cache.ResponseCache consulted before (and updated after) each request; only used if temperature is 0
+    or cache_nonzero_temperature is True, since otherwise repeated requests are expected to give different responses
+    cache_nonzero_temperature: bool, whether to use cache even if temperature is not 0
+    Results are returned in the same order as prompts; if prompts is a dict (or pandas.Series), as a dict mapping its
+    indices onto results.
     """
 
+    gpt_params = gpt_params_with_defaults(gpt_params)
+    class_key = checked_class_key(class_key)
+
+    indices = None
+    if hasattr(prompts, "items"):  # dict or pandas.Series
+        indices = list(prompts.keys())
+        prompts = [prompts[idx] for idx in indices]
+
+    client = OpenAI(api_key=chatgpt_api_key, base_url=base_url, max_retries=0)  # Retries are handled below
+    budget = MinuteBudget(requests_per_minute, tokens_per_minute)
+    if cache is not None and gpt_params["temperature"] != 0 and not cache_nonzero_temperature:
+        cache = None
+
+    def run_prompt(prompt):
+        key = None
+        if cache is not None:
+            key = ResponseCache.key(gpt_params["version"], gpt_params["temperature"], gpt_params["max_tokens"], prompt)
+            ret = cache.lookup(key)
+            if ret is not None:
+                return result_from_response(ret, class_key, class_error_val)
+
+        n_tokens = 0
+        if tokens_per_minute:
+            n_tokens = num_tokens_from_messages(prompt, gpt_params["version"]) + gpt_params["max_tokens"]
+        completion = _create_completion(client, budget, n_tokens, max_tries,
+                                        model=gpt_params["version"],
+                                        temperature=gpt_params["temperature"],
+                                        max_tokens=gpt_params["max_tokens"],
+                                        messages=prompt,)
+        ret = completion.choices[0].message.content
+
+        if cache is not None:
+            usage = completion.usage
+            cost = None
+            if usage is not None and cost_per_token(gpt_params["version"]) != float('inf'):
+                cost = usage.prompt_tokens * cost_per_token(gpt_params["version"]) + \
+                       usage.completion_tokens * cost_per_token(gpt_params["version"], output=True)
+            cache.store(key, gpt_params["version"], gpt_params["temperature"], gpt_params["max_tokens"], prompt, ret,
+                        prompt_tokens=usage.prompt_tokens if usage is not None else None,
+                        completion_tokens=usage.completion_tokens if usage is not None else None, cost=cost)
+
+        return result_from_response(ret, class_key, class_error_val)
+
+    results = map_in_order(run_prompt, prompts, max_workers=max_in_flight)
+    if cache is not None:
+        print(cache.report())
+
+    if indices is not None:
+        return dict(zip(indices, results))
+    return results
+
+
+def gpt_params_with_defaults(gpt_params=None) -> dict:
     # Set default values for hyperparameters if not given
     gpt_params_def = {"version": "gpt-3.5-turbo-0125",
                       "temperature": 0.1,
                       "max_tokens": 50,}
     if gpt_params is None:
         gpt_params = {}
-    gpt_params = gen_utils.set_default_dict(gpt_params, gpt_params_def)
+    return gen_utils.set_default_dict(gpt_params, gpt_params_def)
+
 
+def checked_class_key(class_key):
     # Check whether keys are allowed (can't share anything that .startswith() would return true for more than one key)
     if class_key is not None:
         keys = list(class_key.keys())
@@ -69,29 +161,48 @@ def run_gpt_study(prompts, chatgpt_api_key, gpt_params=None, class_key=None, cla
                         warnings.warn(f'Keys "{key1}" and "{key2}" are not allowed as keys cannot be '
                                       f'prefixes of one another. Class conversion to "gpt_pred" will be skipped.')
                         class_key = None
+    return class_key
 
-    results = []
-    client = OpenAI(api_key=chatgpt_api_key)
-    for prompt in tqdm(prompts):
-        completion = client.chat.completions.create(
-            model=gpt_params["version"],
-            temperature=gpt_params["temperature"],
-            max_tokens=gpt_params["max_tokens"],
-            messages=prompt,
-        )
-
-        result = {}
-        ret = completion.choices[0].message.content
 
-        if class_key is not None:
-            for key, val in class_key.items():
-                if ret.startswith(key):
-                    result["gpt_pred"] = val
-                    break
-            result.setdefault("gpt_pred", class_error_val)
+def num_tokens_from_messages(messages, gpt_model: str = "gpt-4") -> int:
+    # Estimate of prompt tokens of a chat completion request (content tokens plus a few tokens of overhead per message)
+    if isinstance(messages, dict):
+        messages = [messages]
+    return sum(num_tokens_from_string(str(i.get("content", "")), gpt_model) + 4 for i in messages) + 3
 
-        result["gpt_response"] = ret  # Adding last just to maintain cleaner order in json if created
 
-        results.append(result)
-    return results
+def _create_completion(client, budget: MinuteBudget, n_tokens: int, max_tries: int, **params):
+    for i in range(max_tries):
+        budget.acquire(n_tokens)
+        try:
+            return client.chat.completions.create(**params)
+        except (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError) as e:
+            if i >= max_tries - 1:
+                raise
+            time.sleep(_retry_delay(e, i))
+
+
+def _retry_delay(error, i_try: int) -> float:
+    # Retry-After (in seconds) if the API sent one, otherwise exponential backoff with jitter
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            return float(response.headers.get("retry-after"))
+        except (TypeError, ValueError):
+            pass
+    return min(2 ** i_try, 60) * random.uniform(0.5, 1.)
+
+
+def result_from_response(ret: str, class_key=None, class_error_val=-1) -> dict:
+    result = {}
+
+    if class_key is not None:
+        for key, val in class_key.items():
+            if ret.startswith(key):
+                result["gpt_pred"] = val
+                break
+        result.setdefault("gpt_pred", class_error_val)
+
+    result["gpt_response"] = ret  # Adding last just to maintain cleaner order in json if created
 
+    return result
@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import random
+import warnings
+import threading
+import requests
+import urllib3
+from pregpk import gen_utils
+from pregpk.rate_limiting import map_in_order
+
+
+class HarvestJournal:
+    """
+    Append-only JSON-lines journal of a harvest. Each completed chunk is written (with its records) as soon as it is
+    fetched, along with PMIDs that could not be fetched even on their own (dead letters), so an interrupted harvest
+    can be resumed from where it stopped instead of restarting from zero.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: string, path to journal file; existing entries are loaded if the file exists
+        """
+        self.path = path
+        self.completed_pmids = set()
+        self.records = {}
+        self.dead_letters = {}  # PMID -> error message
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            self._load()
+        elif os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def _load(self):
+        with open(self.path, 'r') as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:  # Partially written line from an interrupted run
+                    continue
+
+                if entry['type'] == 'chunk':
+                    self.completed_pmids.update(entry['pmids'])
+                    self.records.update(entry['records'])
+                    for pmid in entry['pmids']:
+                        self.dead_letters.pop(pmid, None)
+                elif entry['type'] == 'dead_letter':
+                    self.dead_letters[entry['pmid']] = entry['error']
+
+    def _append(self, entry: dict):
+        with self._lock:
+            with open(self.path, 'a') as journal_file:
+                journal_file.write(json.dumps(entry) + '\n')
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+
+    def record_chunk(self, pmids: list, records: dict):
+        """
+        Records a successfully fetched chunk of PMIDs; PMIDs in the chunk but not in records were not returned by
+        the API (invalid).
+        """
+        self._append({'type': 'chunk', 'pmids': list(pmids), 'records': records})
+        with self._lock:
+            self.completed_pmids.update(pmids)
+            self.records.update(records)
+            for pmid in pmids:  # Retried dead letters
+                self.dead_letters.pop(pmid, None)
+
+    def record_dead_letter(self, pmid: str, error: str):
+        self._append({'type': 'dead_letter', 'pmid': pmid, 'error': error})
+        with self._lock:
+            self.dead_letters[pmid] = error
+
+
+def retry_with_backoff(func, *args, max_tries: int = 4, base_delay: float = 1., max_delay: float = 60., **kwargs):
+    """
+    Calls func(*args, **kwargs), retrying with exponential backoff (with jitter) if it raises an exception.
+    :param func: callable
+    :param max_tries: int, maximum number of calls before the last exception is raised
+    :param base_delay: float, delay (in seconds) before the first retry; doubled for each following retry
+    :param max_delay: float, maximum delay between retries
+    :return: return value of func
+    """
+    for i in range(max_tries):
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            if i >= max_tries - 1:
+                raise
+            delay = min(base_delay * 2 ** i, max_delay)
+            time.sleep(delay * random.uniform(0.5, 1.))
+
+
+# Errors of the connection or the server rather than of the requested PMIDs (urllib3 errors are raised while reading
+# streamed response bodies)
+TRANSIENT_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                    urllib3.exceptions.HTTPError, ConnectionError, TimeoutError)
+
+
+def is_transient_error(error: Exception) -> bool:
+    """
+    Whether an exception raised while fetching a chunk is caused by the connection or the server (connection errors,
+    timeouts, HTTP 429/5xx), so retrying the same PMIDs later may succeed, rather than by the PMIDs themselves (eg.
+    parse errors or HTTP 4xx).
+    """
+    if isinstance(error, requests.HTTPError):
+        return error.response is None or error.response.status_code == 429 or error.response.status_code >= 500
+    return isinstance(error, TRANSIENT_ERRORS)
+
+
+def journaled_harvest(pmids: list, fetch_chunk, journal_path: str, chunk_size: int, max_workers: int = 1,
+                      max_tries: int = 4, base_delay: float = 1., retry_dead_letters: bool = False) -> tuple:
+    """
+    Harvests records for a list of PMIDs chunk by chunk, writing every completed chunk to a HarvestJournal. Failed
+    chunks are retried with exponential backoff. A chunk that keeps failing because of its data (see
+    is_transient_error) is bisected until the PMIDs causing the failure are isolated, and these are recorded as dead
+    letters instead of failing the whole harvest. A chunk that keeps failing because of the connection or the server
+    (eg. during an outage) stops the harvest instead: no further chunks are started and the error is raised, so the
+    harvest can be resumed from the journal later without its PMIDs being dead-lettered. If the journal already
+    exists, PMIDs completed in previous runs are not fetched again.
+    :param pmids: list of PMIDs
+    :param fetch_chunk: callable taking a list of PMIDs and returning a dict mapping the returned (valid) PMIDs onto
+        JSON-serializable records; must raise an exception if the request fails
+    :param journal_path: string, path to journal file
+    :param chunk_size: int, number of PMIDs per chunk
+    :param max_workers: int, number of chunks fetched concurrently
+    :param max_tries: int, number of attempts for each chunk before it is bisected
+    :param base_delay: float, delay (in seconds) before the first retry of a chunk
+    :param retry_dead_letters: boolean, whether to retry PMIDs recorded as dead letters in previous runs
+    :return: tuple (records, invalid_pmids, dead_letters) where records is a dict mapping PMIDs onto records,
+        invalid_pmids is a list of PMIDs not returned by the API and dead_letters is a dict mapping PMIDs that could
+        not be fetched onto error messages.
+    :raises Exception: the last error of a chunk that still fails with a transient error after max_tries attempts
+    """
+    journal = HarvestJournal(journal_path)
+    pmids = list(dict.fromkeys(str(i) for i in pmids))
+
+    skip = journal.completed_pmids if retry_dead_letters else journal.completed_pmids | set(journal.dead_letters)
+    to_fetch = [i for i in pmids if i not in skip]
+    if len(to_fetch) < len(pmids):
+        print(f"Resuming harvest from {journal_path}: {len(pmids) - len(to_fetch)} PMIDs already processed.")
+
+    stopped = threading.Event()
+
+    def process_chunk(chunk):
+        stack = [chunk]
+        while stack and not stopped.is_set():
+            i_pmids = stack.pop()
+            try:
+                i_records = retry_with_backoff(fetch_chunk, i_pmids, max_tries=max_tries, base_delay=base_delay)
+            except Exception as e:
+                if is_transient_error(e):
+                    stopped.set()  # Chunks that haven't started are skipped
+                    raise
+                if len(i_pmids) == 1:
+                    journal.record_dead_letter(i_pmids[0], repr(e))
+                else:  # Bisect to isolate the PMIDs causing the failure
+                    half = len(i_pmids) // 2
+                    stack.extend([i_pmids[half:], i_pmids[:half]])
+                continue
+            journal.record_chunk(i_pmids, i_records)
+
+    try:
+        map_in_order(process_chunk, gen_utils.split_list(to_fetch, chunk_size), max_workers=max_workers)
+    except Exception as e:
+        if is_transient_error(e):
+            warnings.warn(f"Harvest stopped after a request kept failing ({e!r}); {len(journal.completed_pmids)} "
+                          f"PMIDs are recorded in {journal_path}. Rerun with the same journal to resume.")
+        raise
+
+    dead_letters = {i: journal.dead_letters[i] for i in pmids if i in journal.dead_letters}
+    if dead_letters:
+        warnings.warn(f"{len(dead_letters)} PMIDs could not be fetched and were recorded as dead letters in "
+                      f"{journal_path} (they are not counted as invalid; retry them with retry_dead_letters=True): "
+                      f"{', '.join(dead_letters)}")
+
+    records = {i: journal.records[i] for i in pmids if i in journal.records}
+    invalid_pmids = [i for i in pmids if i not in records and i not in dead_letters]
+
+    return records, invalid_pmids, dead_letters
@@ -1,6 +1,10 @@
 from typing import Any
 import warnings
 import pandas as pd
+from pregpk.gpt.utilities import get_encoding, num_tokens_from_batch
+
+
+TEXT_SECTIONS = ["title", "abstract", "intro", "methods", "results", "fig", "table", "discuss", "concl", "abbr"]
 
 
 def add_dict_to_df_using_reference_column(df: pd.DataFrame, data: dict, ref_col: Any, new_col: Any, default: Any=None,
@@ -62,9 +66,13 @@ def filter_dataset_for_testing(text_df: pd.DataFrame) -> pd.DataFrame:
     return text_df
 
 
-def dataset_from_text_df(text_df: pd.DataFrame, sections) -> dict:
+def dataset_from_text_df(text_df: pd.DataFrame, sections, corpus=None, gpt_model=None) -> dict:
     # TODO: this is terrible. assumes everything from pubtator.
-    sections_to_include = ["title", "abstract", "intro", "methods", "results", "fig", "table", "discuss", "concl", "abbr"]
+    # corpus: optional pubtator.corpus.CorpusStore (indexed by PMID, like text_df) to read full text sections from
+    #  instead of the 'pubtator_text' column
+    # gpt_model: optional model name; if given, token counts of each section are stored in the records (see
+    #  add_token_counts)
+    sections_to_include = TEXT_SECTIONS
 
     dataset = {}
     for idx, row in text_df.iterrows():
@@ -76,16 +84,56 @@ def dataset_from_text_df(text_df: pd.DataFrame, sections) -> dict:
         if 'abstract' in sections:
             dataset[idx]['abstract'] = row['title']
         if 'fulltext' in sections:
+            if corpus is not None:
+                fulltext = corpus.sections(idx) if idx in corpus else {}
+            else:
+                fulltext = row['pubtator_text']
             for sec in sections_to_include:
-                if sec in row['pubtator_text']:
-                        dataset[idx][sec] = row['pubtator_text'][sec]
+                if sec in fulltext:
+                        dataset[idx][sec] = fulltext[sec]
 
         # Has PK data
         dataset[idx]['has_pk_data'] = row['has_pk_data']
 
+    if gpt_model is not None:
+        add_token_counts(dataset, gpt_model)
+
+    return dataset
+
+
+def add_token_counts(dataset: dict, gpt_model: str = "gpt-4", num_threads: int = 8) -> dict:
+    """
+    Stores the number of tokens of each text section in the records of a dataset, so estimating costs or fitting
+    prompts into a context window doesn't need to tokenize the same text again. Counts are stored per encoding under
+    record['n_tokens'] (eg. {'cl100k_base': {'title': 21, 'abstract': 312}}); sections already counted with the model's
+    encoding are skipped, and all others are tokenized in a single parallel batch.
+    :param dataset: dict mapping indices onto records (dicts of sections), as returned by dataset_from_text_df
+    :param gpt_model: string, model whose encoding is used to count tokens
+    :param num_threads: int, number of threads used for encoding
+    :return: dataset, updated in place
+    """
+    encoding = get_encoding(gpt_model).name
+    to_count = []
+    for idx, record in dataset.items():
+        counts = record.setdefault('n_tokens', {}).setdefault(encoding, {})
+        to_count.extend((idx, sec) for sec in TEXT_SECTIONS
+                        if isinstance(record.get(sec), str) and sec not in counts)
+
+    n_tokens = num_tokens_from_batch([dataset[idx][sec] for idx, sec in to_count], gpt_model, num_threads=num_threads)
+    for (idx, sec), n in zip(to_count, n_tokens):
+        dataset[idx]['n_tokens'][encoding][sec] = n
+
     return dataset
 
 
+def section_token_counts(record: dict, gpt_model: str = "gpt-4") -> dict:
+    """
+    :return: dict mapping sections of a dataset record onto their number of tokens in the encoding of gpt_model, as
+        stored by add_token_counts (empty if they haven't been counted)
+    """
+    return record.get('n_tokens', {}).get(get_encoding(gpt_model).name, {})
+
+
 def merge_pubmed_api_text_dfs(edf, pdf, conflict_priority='both', conflict_dict=None,
                               article_join='outer'):
 
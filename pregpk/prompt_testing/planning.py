@@ -0,0 +1,152 @@
+import pandas as pd
+from pregpk.gpt.utilities import (gpt_params_with_defaults, cost_per_token, num_tokens_from_string,
+                                  num_tokens_from_batch)
+from pregpk.prompt_testing.data_utils import add_token_counts, section_token_counts
+from pregpk.prompt_testing.preprocessing import SECTION_LABELS, query_from_sections
+
+
+# Sections in the order they are packed into queries (most informative for PK screening first)
+SECTION_PRIORITY = ["title", "abstract", "methods", "results", "table", "fig", "concl", "discuss", "intro", "abbr"]
+
+CONTEXT_WINDOWS = {"gpt-4": 8192,
+                   "gpt-4-0125-preview": 128000,
+                   "gpt-4-1106-preview": 128000,
+                   "gpt-3.5-turbo-0125": 16385,
+                   }
+
+BATCH_DISCOUNT = 0.5  # Price of OpenAI Batch API requests (see gpt.batch) relative to synchronous requests
+MESSAGE_OVERHEAD_TOKENS = 2 * 4 + 3  # Tokens added per request by a system and a user message (num_tokens_from_messages)
+
+
+def pack_sections(n_tokens: dict, token_budget: int, label_tokens: dict, section_priority=None) -> list:
+    """
+    Chooses the sections of an article that fit into a token budget, adding whole sections in priority order and
+    skipping any that no longer fit (so a long section doesn't keep shorter, lower-priority ones out).
+    :param n_tokens: dict mapping sections onto their number of tokens (see data_utils.section_token_counts)
+    :param token_budget: int, maximum number of tokens of the query
+    :param label_tokens: dict mapping sections onto the number of tokens of their labels
+    :param section_priority: list of sections in order of priority; None for SECTION_PRIORITY
+    :return: list of sections, in priority order
+    """
+    if section_priority is None:
+        section_priority = SECTION_PRIORITY
+
+    packed, used = [], 0
+    for sec in section_priority:
+        if sec not in n_tokens:
+            continue
+        sec_tokens = n_tokens[sec] + label_tokens[sec] + 1  # +1 for the space joining sections
+        if used + sec_tokens <= token_budget:
+            packed.append(sec)
+            used += sec_tokens
+    return packed
+
+
+def plan_gpt_study(dataset: dict, prompt: str, gpt_params=None, token_budget: int = None, section_priority=None,
+                   max_in_flight: int = 1, requests_per_minute: float = None, tokens_per_minute: float = None,
+                   latency: float = 2., batch: bool = False, verbose: bool = True) -> dict:
+    """
+    Builds the prompts of a screening study, packing the sections of each article into a token budget, and predicts
+    its cost and wall time before any request is sent. Sections are tokenized only once (counts are stored in the
+    dataset records, see data_utils.add_token_counts), so plans for several configurations are cheap to compare.
+    Token counts of queries are estimates (sums of section and label counts), so budgets should keep a small margin.
+    :param dataset: dict mapping indices (PMIDs) onto records (dicts of sections), as returned by
+        data_utils.dataset_from_text_df
+    :param prompt: string, instructions sent as the system message of every request
+    :param gpt_params: dictionary with any ChatGPT parameters to change from default values (as in run_gpt_study)
+    :param token_budget: int, maximum number of tokens of each article's query; None to fill the model's context
+        window (minus prompt, message overhead and max_tokens)
+    :param section_priority: list of sections in the order they are packed; None for SECTION_PRIORITY
+    :param max_in_flight: int, maximum number of concurrent requests (as in run_gpt_study)
+    :param requests_per_minute: float, requests-per-minute limit of the account/model; None for no limit
+    :param tokens_per_minute: float, tokens-per-minute limit of the account/model; None for no limit
+    :param latency: float, expected seconds per request
+    :param batch: bool, whether the study is run through the OpenAI Batch API (see gpt.batch), which is discounted
+        but completes within 24 h instead of the predicted wall time
+    :param verbose: bool, whether to print a summary of the plan
+    :return: dict with "prompts" (index -> messages; run_gpt_study returns results keyed by the same indices, and
+        gpt.batch.write_batch_requests uses them as custom IDs), "sections" (index -> packed sections), token and
+        cost predictions (costs in USD; output cost assumes every response uses max_tokens, so it's an upper bound)
+        and "wall_time" (seconds; None for batch)
+    """
+    gpt_params = gpt_params_with_defaults(gpt_params)
+    model = gpt_params["version"]
+
+    prompt_tokens = num_tokens_from_string(prompt, model) + MESSAGE_OVERHEAD_TOKENS
+    if token_budget is None:
+        if model not in CONTEXT_WINDOWS:
+            raise ValueError(f'Context window of "{model}" is unknown; token_budget must be given.')
+        token_budget = CONTEXT_WINDOWS[model] - prompt_tokens - gpt_params["max_tokens"]
+
+    add_token_counts(dataset, model)
+    label_tokens = dict(zip(SECTION_LABELS, num_tokens_from_batch(list(SECTION_LABELS.values()), model)))
+
+    prompts, sections = {}, {}
+    input_tokens, n_reduced = 0, 0
+    for idx, record in dataset.items():
+        n_tokens = section_token_counts(record, model)
+        sections[idx] = pack_sections(n_tokens, token_budget, label_tokens, section_priority)
+        query = query_from_sections({sec: record[sec] for sec in sections[idx]})
+        prompts[idx] = [{"role": "system", "content": prompt}, {"role": "user", "content": query}]
+
+        input_tokens += prompt_tokens + sum(n_tokens[sec] + label_tokens[sec] + 1 for sec in sections[idx])
+        n_reduced += len(sections[idx]) < len(n_tokens)
+
+    n_prompts = len(prompts)
+    output_tokens = n_prompts * gpt_params["max_tokens"]
+    discount = BATCH_DISCOUNT if batch else 1.
+    input_cost = input_tokens * cost_per_token(model) * discount
+    output_cost = output_tokens * cost_per_token(model, output=True) * discount
+
+    wall_time = None
+    if not batch:
+        wall_time = n_prompts * latency / max_in_flight
+        if requests_per_minute:
+            wall_time = max(wall_time, 60. * n_prompts / requests_per_minute)
+        if tokens_per_minute:
+            wall_time = max(wall_time, 60. * (input_tokens + output_tokens) / tokens_per_minute)
+
+    plan = {"model": model,
+            "token_budget": token_budget,
+            "n_prompts": n_prompts,
+            "n_reduced": n_reduced,
+            "input_tokens": input_tokens,
+            "max_output_tokens": output_tokens,
+            "input_cost": input_cost,
+            "max_output_cost": output_cost,
+            "max_total_cost": input_cost + output_cost,
+            "wall_time": wall_time,
+            "prompts": prompts,
+            "sections": sections,
+            }
+
+    if verbose:
+        print_study_plan(plan)
+
+    return plan
+
+
+def print_study_plan(plan: dict):
+    wall_time = "up to 24 h (batch)" if plan["wall_time"] is None else f"{plan['wall_time'] / 60.:.1f} min"
+    print(f'Study plan for {plan["model"]} ({plan["token_budget"]} tokens per query):\n'
+          f'\t{plan["n_prompts"]} prompts ({plan["n_reduced"]} with sections left out to fit the budget)\n'
+          f'\t{plan["input_tokens"]} input tokens: ${plan["input_cost"]:.4f}\n'
+          f'\t{plan["max_output_tokens"]} output tokens at most: ${plan["max_output_cost"]:.4f}\n'
+          f'\tTotal cost at most: ${plan["max_total_cost"]:.4f}\n'
+          f'\tPredicted wall time: {wall_time}\n')
+
+
+def compare_study_plans(dataset: dict, prompt: str, configurations: list, **kwargs) -> pd.DataFrame:
+    """
+    Plans a study under several configurations, to choose the cheapest one that fits.
+    :param configurations: list of dicts of plan_gpt_study arguments (eg. [{"gpt_params": {"version": "gpt-4"},
+        "token_budget": 4000}, {"gpt_params": {"version": "gpt-3.5-turbo-0125"}, "batch": True}])
+    :param kwargs: plan_gpt_study arguments shared by all configurations
+    :return: pandas.DataFrame with one row of predictions per configuration, sorted by max_total_cost
+    """
+    rows = []
+    for config in configurations:
+        plan = plan_gpt_study(dataset, prompt, **{**kwargs, "verbose": False, **config})
+        rows.append({key: val for key, val in plan.items() if key not in ("prompts", "sections")} |
+                    {"batch": config.get("batch", kwargs.get("batch", False))})
+    return pd.DataFrame(rows).sort_values("max_total_cost").reset_index(drop=True)
@@ -1,19 +1,26 @@
 import random
 
 
+SECTION_LABELS = {"title": "<TITLE>: ",
+                  "abstract": "<ABSTRACT>: ",
+                  "intro": "<INTRODUCTION>: ",
+                  "methods": "<METHODS>: ",
+                  "results": "<RESULTS>: ",
+                  "fig": "<FIGURE CAPTIONS>: ",
+                  "table": "<TABLE CAPTIONS>: ",
+                  "discuss": "<DISCUSSION>: ",
+                  "concl": "<CONCLUSION>: ",
+                  "abbr": "<ABBREVIATIONS>: ",
+                  }
+
+
+def query_from_sections(sections: dict) -> str:
+    # Joins (labelled) sections into a single query, in the order given
+    return ' '.join([f"{SECTION_LABELS[sec]}{text}" for sec, text in sections.items()])
+
+
 def make_article_queries(dataset):
     # TODO: maybe clean this up as well
-    section_key = {"title": "<TITLE>: ",
-                   "abstract": "<ABSTRACT>: ",
-                   "intro": "<INTRODUCTION>: ",
-                   "methods": "<METHODS>: ",
-                   "results": "<RESULTS>: ",
-                   "fig": "<FIGURE CAPTIONS>: ",
-                   "table": "<TABLE CAPTIONS>: ",
-                   "discuss": "<DISCUSSION>: ",
-                   "concl": "<CONCLUSION>: ",
-                   "abbr": "<ABBREVIATIONS>: ",
-                   }
 
     # dataset["query"] = dataset.apply(lambda x: f"<TITLE>: {x['title']} <ABSTRACT>: {x['abstract']}", axis=1)
     # dataset["query"] = dataset.apply(
@@ -22,8 +29,8 @@ def make_article_queries(dataset):
 
     for idx, row in dataset.iterrows():
         row = row.dropna()
-        sections = [i for i in row.index.to_list() if i != "has_pk_data"]
-        dataset.loc[idx, "query"] = ' '.join([f"{section_key[sec]}{row[sec]}" for sec in sections])
+        sections = [i for i in row.index.to_list() if i in SECTION_LABELS]  # Skips labels and token counts
+        dataset.loc[idx, "query"] = query_from_sections({sec: row[sec] for sec in sections})
 
     return dataset
 
@@ -0,0 +1,139 @@
+import os
+import json
+import threading
+
+
+class AnnotationIndex:
+    """
+    Inverted index of the entity annotations (chemicals, diseases, genes, ...) PubTator 3 returns for each passage:
+    entity identifier (eg. 'MESH:D014859') -> PMIDs -> sections the entity is mentioned in. Normalized entity names
+    are indexed onto identifiers as well, so articles can be pre-screened for a drug or condition with set operations
+    (eg. before spending GPT calls on them) without re-reading any text.
+    """
+
+    def __init__(self):
+        self.entities = {}  # identifier -> {pmid: set of sections}
+        self.names = {}  # lower-case normalized name or mention -> set of identifiers
+        self.entity_types = {}  # identifier -> type (eg. 'Chemical', 'Disease')
+        self._lock = threading.Lock()
+
+    def __contains__(self, identifier: str) -> bool:
+        return identifier in self.entities
+
+    def __len__(self) -> int:
+        return len(self.entities)
+
+    def add_article(self, art: dict):
+        """
+        Indexes the annotations of a PubTator 3 BioC JSON article (full or compact, see parsing.compact_article).
+        """
+        pmid = str(art['pmid'])
+        with self._lock:
+            for passage in art['passages']:
+                infons = passage.get('infons', {})
+                section = (infons.get('section_type') or infons.get('type') or '').lower()
+                for ann in passage.get('annotations', []):
+                    ann_infons = ann.get('infons', {})
+                    identifiers = ann_infons.get('identifier')
+                    if not identifiers or identifiers == '-':  # Mentions that could not be normalized
+                        continue
+                    for identifier in str(identifiers).split(';'):  # Some mentions map onto several entities
+                        self.entities.setdefault(identifier, {}).setdefault(pmid, set()).add(section)
+                        if ann_infons.get('type'):
+                            self.entity_types[identifier] = ann_infons['type']
+                        for name in (ann_infons.get('name'), ann.get('text')):
+                            if name:
+                                self.names.setdefault(name.lower(), set()).add(identifier)
+
+    def add_articles(self, articles: list):
+        for art in articles:
+            self.add_article(art)
+
+    def identifiers_for(self, entity: str, entity_type: str = None) -> set:
+        """
+        Resolves an entity identifier or name (case-insensitive) onto the identifiers in the index.
+        :param entity: string, identifier (eg. 'MESH:D014859') or normalized name/mention (eg. 'warfarin')
+        :param entity_type: string, only return identifiers of this type (eg. 'Chemical'); None for any type
+        :return: set of identifiers
+        """
+        identifiers = {entity} if entity in self.entities else set(self.names.get(entity.lower(), ()))
+        if entity_type is not None:
+            identifiers = {i for i in identifiers if self.entity_types.get(i) == entity_type}
+        return identifiers
+
+    def pmids_for(self, entity: str, entity_type: str = None, sections: list = None) -> set:
+        """
+        :param entity: string, identifier or name of entity (see identifiers_for)
+        :param entity_type: string, only consider entities of this type; None for any type
+        :param sections: list of sections (eg. ['title', 'abstract']) the entity must be mentioned in; None for any
+        :return: set of PMIDs of articles mentioning the entity
+        """
+        pmids = set()
+        for identifier in self.identifiers_for(entity, entity_type):
+            for pmid, pmid_sections in self.entities[identifier].items():
+                if sections is None or not pmid_sections.isdisjoint(sections):
+                    pmids.add(pmid)
+        return pmids
+
+    def sections_for(self, entity: str, pmid: str) -> set:
+        """
+        :return: set of sections of article pmid mentioning entity (identifier or name)
+        """
+        sections = set()
+        for identifier in self.identifiers_for(entity):
+            sections |= self.entities[identifier].get(str(pmid), set())
+        return sections
+
+    def pmids_with_all(self, entities: list, **kwargs) -> set:
+        """
+        :return: set of PMIDs of articles mentioning every entity (eg. a drug and a condition); kwargs as in pmids_for
+        """
+        pmids = None
+        for entity in entities:
+            pmids = self.pmids_for(entity, **kwargs) if pmids is None else pmids & self.pmids_for(entity, **kwargs)
+            if not pmids:
+                break
+        return pmids or set()
+
+    def pmids_with_any(self, entities: list, **kwargs) -> set:
+        """
+        :return: set of PMIDs of articles mentioning at least one of entities; kwargs as in pmids_for
+        """
+        return set().union(*(self.pmids_for(i, **kwargs) for i in entities))
+
+    def pmids_for_unii(self, unii: str, drug_to_unii: dict, **kwargs) -> set:
+        """
+        Finds articles mentioning a drug by its GSRS UNII, through the drug names mapped onto it.
+        :param unii: string, GSRS UNII
+        :param drug_to_unii: dict mapping drug names (synonyms joined with "/") onto UNIIs, as saved by
+            data_transformation.stdize_utils.get_drug_dropdown_json_from_gsrs
+        :return: set of PMIDs; kwargs as in pmids_for
+        """
+        names = [name for drugs, i_unii in drug_to_unii.items() if i_unii == unii for name in drugs.split('/')]
+        return self.pmids_with_any(names, **kwargs)
+
+    def save(self, path: str):
+        """
+        Saves the index as JSON.
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._lock:
+            data = {'entities': {i: {pmid: sorted(secs) for pmid, secs in pmids.items()}
+                                 for i, pmids in self.entities.items()},
+                    'names': {name: sorted(ids) for name, ids in self.names.items()},
+                    'entity_types': self.entity_types}
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as index_file:
+            json.dump(data, index_file, separators=(',', ':'))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str):
+        index = cls()
+        with open(path, 'r') as index_file:
+            data = json.load(index_file)
+        index.entities = {i: {pmid: set(secs) for pmid, secs in pmids.items()} for i, pmids in data['entities'].items()}
+        index.names = {name: set(ids) for name, ids in data['names'].items()}
+        index.entity_types = data['entity_types']
+        return index
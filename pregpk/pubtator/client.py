@@ -0,0 +1,176 @@
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+from pregpk.rate_limiting import TokenBucket
+from pregpk.pubtator.parsing import iter_pubtator_articles
+
+
+PUBTATOR_BASE_URL = "https://www.ncbi.nlm.nih.gov/research/pubtator3-api/"
+
+# Module-level settings (as in entrez.client); used by get_client() when creating new clients
+base_url = PUBTATOR_BASE_URL
+max_workers = 3
+rate = 3.  # PubTator asks for no more than 3 requests per second
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class PubTatorClient:
+    """
+    Client for the PubTator 3 biocjson export that keeps up to "max_workers" requests in flight over a pooled
+    (keep-alive, gzip) requests.Session. Requests are paced by a token bucket whose rate is halved whenever PubTator
+    answers with HTTP 429 (waiting for Retry-After if given) and slowly restored after successful requests, so
+    throughput stays as high as PubTator allows without violating its limits.
+    """
+
+    def __init__(self, base_url: str = PUBTATOR_BASE_URL, max_workers: int = 3, rate: float = 3.,
+                 min_rate: float = 0.5, max_tries: int = 4, timeout: float = 120.):
+        """
+        :param base_url: string, base URL of the PubTator 3 API
+        :param max_workers: int, maximum number of requests in flight
+        :param rate: float, maximum requests per second
+        :param min_rate: float, requests per second the rate is never reduced below after HTTP 429s
+        :param max_tries: int, number of attempts for requests failing with HTTP 429/5xx or connection errors
+        :param timeout: float, seconds to wait for a response
+        """
+        self.base_url = base_url if base_url.endswith('/') else base_url + '/'
+        self.max_workers = max_workers
+        self.max_rate = rate
+        self.min_rate = min_rate
+        self.max_tries = max_tries
+        self.timeout = timeout
+        self.limiter = TokenBucket(rate, capacity=1)  # No bursts
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=max_workers + 1))
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=max_workers + 1))
+        self.session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+        self.n_requests = 0
+        self.n_rate_limited = 0
+        self._lock = threading.Lock()
+
+    def export_url(self, pmids: list) -> str:
+        return f"{self.base_url}publications/export/biocjson?pmids={','.join(map(str, pmids))}&full=true"
+
+    def open_articles(self, pmids: list) -> requests.Response:
+        """
+        Sends the biocjson export request for a list of (up to 100) PMIDs and returns as soon as the response headers
+        arrive, without reading the body (see iter_response_articles).
+        :param pmids: list of PMIDs
+        :return: streamed requests.Response; close it (or exhaust iter_response_articles) to release the connection
+        :raises requests.HTTPError: if the request is still unsuccessful after max_tries attempts
+        """
+        resp = self._get(self.export_url(pmids))
+        resp.raw.decode_content = True  # Transparently decompress gzip responses
+        return resp
+
+    @staticmethod
+    def iter_response_articles(resp: requests.Response):
+        """
+        Parses a response of open_articles as it is streamed, yielding one compact article at a time (see
+        parsing.compact_article), so no more than one article of the response is held in memory. The response is
+        closed once it is exhausted (or the generator is closed).
+        """
+        with resp:
+            yield from iter_pubtator_articles(resp.raw)
+
+    def iter_articles(self, pmids: list):
+        """
+        :return: generator of the compact articles PubTator returns for a list of (up to 100) PMIDs, parsed one at a
+            time as the response streams in
+        """
+        return self.iter_response_articles(self.open_articles(pmids))
+
+    def request_articles(self, pmids: list) -> dict:
+        """
+        Requests the BioC JSON articles for a list of (up to 100) PMIDs, for callers that need all of them at once
+        (eg. to journal a chunk); see iter_articles to process articles as they are parsed instead.
+        :param pmids: list of PMIDs
+        :return: dict mapping the PMIDs returned by PubTator onto their compact articles
+        :raises requests.HTTPError: if the request is still unsuccessful after max_tries attempts
+        """
+        return {art['pmid']: art for art in self.iter_articles(pmids)}
+
+    def _get(self, url: str) -> requests.Response:
+        # Returns a streamed response; the caller should close it to return the connection to the pool
+        for i in range(self.max_tries):
+            self.limiter.acquire()
+            with self._lock:
+                self.n_requests += 1
+            try:
+                resp = self.session.get(url, timeout=self.timeout, stream=True)
+            except requests.ConnectionError:
+                if i >= self.max_tries - 1:
+                    raise
+                time.sleep(2 ** i)
+                continue
+
+            if resp.status_code < 500 and resp.status_code != 429:
+                if resp.status_code >= 400:
+                    resp.close()
+                resp.raise_for_status()
+                self._recover()
+                return resp
+
+            resp.close()
+            if i >= self.max_tries - 1:
+                resp.raise_for_status()
+            if resp.status_code == 429:
+                self._back_off(resp.headers.get('Retry-After'))
+            else:
+                time.sleep(2 ** i)
+
+    def _back_off(self, retry_after: str = None):
+        with self._lock:
+            self.n_rate_limited += 1
+            self.limiter.set_rate(max(self.limiter.rate / 2, self.min_rate))
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):  # Missing or HTTP-date Retry-After
+            delay = 1 / self.limiter.rate
+        self.limiter.pause(delay)
+
+    def _recover(self):
+        if self.limiter.rate < self.max_rate:
+            with self._lock:
+                self.limiter.set_rate(min(self.limiter.rate * 1.1, self.max_rate))
+
+    def imap(self, func, items: list, progress_bar: bool = True):
+        """
+        Applies func (which should make its requests through this client) to every element of items with up to
+        max_workers calls in flight, yielding the results in input order as they become available.
+        """
+        items = list(items)
+        pbar = tqdm(total=len(items)) if progress_bar else None
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = deque()
+            for item in items:
+                pending.append(executor.submit(func, item))
+                if len(pending) >= self.max_workers:
+                    yield pending.popleft().result()
+                    if pbar is not None:
+                        pbar.update()
+            while pending:
+                yield pending.popleft().result()
+                if pbar is not None:
+                    pbar.update()
+
+        if pbar is not None:
+            pbar.close()
+
+
+def get_client() -> PubTatorClient:
+    """
+    Returns the process-wide PubTatorClient (created on first use with the module-level base_url, max_workers and
+    rate settings), so that every function making PubTator requests shares one connection pool and rate limit.
+    """
+    key = (base_url, max_workers, rate)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = PubTatorClient(base_url=base_url, max_workers=max_workers, rate=rate)
+        return _clients[key]
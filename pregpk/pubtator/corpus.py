@@ -0,0 +1,210 @@
+import os
+import json
+import zlib
+import mmap
+import threading
+import weakref
+from collections.abc import Mapping
+
+
+# Absolute path -> CorpusStore, so unpickled CorpusArticles share one open store per corpus
+_open_stores = weakref.WeakValueDictionary()
+_open_stores_lock = threading.Lock()
+
+
+class CorpusStore:
+    """
+    On-disk store of article section texts. Sections are appended (optionally zlib-compressed) to a single blob file
+    and located through an index mapping (pmid, section) onto (offset, length) in the blob, so opening a corpus only
+    loads the index and each section is read (as a slice of the memory-mapped blob) only when it is accessed.
+
+    Files: "<path>.blob" with section texts and "<path>.index.json" with the index (written on flush() and close()).
+    """
+
+    def __init__(self, path: str, compression_level: int = 6):
+        """
+        :param path: string, path prefix of the corpus files (created if they don't exist)
+        :param compression_level: int, zlib compression level of appended sections; 0 to store them uncompressed
+        """
+        self.path = path
+        self.blob_path = f"{path}.blob"
+        self.index_path = f"{path}.index.json"
+        self.compression_level = compression_level
+        self.index = {}  # pmid -> {section: [offset, length, is_compressed]}
+        self._lock = threading.Lock()
+        self._mmap = None
+        self._dirty = False
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as index_file:
+                self.index = json.load(index_file)
+        self._blob = open(self.blob_path, 'a+b')
+        with _open_stores_lock:
+            open_store = _open_stores.get(os.path.abspath(path))
+            if open_store is None or open_store.closed:
+                _open_stores[os.path.abspath(path)] = self
+
+    @classmethod
+    def open(cls, path: str) -> 'CorpusStore':
+        """
+        :return: CorpusStore at path, reusing the store already open in this process if there is one
+        """
+        with _open_stores_lock:
+            store = _open_stores.get(os.path.abspath(path))
+        return store if store is not None and not store.closed else cls(path)
+
+    @property
+    def closed(self) -> bool:
+        return self._blob.closed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, pmid) -> bool:
+        return str(pmid) in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    @property
+    def pmids(self) -> list:
+        return list(self.index.keys())
+
+    def add(self, pmid: str, sections: dict):
+        """
+        Appends the sections of an article (replacing any sections previously stored for it). Since replaced sections
+        are not removed from the blob, articles already stored with the same sections are skipped, so re-harvesting
+        the same PMIDs doesn't grow the corpus.
+        :param pmid: string, PMID of article
+        :param sections: dict mapping section names onto text (eg. as returned by pubtator.utilities.text_from_pmids)
+        """
+        pmid = str(pmid)
+        sections = dict(sections)
+        entries = {}
+        with self._lock:
+            if pmid in self.index and list(sections.items()) == [
+                    (section, self._read(*entry)) for section, entry in self.index[pmid].items()]:
+                return
+            self._blob.seek(0, os.SEEK_END)
+            for section, text in sections.items():
+                data = text.encode('utf-8')
+                is_compressed = bool(self.compression_level)
+                if is_compressed:
+                    data = zlib.compress(data, self.compression_level)
+                entries[section] = [self._blob.tell(), len(data), is_compressed]
+                self._blob.write(data)
+            self.index[pmid] = entries
+            self._dirty = True
+
+    def add_many(self, texts: dict):
+        """
+        :param texts: dict mapping PMIDs onto dicts of sections (see add)
+        """
+        for pmid, sections in texts.items():
+            self.add(pmid, sections)
+        self.flush()
+
+    def section(self, pmid: str, section: str) -> str:
+        """
+        :return: string, text of a section of an article
+        :raises KeyError: if the article or section is not in the corpus
+        """
+        offset, length, is_compressed = self.index[str(pmid)][section]
+        with self._lock:
+            return self._read(offset, length, is_compressed)
+
+    def _read(self, offset: int, length: int, is_compressed: bool) -> str:
+        # Must be called with the lock held
+        if not length:
+            return ''
+        data = self._view(offset + length)[offset:offset + length]
+        return (zlib.decompress(data) if is_compressed else data).decode('utf-8')
+
+    def sections(self, pmid: str) -> 'CorpusArticle':
+        """
+        :return: CorpusArticle, read-only mapping of section names onto texts, read from the blob on access
+        :raises KeyError: if the article is not in the corpus
+        """
+        if str(pmid) not in self.index:
+            raise KeyError(pmid)
+        return CorpusArticle(self, str(pmid))
+
+    def _view(self, end: int) -> mmap.mmap:
+        # Memory map of the blob; re-mapped if sections were appended beyond the current mapping
+        if self._mmap is None or len(self._mmap) < end:
+            self._blob.flush()
+            if self._mmap is not None:
+                self._mmap.close()
+            self._mmap = mmap.mmap(self._blob.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def flush(self):
+        """
+        Writes the index (atomically) and flushes the blob, so the corpus can be reopened.
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            self._blob.flush()
+            os.fsync(self._blob.fileno())
+            tmp_path = f"{self.index_path}.tmp"
+            with open(tmp_path, 'w') as index_file:
+                json.dump(self.index, index_file, separators=(',', ':'))
+            os.replace(tmp_path, self.index_path)
+            self._dirty = False
+
+    def size_on_disk(self) -> int:
+        self._blob.flush()
+        index_size = os.path.getsize(self.index_path) if os.path.exists(self.index_path) else 0
+        return os.path.getsize(self.blob_path) + index_size
+
+    def close(self):
+        self.flush()
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._blob.close()
+
+
+class CorpusArticle(Mapping):
+    """
+    Lazy, read-only view of the sections of one article in a CorpusStore; behaves like the dict of sections returned
+    by pubtator.utilities.text_from_pmids, but texts are only read when accessed.
+
+    Views are pickled as references (corpus path and PMID), not texts, so DataFrames holding them can be pickled; on
+    unpickling, the corpus is reopened from its path (see CorpusStore.open), which must therefore still exist and
+    have been flushed.
+    """
+
+    def __init__(self, corpus: CorpusStore, pmid: str):
+        self.corpus = corpus
+        self.pmid = pmid
+
+    def __getitem__(self, section: str) -> str:
+        if section not in self.corpus.index[self.pmid]:
+            raise KeyError(section)
+        return self.corpus.section(self.pmid, section)
+
+    def __iter__(self):
+        return iter(self.corpus.index[self.pmid])
+
+    def __len__(self) -> int:
+        return len(self.corpus.index[self.pmid])
+
+    def __contains__(self, section) -> bool:
+        return section in self.corpus.index[self.pmid]
+
+    def __repr__(self) -> str:
+        return f"CorpusArticle(pmid={self.pmid!r}, sections={list(self)})"
+
+    def __reduce__(self):
+        return _corpus_article, (os.path.abspath(self.corpus.path), self.pmid)
+
+
+def _corpus_article(path: str, pmid: str) -> CorpusArticle:
+    return CorpusArticle(CorpusStore.open(path), pmid)
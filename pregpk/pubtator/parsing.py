@@ -0,0 +1,84 @@
+import ijson
+
+
+# Passage and annotation "infons" used by pubtator.utilities (and pubtator.annotations); everything else is dropped
+PASSAGE_INFONS = ('type', 'section_type', 'article-id_doi', 'journal')
+ANNOTATION_INFONS = ('identifier', 'type', 'name')
+
+# Version of the article format built by compact_article; increment when it changes, so articles cached by older
+# versions are re-fetched (see record_cache.RecordCache)
+ARTICLE_VERSION = 1
+
+
+def iter_pubtator_articles(source):
+    """
+    Incrementally parses a PubTator 3 biocjson export response ({"PubTator3": [article, ...]}), yielding one compact
+    article at a time (see compact_article). Only one full article is held in memory at once, so peak memory is
+    bounded by the largest article rather than by the size of the response.
+    :param source: file-like object (eg. streamed response body) with biocjson export; may be empty (PubTator returns
+        an empty body if none of the requested PMIDs are valid)
+    :return: generator of compact article dicts (with 'pmid' converted to string)
+    """
+    source = _NonEmptyStream(source)
+    if source.is_empty():
+        return
+
+    for art in ijson.items(source, 'PubTator3.item', use_float=True):
+        yield compact_article(art)
+
+
+def compact_article(art: dict) -> dict:
+    """
+    Strips a PubTator 3 BioC JSON article down to the fields used by this package: PMID, date, journal, authors and,
+    for each passage, its text, type/section infons and annotation identifiers, types and normalized names. The
+    result keeps the structure of the original article, so it can be used wherever a full article is expected.
+    :param art: article dict returned by PubTator
+    :return: compact article dict (with 'pmid' converted to string)
+    """
+    passages = []
+    for passage in art['passages']:
+        infons = passage.get('infons', {})
+        annotations = []
+        for ann in passage.get('annotations', []):
+            ann_infons = ann.get('infons', {})
+            annotations.append({'text': ann.get('text', ''),
+                                'infons': {key: ann_infons[key] for key in ANNOTATION_INFONS if key in ann_infons}})
+        passages.append({'infons': {key: infons[key] for key in PASSAGE_INFONS if key in infons},
+                         'text': passage.get('text', ''),
+                         'annotations': annotations})
+
+    return {
+        'pmid': str(art['pmid']),
+        'date': art.get('date', ''),
+        'journal': art.get('journal', ''),
+        'authors': art.get('authors', []),
+        'passages': passages,
+    }
+
+
+class _NonEmptyStream:
+    # Wraps a file-like object so that emptiness can be checked without losing the first bytes
+    def __init__(self, source):
+        self._source = source
+        self._head = source.read(1)
+
+    def is_empty(self) -> bool:
+        return not self._head.strip() and not self._peek_more()
+
+    def _peek_more(self) -> bool:
+        # Leading whitespace; keep reading until a non-whitespace byte (or the end) is found
+        while self._head and not self._head.strip():
+            more = self._source.read(1024)
+            if not more:
+                return False
+            self._head += more
+        return bool(self._head.strip())
+
+    def read(self, size: int = -1) -> bytes:
+        if not self._head:
+            return self._source.read(size)
+        if size is None or size < 0:
+            head, self._head = self._head, b''
+            return head + self._source.read()
+        head, self._head = self._head[:size], self._head[size:]
+        return head
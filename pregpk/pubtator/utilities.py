@@ -1,10 +1,15 @@
 import warnings
 import requests
+import ijson
 import time
-import json
-from tqdm import tqdm
 import pandas as pd
 from pregpk import gen_utils
+from pregpk.record_cache import RecordCache
+from pregpk.harvest_journal import journaled_harvest
+from pregpk.pubtator.client import get_client
+from pregpk.pubtator.parsing import ARTICLE_VERSION
+from pregpk.pubtator.corpus import CorpusStore
+from pregpk.pubtator.annotations import AnnotationIndex
 
 
 def is_fill_invalid_option_allowed(fill_invalid_val):  # Must either be "remove" or falsey value
@@ -18,14 +23,202 @@ def api_call_from_pmids(pmids: list) -> str:
     :return: string used to query full-text information from PubTator API
     """
     pmids_str = gen_utils.comma_sep_str_from_list(pmids)
-    return f"https://www.ncbi.nlm.nih.gov/research/pubtator3-api/publications/export/biocjson?pmids={pmids_str}&full=true"
+    return f"{get_client().base_url}publications/export/biocjson?pmids={pmids_str}&full=true"
 
 
-def text_from_pmids(pmids: list, fill_invalid_pmids='remove') -> dict:
+def iter_articles(pmids: list, cache: RecordCache = None, progress_bar: bool = True, journal_path: str = None,
+                  retry_dead_letters: bool = False, failed_pmids: dict = None):
+    """
+    Yields the BioC JSON articles returned by PubTator 3 for a list of PMIDs one at a time, as each response is parsed
+    (with several requests in flight through the shared PubTatorClient; see pubtator.client), so memory use doesn't
+    grow with the number of PMIDs per request. If a RecordCache is given, cached articles are yielded first and only
+    the remaining PMIDs are requested; returned articles are stored in the cache as they are parsed and PMIDs not
+    returned by a completed request are stored as invalid. PMIDs of requests that still fail after the client's
+    retries (or whose response breaks off) are skipped and added to failed_pmids, never stored as invalid.
+    :param pmids: list of PMIDs
+    :param cache: RecordCache consulted before making requests; None to always fetch from PubTator
+    :param progress_bar: boolean, whether to show a tqdm progress bar over requests
+    :param journal_path: string, path to a harvest journal (see harvest_journal.journaled_harvest); if given, failed
+        requests are retried with backoff, a chunk failing because of its data is bisected to isolate bad PMIDs,
+        every completed chunk is recorded and an interrupted harvest (including one stopped by connection or server
+        errors, which are raised) resumes from the journal. Since the journal keeps every record, articles are then
+        yielded once all chunks are done.
+    :param retry_dead_letters: boolean, whether to retry PMIDs that could not be fetched in previous runs with the same
+        journal
+    :param failed_pmids: dict updated with PMIDs that could not be fetched because of request errors (mapped onto
+        error messages); these are neither returned nor stored as invalid in the cache
+    :return: generator of article dicts (with 'pmid' converted to string)
+    """
+    pmids = [str(i) for i in pmids]
+    max_pmids_per_call = 99
+    client = get_client()
+    if failed_pmids is None:
+        failed_pmids = {}
+
+    to_fetch = pmids
+    if cache is not None:
+        cached, _, to_fetch = cache.lookup('pubtator', 'pubmed', 'biocjson', pmids, version=ARTICLE_VERSION)
+        if not cache.fetch_allowed:
+            to_fetch = []
+        yield from cached.values()
+
+    if journal_path is not None:
+        def fetch_chunk(i_pmids):
+            articles = client.request_articles(i_pmids)  # Journaled as a whole
+            if cache is not None:
+                cache.store('pubtator', 'pubmed', 'biocjson', articles, version=ARTICLE_VERSION)
+                cache.store_invalid('pubtator', 'pubmed', 'biocjson', [i for i in i_pmids if i not in articles])
+            return articles
+
+        if to_fetch:
+            articles, _, dead_letters = journaled_harvest(to_fetch, fetch_chunk, journal_path,
+                                                          chunk_size=max_pmids_per_call,
+                                                          max_workers=client.max_workers,
+                                                          retry_dead_letters=retry_dead_letters)
+            failed_pmids.update(dead_letters)
+            yield from articles.values()
+    else:
+        def skip_chunk(i_pmids, error):
+            # Unsuccessful (or truncated) request; PMIDs can't be confirmed as valid or invalid
+            warnings.warn(f"PubTator request failed ({error!r}); {len(i_pmids)} PMIDs could not be fetched (they are "
+                          f"not counted as invalid).")
+            failed_pmids.update({i: repr(error) for i in i_pmids})
+
+        def open_chunk(i_pmids):
+            # Waiting for responses happens in the client's threads; bodies are parsed as they are consumed below
+            try:
+                return i_pmids, client.open_articles(i_pmids)
+            except requests.RequestException as e:
+                skip_chunk(i_pmids, e)
+                return i_pmids, None
+
+        split_pmids = gen_utils.split_list(to_fetch, max_pmids_per_call)
+        for i_pmids, resp in client.imap(open_chunk, split_pmids, progress_bar=progress_bar):
+            if resp is None:
+                continue
+            returned = set()
+            try:
+                for art in client.iter_response_articles(resp):
+                    if cache is not None:
+                        cache.store('pubtator', 'pubmed', 'biocjson', {art['pmid']: art}, version=ARTICLE_VERSION)
+                    returned.add(art['pmid'])
+                    yield art
+            except (requests.RequestException, ijson.JSONError) as e:
+                skip_chunk([i for i in i_pmids if i not in returned], e)
+                continue
+            finally:
+                resp.close()
+            if cache is not None:  # Only once the whole response has been read
+                cache.store_invalid('pubtator', 'pubmed', 'biocjson', [i for i in i_pmids if i not in returned])
+
+    if cache is not None:
+        print(cache.report())
+
+
+def harvest_from_pmids(pmids: list, cache: RecordCache = None, journal_path: str = None,
+                       corpus: CorpusStore = None, annotation_index: AnnotationIndex = None,
+                       retry_dead_letters: bool = False) -> tuple:
+    """
+    Fetches every PMID from PubTator 3 once and parses each returned article into a compact record. Validity,
+    metadata and text are all derived from these records, so a full run only downloads each (full-text) article once.
+    :param pmids: list of PMIDs
+    :param cache: RecordCache consulted before making requests; None to always fetch from PubTator
+    :param journal_path: string, path to a harvest journal to resume from and record progress in (see
+        iter_articles); None to harvest without a journal
+    :param corpus: CorpusStore the section texts of every article are written to as soon as it is parsed; records
+        then hold lazy CorpusArticle views instead of the texts themselves (pickled as references to the corpus
+        files, which must be kept for the views to be unpickled). None to keep texts in memory
+    :param annotation_index: AnnotationIndex every article's entity annotations are added to; None to discard them
+    :param retry_dead_letters: boolean, whether to retry PMIDs that could not be fetched (dead letters) in previous
+        runs with the same journal
+    :return: tuple (records, invalid_pmids, failed_pmids), where records is a dict mapping PMIDs onto record dicts
+        (see record_from_article) in input order, invalid_pmids is a list of inputted PMIDs not returned by PubTator
+        and failed_pmids is a dict mapping PMIDs that could not be fetched because of request errors onto error
+        messages. Failed PMIDs are not invalid: they are neither cached as invalid nor removed by the functions below,
+        and can be retried (with retry_dead_letters if a journal is used).
+    """
+
+    print('\nLoading articles from PubTator API...')
+    time.sleep(0.1)  # For some reason print statement showing up after first tqdm loading bar
+
+    pmids = list(dict.fromkeys(str(i) for i in pmids))  # Remove duplicates, preserve order
+
+    records = {}
+    failed_pmids = {}
+    for art in iter_articles(pmids, cache=cache, journal_path=journal_path, retry_dead_letters=retry_dead_letters,
+                             failed_pmids=failed_pmids):
+        # Each article is indexed, written to the corpus and reduced to a record as soon as it is parsed
+        if annotation_index is not None:
+            annotation_index.add_article(art)
+        record = record_from_article(art)
+        if corpus is not None:
+            corpus.add(record['pmid'], record['sections'])
+            record['sections'] = corpus.sections(record['pmid'])
+        records[art['pmid']] = record
+
+    if corpus is not None:
+        corpus.flush()
+
+    records = {i: records[i] for i in pmids if i in records}
+    invalid_pmids = [i for i in pmids if i not in records and i not in failed_pmids]
+
+    return records, invalid_pmids, failed_pmids
+
+
+def record_from_article(art: dict) -> dict:
+    """
+    Builds a compact record from a PubTator 3 BioC JSON article, containing only the fields used by the metadata and
+    text functions.
+    :param art: article dict returned by PubTator
+    :return: dict with keys 'pmid', 'title', 'authors', 'pub_date', 'pub_year', 'source', 'doi', 'has_abstract' and
+        'sections' (dict mapping section names onto text, as returned by text_from_pmids)
+    """
+    sections = {}  # Section name -> list of passage texts
+    has_abstract = False
+    for passage in art['passages']:
+        if passage['infons'].get('type') == 'abstract':
+            has_abstract = True
+        if passage['text']:  # Only if passage actually has text, not an empty string
+            try:
+                section = passage['infons']['section_type'].lower()
+            except KeyError:  # Probably because only title and abstract
+                section = passage['infons']['type']
+            except:
+                warnings.warn(f"PubTator return for PMID {art['pmid']} does not have 'section_type' or "
+                              f"'type' fields as expected.")
+                continue
+            sections.setdefault(section, []).append(passage['text'])
+
+    return {
+        'pmid': art['pmid'],
+        'title': art['passages'][0]['text'],
+        'authors': art['authors'],
+        'pub_date': art['date'][:art['date'].index('T')],  # Only date, not time (string in format YYYY-MM-DDTHH:MM:SSZ
+        'pub_year': int(art['date'][:4]),
+        'source': art['journal'],
+        'doi': get_doi_from_article_dict(art),
+        'has_abstract': has_abstract,
+        'sections': {sec: ' '.join(texts) for sec, texts in sections.items()},
+    }
+
+
+def metadata_from_record(record: dict) -> dict:
+    return {key: record[key] for key in ('title', 'authors', 'pub_date', 'pub_year', 'source', 'doi', 'has_abstract')}
+
+
+def text_from_pmids(pmids: list, fill_invalid_pmids='remove', cache: RecordCache = None,
+                    journal_path: str = None, corpus: CorpusStore = None, retry_dead_letters: bool = False) -> dict:
     """
     Fetches all text available from PubTator 3 API for a list of PMIDs. Returned text is split into sections (title,
     abstract, methods, etc.).
     :param pmids: list of PMID strings to obtain texts from PubTator 3
+    :param cache: RecordCache consulted before making requests; None to always fetch from PubTator
+    :param journal_path: string, path to a harvest journal to resume from and record progress in (see
+        iter_articles); None to harvest without a journal
+    :param corpus: CorpusStore texts are written to (see harvest_from_pmids); sections are then returned as lazy
+        CorpusArticle mappings instead of dicts, which pickle as references to the corpus files (not texts)
+    :param retry_dead_letters: boolean, whether to retry PMIDs that could not be fetched in previous runs with the same
+        journal (see harvest_from_pmids)
     :return: nested dict where PMIDs (keys) map onto a dictionary containing sections of text returned from PubTator.
         eg. {'1234':
                 {'title': 'Review of Current Literature',
@@ -42,109 +235,37 @@ def text_from_pmids(pmids: list, fill_invalid_pmids='remove') -> dict:
         raise ValueError('fill_invalid_pmid must be either "remove" or a falsey value, like None or {}')
 
     print('\nLoading available full text data from PubTator API...')
-    time.sleep(0.1)  # For some reason print statement showing up after first tqdm loading bar
 
-    min_request_dt = 0.3
-    last_req_t = time.time() - min_request_dt*2
-    max_pmids_per_call = 99
+    records, invalid_pmids, _ = harvest_from_pmids(pmids, cache=cache, journal_path=journal_path, corpus=corpus,
+                                                   retry_dead_letters=retry_dead_letters)
+    return _texts_from_records(records, invalid_pmids, fill_invalid_pmids)
+
 
-    split_pmids = gen_utils.split_list(pmids, max_pmids_per_call)
-    texts = {}
-
-    for i_pmids in tqdm(split_pmids):
-        time.sleep(max(0.3 - (time.time() - last_req_t), 0))  # Not supersede PubTator maximum calls per second
-        last_req_t = time.time()  # Have to set before the request (since the request is what takes longest per iter)
-        resp = requests.get(api_call_from_pmids(i_pmids))
-
-        if resp.status_code == 200:  # Successful request
-            # articles = [json.loads(i) for i in resp.text.split('\n') if i]  # OLD API FORMAT "if i" to remove falsey values (empty string)
-            if resp.text:  # resp.text will return falsey '' if only pmids without text are queried
-                articles = json.loads(resp.text)['PubTator3']
-            else:
-                continue  # Move on to next i_pmids
-
-            for art in articles:
-                art['pmid'] = str(art['pmid'])
-                art_text = {}  # List of sections returned
-                for passage in art['passages']:
-                    if passage['text']:  # Only if passage actually has text, not an empty string
-                        try:
-                            section = passage['infons']['section_type'].lower()
-                        except KeyError:  # Probably because only title and abstract
-                            section = passage['infons']['type']
-                        except:
-                            warnings.warn(f"PubTator return for PMID {art['pmid']} does not have 'section_type' or "
-                                          f"'type' fields as expected.")
-                            texts[art['pmid']] = {}
-                            continue
-
-                        if section not in art_text:  # Add section if not yet in dictionary
-                            art_text[section] = ''
-                        art_text[section] += passage['text'] + ' '
-
-                for sec in art_text.keys():
-                    art_text[sec] = art_text[sec][:-1]  # Delete final space
-
-                texts[art['pmid']] = art_text
-
-    # Add text for any pmids that were not returned by PubTator
-    removed_pmids = set(pmids) - set(texts.keys())
-    if removed_pmids and fill_invalid_pmids != 'remove':
-        texts.update({i: fill_invalid_pmids for i in removed_pmids})
+def _texts_from_records(records: dict, invalid_pmids: list, fill_invalid_pmids='remove') -> dict:
+    texts = {pmid: record['sections'] for pmid, record in records.items()}
+    if fill_invalid_pmids != 'remove':  # Add text for any pmids that were not returned by PubTator
+        texts.update({i: fill_invalid_pmids for i in invalid_pmids})
 
     return texts
 
 
-def metadata_from_pmids(pmids: list, fill_invalid_pmids='remove') -> dict:
+def metadata_from_pmids(pmids: list, fill_invalid_pmids='remove', cache: RecordCache = None,
+                        journal_path: str = None, retry_dead_letters: bool = False) -> dict:
 
     if not is_fill_invalid_option_allowed(fill_invalid_pmids):
         raise ValueError('fill_invalid_pmid must be either "remove" or a falsey value, like None or {}')
 
     print('\nLoading metadata from PubTator API...')
 
-    min_request_dt = 0.3
-    last_req_t = time.time() - min_request_dt*2
-    max_pmids_per_call = 99
+    records, invalid_pmids, _ = harvest_from_pmids(pmids, cache=cache, journal_path=journal_path,
+                                                   retry_dead_letters=retry_dead_letters)
+    return _metadata_from_records(records, invalid_pmids, fill_invalid_pmids)
 
-    split_pmids = gen_utils.split_list(pmids, max_pmids_per_call)
-    metadata = {}
-    for i_pmids in tqdm(split_pmids):
-        time.sleep(max(0.3 - (time.time() - last_req_t), 0))  # Not supersede PubTator maximum calls per second
-        last_req_t = time.time()  # Have to set before the request (since the request is what takes longest per iter)
-        resp = requests.get(api_call_from_pmids(i_pmids))
-
-        # articles = [json.loads(i) for i in resp.text.split('\n') if i]  # OLD API FORMAT "if i" to remove falsey values (empty string)
-        # TODO: Check for response code
-        if resp.text:  # resp.text will return falsey '' if only pmids without text are queried
-            articles = json.loads(resp.text)['PubTator3']
-        else:
-            continue
-
-        for art in articles:
-
-            # Getting boolean for whether there is an abstract
-            has_abstract = False
-            for ipassage in art['passages']:
-                if ipassage['infons']['type'] == 'abstract':
-                    has_abstract = True
-                    break
-
-            # Get DOI
-            art_doi = get_doi_from_article_dict(art)
-            metadata[str(art['pmid'])] = {
-                'title': art['passages'][0]['text'],
-                'authors': art['authors'],
-                'pub_date': art['date'][:art['date'].index('T')], # Only date, not time (string in format YYYY-MM-DDTHH:MM:SSZ
-                'pub_year': int(art['date'][:4]),
-                'source': art['journal'],
-                'doi': art_doi,
-                'has_abstract': has_abstract,
-            }
 
-    # Add text for any pmids that were not returned by PubTator
-    removed_pmids = set(pmids) - set(metadata.keys())
-    if removed_pmids and fill_invalid_pmids != 'remove':
-        metadata.update({i: fill_invalid_pmids for i in removed_pmids})
+def _metadata_from_records(records: dict, invalid_pmids: list, fill_invalid_pmids='remove') -> dict:
+    metadata = {pmid: metadata_from_record(record) for pmid, record in records.items()}
+    if fill_invalid_pmids != 'remove':  # Add metadata for any pmids that were not returned by PubTator
+        metadata.update({i: fill_invalid_pmids for i in invalid_pmids})
 
     return metadata
 
@@ -162,32 +283,16 @@ def get_doi_from_article_dict(article:dict):
     return ''
 
 
-def remove_invalid_pmids(pmids:list, verbose=False, return_invalid=False):
+def remove_invalid_pmids(pmids:list, verbose=False, return_invalid=False, cache: RecordCache = None,
+                         journal_path: str = None, retry_dead_letters: bool = False):
 
-    min_request_dt = 0.3
-    last_req_t = time.time() - min_request_dt * 2
-    max_pmids_per_call = 99
-
-    split_pmids = gen_utils.split_list(pmids, max_pmids_per_call)
-    returned_pmids = []
-    for i_pmids in split_pmids:
-        time.sleep(max(0.3 - (time.time() - last_req_t), 0))  # Not supersede PubTator maximum calls per second
-        last_req_t = time.time()  # Have to set before the request (since the request is what takes longest per iter)
-        resp = requests.get(api_call_from_pmids(i_pmids))
-
-        if not resp.text:  # If all pmids are invalid
-            continue
-        else:
-            returned_pmids += [str(i['pmid']) for i in json.loads(resp.text)['PubTator3']]
-
-    removed_pmids = list(set(pmids) - set(returned_pmids))
+    records, removed_pmids, failed_pmids = harvest_from_pmids(pmids, cache=cache, journal_path=journal_path,
+                                                              retry_dead_letters=retry_dead_letters)
+    # PMIDs that failed because of request errors are kept, since they can't be confirmed as invalid
+    returned_pmids = [i for i in dict.fromkeys(str(i) for i in pmids) if i in records or i in failed_pmids]
 
     if verbose:
-        if removed_pmids:
-            print("\nFollowing PMIDs are not found on PubTator API and were removed:")
-            for i in removed_pmids:
-                print(f"\t- {i}")
-            print('')
+        _print_removed_pmids(removed_pmids)
 
     if return_invalid:
         return returned_pmids, removed_pmids
@@ -195,11 +300,27 @@ def remove_invalid_pmids(pmids:list, verbose=False, return_invalid=False):
         return returned_pmids
 
 
-def get_complete_df_from_pmids(pmids):
+def _print_removed_pmids(removed_pmids: list):
+    if removed_pmids:
+        print("\nFollowing PMIDs are not found on PubTator API and were removed:")
+        for i in removed_pmids:
+            print(f"\t- {i}")
+        print('')
+
+
+def get_complete_df_from_pmids(pmids, cache: RecordCache = None, journal_path: str = None,
+                               corpus: CorpusStore = None, annotation_index: AnnotationIndex = None,
+                               retry_dead_letters: bool = False):
+
+    # Single harvest; validity, metadata and text are all views over the same records
+    records, invalid_pmids, _ = harvest_from_pmids(pmids, cache=cache, journal_path=journal_path, corpus=corpus,
+                                                   annotation_index=annotation_index,
+                                                   retry_dead_letters=retry_dead_letters)
+    _print_removed_pmids(invalid_pmids)
 
-    pmids, invalid_pmids = remove_invalid_pmids(pmids, verbose=True, return_invalid=True)
-    metadata = metadata_from_pmids(pmids)
-    text = text_from_pmids(pmids)
+    pmids = list(records.keys())
+    metadata = _metadata_from_records(records, invalid_pmids)
+    text = _texts_from_records(records, invalid_pmids)
 
     pmids = pd.DataFrame(data={'pmid':pmids}, index=pmids)
     metadata = pd.DataFrame.from_dict(metadata, orient='index')
@@ -0,0 +1,182 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+
+
+class TokenBucket:
+    """
+    Thread-safe token-bucket rate limiter. Tokens are refilled continuously at "rate" tokens per second up to
+    "capacity"; acquire() blocks until the requested number of tokens is available.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        :param rate: float, tokens added per second (eg. maximum requests per second)
+        :param capacity: float, maximum number of tokens stored (burst size); defaults to rate
+        """
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        if now > self._last:  # _last may be in the future while paused
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+
+    def set_rate(self, rate: float):
+        """
+        Changes the refill rate (eg. to back off after the server signals overload); capacity is left unchanged.
+        """
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+        with self._lock:
+            self._refill()
+            self.rate = rate
+
+    def pause(self, seconds: float):
+        """
+        Empties the bucket and delays refilling for "seconds" seconds (eg. to honour a Retry-After header).
+        """
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 0.)
+            self._last = max(self._last, time.monotonic() + seconds)
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        """
+        Consumes "tokens" tokens if available, without blocking.
+        :return: boolean, whether the tokens were consumed
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens: float = 1):
+        """
+        Blocks until "tokens" tokens are available and consumes them.
+        :param tokens: float, number of tokens to consume; must not be larger than capacity
+        """
+        if tokens > self.capacity:
+            raise ValueError(f'Cannot acquire {tokens} tokens from bucket with capacity {self.capacity}')
+
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = max(self._last - time.monotonic(), 0.) + (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def map_in_order(func, items: list, max_workers: int, progress_bar: bool = True) -> list:
+    """
+    Applies func to every element of items using a bounded pool of worker threads (so that up to max_workers calls
+    are in flight at once) and returns the results in the same order as items.
+    :param func: callable taking a single element of items
+    :param items: list of inputs
+    :param max_workers: int, maximum number of concurrent calls
+    :param progress_bar: boolean, whether to show a tqdm progress bar
+    :return: list with func(item) for each element of items, in input order
+    """
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        return [func(i) for i in (tqdm(items) if progress_bar else items)]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(func, items)  # executor.map yields in input order
+        if progress_bar:
+            results = tqdm(results, total=len(items))
+        return list(results)
+
+
+class AdaptiveChunkSize:
+    """
+    Thread-safe chunk size that adapts to observed request latency and errors: it shrinks (multiplicatively) when
+    requests fail or take longer than target_latency and grows again when requests are fast, staying between
+    min_size and max_size.
+    """
+
+    def __init__(self, initial: int, min_size: int = 1, max_size: int = None, target_latency: float = 10.,
+                 grow_factor: float = 1.5, shrink_factor: float = 0.5):
+        """
+        :param initial: int, initial chunk size
+        :param min_size: int, minimum chunk size
+        :param max_size: int, maximum chunk size; defaults to initial
+        :param target_latency: float, request duration (in seconds) to aim for
+        :param grow_factor: float, factor applied to chunk size after fast requests
+        :param shrink_factor: float, factor applied to chunk size after failed requests (slow requests shrink by
+            its square root)
+        """
+        self.min_size = min_size
+        self.max_size = max_size if max_size is not None else initial
+        self.target_latency = target_latency
+        self.grow_factor = grow_factor
+        self.shrink_factor = shrink_factor
+        self._size = float(min(max(initial, min_size), self.max_size))
+        self._lock = threading.Lock()
+        self.n_ok = 0
+        self.n_failed = 0
+
+    @property
+    def size(self) -> int:
+        return int(self._size)
+
+    def _set(self, size: float):
+        self._size = min(max(size, self.min_size), self.max_size)
+
+    def record(self, size: int, latency: float, failed: bool = False):
+        """
+        Updates the chunk size after a request for a chunk of "size" elements which took "latency" seconds.
+        """
+        with self._lock:
+            if failed:
+                self.n_failed += 1
+                self._set(min(self._size, size) * self.shrink_factor)
+                return
+
+            self.n_ok += 1
+            if latency > self.target_latency:
+                # Scale towards the size that would have taken target_latency, but never shrink too abruptly
+                self._set(min(self._size, max(size * self.target_latency / latency, size * self.shrink_factor ** 0.5)))
+            elif latency < self.target_latency / 2 and size >= self._size:
+                self._set(self._size * self.grow_factor)
+
+
+class MinuteBudget:
+    """
+    Thread-safe scheduler for APIs with requests-per-minute and tokens-per-minute limits (eg. OpenAI): acquire()
+    blocks until both the request and the (estimated) token budget allow another request. Bursts are limited to
+    roughly ten seconds' worth of each budget.
+    """
+
+    def __init__(self, requests_per_minute: float = None, tokens_per_minute: float = None):
+        """
+        :param requests_per_minute: float, maximum requests per minute; None for no limit
+        :param tokens_per_minute: float, maximum tokens (prompt + completion) per minute; None for no limit
+        """
+        self.requests = None
+        self.tokens = None
+        if requests_per_minute:
+            self.requests = TokenBucket(requests_per_minute / 60, capacity=max(requests_per_minute / 6, 1))
+        if tokens_per_minute:
+            self.tokens = TokenBucket(tokens_per_minute / 60, capacity=tokens_per_minute / 6)
+
+    def acquire(self, tokens: float = 0):
+        """
+        Blocks until a request using "tokens" tokens fits in both budgets and consumes them. Requests estimated to
+        use more tokens than the burst size wait for a full burst.
+        """
+        if self.requests is not None:
+            self.requests.acquire()
+        if self.tokens is not None and tokens:
+            self.tokens.acquire(min(tokens, self.tokens.capacity))
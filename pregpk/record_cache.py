@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import zlib
+import sqlite3
+import threading
+from pregpk import gen_utils
+
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.pregpk', 'record_cache.sqlite')
+CACHE_MODES = ('use', 'refresh', 'cache_only')
+
+
+class RecordCache:
+    """
+    Persistent on-disk cache for records fetched from the Entrez and PubTator APIs, stored in an SQLite database.
+    Records are keyed by (source, db, pmid, record_type) and stored as zlib-compressed JSON, along with the version of
+    the record format they were parsed into; records of another version are treated as missing, so they are re-fetched
+    after the parser changes instead of being served for up to ttl_days. PMIDs confirmed to be invalid by an API are
+    stored as well (negative cache, independent of the format version), so they aren't re-requested on every run.
+
+    Modes:
+        - 'use': return cached records if available and not expired, fetch (and store) the rest
+        - 'refresh': ignore cached records and re-fetch everything, overwriting the cache
+        - 'cache_only': never make requests; PMIDs not in the cache are treated as not returned by the API
+    """
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, ttl_days: float = 30, mode: str = 'use',
+                 compression_level: int = 6):
+        """
+        :param path: string, path to SQLite database file (created if it doesn't exist)
+        :param ttl_days: float, number of days after which a cached record is considered expired; None to never expire
+        :param mode: string, one of 'use', 'refresh' or 'cache_only' (see class docstring)
+        :param compression_level: int, zlib compression level for stored payloads
+        """
+        if mode not in CACHE_MODES:
+            raise ValueError(f'mode must be one of {CACHE_MODES}')
+
+        self.path = path
+        self.ttl_days = ttl_days
+        self.mode = mode
+        self.compression_level = compression_level
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS records ("
+                           "source TEXT, db TEXT, pmid TEXT, record_type TEXT, "
+                           "payload BLOB, is_invalid INTEGER, fetched_at REAL, version INTEGER DEFAULT 0, "
+                           "PRIMARY KEY (source, db, pmid, record_type))")
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(records)")]
+        if 'version' not in columns:  # Caches created before records were versioned (their records count as version 0)
+            self._conn.execute("ALTER TABLE records ADD COLUMN version INTEGER DEFAULT 0")
+        self._conn.commit()
+
+    @property
+    def fetch_allowed(self) -> bool:
+        return self.mode != 'cache_only'
+
+    def _min_fetched_at(self) -> float:
+        if self.ttl_days is None:
+            return float('-inf')
+        return time.time() - self.ttl_days * 86400
+
+    def lookup(self, source: str, db: str, record_type: str, pmids: list, version: int = 0) -> tuple:
+        """
+        Looks up a list of PMIDs in the cache.
+        :param source: string, API the records come from (eg. 'entrez', 'pubtator')
+        :param db: string, database within the API (eg. 'pubmed')
+        :param record_type: string, type of record stored (eg. 'record', 'biocjson')
+        :param pmids: list of PMID strings
+        :param version: int, current version of the record format (eg. entrez.parsing.RECORD_VERSION); cached records
+            of any other version are returned as missing
+        :return: tuple (found, invalid, missing) where found is a dict mapping PMIDs onto cached records, invalid is a
+            list of PMIDs cached as invalid and missing is a list of PMIDs that have to be fetched.
+        """
+        pmids = [str(i) for i in pmids]
+        if self.mode == 'refresh':
+            self.misses += len(pmids)
+            return {}, [], pmids
+
+        cached = {}
+        min_fetched_at = self._min_fetched_at()
+        with self._lock:
+            for i_pmids in gen_utils.split_list(pmids, 900):  # Below SQLite's maximum number of host parameters
+                rows = self._conn.execute(
+                    f"SELECT pmid, payload, is_invalid FROM records WHERE source=? AND db=? AND record_type=? "
+                    f"AND fetched_at>=? AND (is_invalid=1 OR version=?) AND pmid IN ({','.join('?' * len(i_pmids))})",
+                    [source, db, record_type, min_fetched_at, version] + i_pmids).fetchall()
+                cached.update({pmid: (payload, is_invalid) for pmid, payload, is_invalid in rows})
+
+        found, invalid, missing = {}, [], []
+        for pmid in pmids:
+            if pmid not in cached:
+                missing.append(pmid)
+            elif cached[pmid][1]:
+                invalid.append(pmid)
+            else:
+                found[pmid] = self._decode(cached[pmid][0])
+
+        self.hits += len(found)
+        self.negative_hits += len(invalid)
+        self.misses += len(missing)
+
+        return found, invalid, missing
+
+    def store(self, source: str, db: str, record_type: str, records: dict, version: int = 0):
+        """
+        Stores (or overwrites) records in the cache.
+        :param records: dict mapping PMIDs onto JSON-serializable records
+        :param version: int, version of the record format of records (see lookup)
+        """
+        now = time.time()
+        rows = [(source, db, str(pmid), record_type, self._encode(record), 0, now, version)
+                for pmid, record in records.items()]
+        self._write(rows)
+
+    def store_invalid(self, source: str, db: str, record_type: str, pmids: list):
+        """
+        Stores PMIDs confirmed to be invalid by an API in the negative cache.
+        """
+        now = time.time()
+        rows = [(source, db, str(pmid), record_type, None, 1, now, 0) for pmid in pmids]
+        self._write(rows)
+
+    def _write(self, rows: list):
+        if not rows:
+            return
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self._conn.commit()
+
+    def _encode(self, record) -> bytes:
+        return zlib.compress(json.dumps(record).encode('utf-8'), self.compression_level)
+
+    @staticmethod
+    def _decode(payload: bytes):
+        return json.loads(zlib.decompress(payload).decode('utf-8'))
+
+    def prune_expired(self) -> int:
+        """
+        Deletes expired records from the cache.
+        :return: int, number of deleted records
+        """
+        with self._lock:
+            n = self._conn.execute("DELETE FROM records WHERE fetched_at<?", (self._min_fetched_at(),)).rowcount
+            self._conn.commit()
+        return n
+
+    def hit_rate(self) -> float:
+        n = self.hits + self.negative_hits + self.misses
+        return (self.hits + self.negative_hits) / n if n else 0.
+
+    def report(self) -> str:
+        return (f"Record cache ({self.mode}): {self.hits} hits, {self.negative_hits} negative hits, "
+                f"{self.misses} misses ({self.hit_rate():.1%} hit rate)")
+
+    def reset_stats(self):
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    def close(self):
+        self._conn.close()
+
@@ -0,0 +1,198 @@
+import json
+import time
+import random
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pregpk.rate_limiting import TokenBucket
+
+
+MESSAGE_ROLES = ('system', 'developer', 'user', 'assistant', 'tool')
+
+
+def default_responder(messages: list, params: dict) -> str:
+    # Deterministic classification-style answer: "1" if the prompt mentions pharmacokinetics, "0" otherwise
+    text = ' '.join(str(i.get('content', '')) for i in messages).lower()
+    return '1 - mentions pharmacokinetics' if 'pharmacokinetic' in text else '0 - no pharmacokinetic data'
+
+
+class OpenAIStubServer:
+    """
+    Local OpenAI-compatible stand-in for the chat completions endpoint (POST /v1/chat/completions), so GPT studies can
+    be tested and benchmarked without an API key or cost. Answers come from a responder callable; latency, error rates
+    (HTTP 500) and rate limiting (HTTP 429 with Retry-After) can be configured, and the number of requests, tokens and
+    the maximum number of concurrent requests are recorded. Malformed requests are answered with HTTP 400 and an
+    OpenAI-style error (see validate_chat_completion). Point an OpenAI client at it with base_url.
+    """
+
+    def __init__(self, responder=default_responder, port: int = 0, latency: float = 0., latency_jitter: float = 0.,
+                 error_rate: float = 0., rate_limit: float = None, seed: int = 0):
+        """
+        :param responder: callable taking (messages, params) and returning the completion text
+        :param port: int, port to listen on (0 to pick a free port)
+        :param latency: float, seconds added to every response
+        :param latency_jitter: float, maximum random seconds added on top of latency
+        :param error_rate: float, fraction of requests answered with HTTP 500
+        :param rate_limit: float, maximum requests per second before answering with HTTP 429; None for no limit
+        :param seed: int, random seed for jitter and errors
+        """
+        self.responder = responder
+        self.port = port
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.limiter = TokenBucket(rate_limit) if rate_limit else None
+        self.request_counts = Counter()
+        self.n_tokens = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._httpd = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    def start(self):
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', self.port), _StubRequestHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.stub = self
+        self.port = self._httpd.server_address[1]
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def reset_counts(self):
+        with self._lock:
+            self.request_counts = Counter()
+            self.n_tokens = 0
+            self.max_in_flight = 0
+
+    def respond(self, path: str, body: dict) -> tuple:
+        """
+        Builds the response to a request.
+        :return: tuple (status, response dict, extra_headers)
+        """
+        with self._lock:
+            self.request_counts[path] += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            delay = self.latency + self._rng.uniform(0, self.latency_jitter)
+            failed = self._rng.random() < self.error_rate
+
+        try:
+            if delay:
+                time.sleep(delay)
+            if self.limiter is not None and not self.limiter.try_acquire():
+                with self._lock:
+                    self.request_counts['429'] += 1
+                return 429, _error('Rate limit reached', error_type='rate_limit_error'), {'Retry-After': '1'}
+            if failed:
+                return 500, _error('The server had an error processing your request', error_type='server_error'), {}
+            if path.rstrip('/') != '/v1/chat/completions':
+                return 404, _error(f'Unknown path {path}'), {}
+            invalid = validate_chat_completion(body)
+            if invalid is not None:
+                return 400, _error(*invalid, error_type='invalid_request_error'), {}
+            return 200, self.chat_completion(body), {}
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def chat_completion(self, body: dict) -> dict:
+        content = self.responder(body.get('messages', []), body)
+        if body.get('max_tokens'):
+            content = ' '.join(content.split(' ')[:body['max_tokens']])
+        prompt_tokens = sum(len(str(i.get('content', ''))) // 4 + 4 for i in body.get('messages', []))
+        completion_tokens = len(content) // 4 + 1
+        with self._lock:
+            self.n_tokens += prompt_tokens + completion_tokens
+        return {
+            'id': f"chatcmpl-stub{sum(self.request_counts.values())}",
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': body.get('model', ''),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'logprobs': None,
+                         'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                      'total_tokens': prompt_tokens + completion_tokens},
+        }
+
+
+def validate_chat_completion(body) -> tuple:
+    """
+    Checks a chat completion request body the way the OpenAI API does for the fields the stub uses.
+    :return: tuple (message, param) describing the first problem found, or None if the body is valid
+    """
+    if not isinstance(body, dict):
+        return "We could not parse the JSON body of your request.", None
+    if not isinstance(body.get('model'), str) or not body['model']:
+        return "you must provide a model parameter", 'model'
+
+    messages = body.get('messages')
+    if not isinstance(messages, list) or not messages:
+        return "'messages' must be a non-empty array of message objects", 'messages'
+    for i, message in enumerate(messages):
+        if not isinstance(message, dict):
+            return f"Invalid type for 'messages[{i}]': expected an object, but got {type(message).__name__} instead.", \
+                f'messages[{i}]'
+        if message.get('role') not in MESSAGE_ROLES:
+            return f"Invalid value for 'messages[{i}].role': expected one of {', '.join(MESSAGE_ROLES)}.", \
+                f'messages[{i}].role'
+        if not isinstance(message.get('content'), (str, list)):
+            return f"Invalid type for 'messages[{i}].content': expected a string or an array.", \
+                f'messages[{i}].content'
+
+    max_tokens = body.get('max_tokens')
+    if max_tokens is not None and (not isinstance(max_tokens, int) or isinstance(max_tokens, bool) or max_tokens < 1):
+        return f"Invalid 'max_tokens': expected an integer of at least 1, but got {max_tokens!r} instead.", 'max_tokens'
+    temperature = body.get('temperature')
+    if temperature is not None and (not isinstance(temperature, (int, float)) or not 0 <= temperature <= 2):
+        return f"Invalid 'temperature': expected a number between 0 and 2, but got {temperature!r} instead.", \
+            'temperature'
+
+    return None
+
+
+def _error(message: str, param: str = None, error_type: str = 'invalid_request_error') -> dict:
+    return {'error': {'message': message, 'type': error_type, 'param': param, 'code': None}}
+
+
+class _StubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            body = json.loads(body or b'{}')
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            body = None  # Answered with HTTP 400
+        try:
+            status, response, headers = self.server.stub.respond(self.path, body)
+        except Exception as e:  # Eg. a failing responder; answer like the API would instead of dropping the connection
+            status, response, headers = 500, _error(f'The server had an error processing your request ({e!r})',
+                                                    error_type='server_error'), {}
+
+        payload = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for key, val in headers.items():
+            self.send_header(key, val)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):  # Silence per-request logging
+        pass
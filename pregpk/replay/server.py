@@ -0,0 +1,378 @@
+import gzip
+import json
+import time
+import random
+import threading
+import itertools
+from collections import Counter
+from urllib.parse import urlparse, parse_qs
+from xml.sax.saxutils import escape
+import xml.etree.ElementTree as ET
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pregpk.rate_limiting import TokenBucket
+
+
+EFETCH_HEADER = ('<?xml version="1.0" ?>\n<!DOCTYPE PubmedArticleSet PUBLIC "-//NLM//DTD PubMedArticle, 1st January '
+                 '2024//EN" "https://dtd.nlm.nih.gov/ncbi/pubmed/out/pubmed_240101.dtd">\n')
+ESEARCH_HEADER = ('<?xml version="1.0" encoding="UTF-8" ?>\n<!DOCTYPE eSearchResult PUBLIC "-//NLM//DTD esearch '
+                  '20060628//EN" "https://eutils.ncbi.nlm.nih.gov/eutils/dtd/20060628/esearch.dtd">\n')
+EPOST_HEADER = ('<?xml version="1.0" encoding="UTF-8" ?>\n<!DOCTYPE ePostResult PUBLIC "-//NLM//DTD epost '
+                '20060628//EN" "https://eutils.ncbi.nlm.nih.gov/eutils/dtd/20060628/epost.dtd">\n')
+ESUMMARY_HEADER = ('<?xml version="1.0" encoding="UTF-8" ?>\n<!DOCTYPE eSummaryResult PUBLIC "-//NLM//DTD esummary v1 '
+                   '20041029//EN" "https://eutils.ncbi.nlm.nih.gov/eutils/dtd/20041029/esummary-v1.dtd">\n')
+
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+_WORDS = ('pregnancy pharmacokinetics clearance plasma concentration dose trimester maternal fetal placental '
+          'exposure drug women study patients volume distribution half-life postpartum gestation infant cord blood '
+          'ratio metabolism renal hepatic model population analysis increased decreased compared during').split()
+_AFFILIATIONS = ['Department of Pharmacy, University of Washington, Seattle, WA, USA.',
+                 'Division of Clinical Pharmacology, Leiden University Medical Center, Leiden, Netherlands.',
+                 'Faculty of Medicine, University of Tokyo, Tokyo, Japan.',
+                 'Institute of Pharmaceutical Science, King\'s College London, London, UK.',
+                 'Department of Obstetrics, Charite, Berlin, Germany.',
+                 'Hospital Universitario, Madrid, Spain.']
+_MESH_TERMS = ['Humans', 'Female', 'Pregnancy', 'Adult', 'Pharmacokinetics', 'Metabolic Clearance Rate',
+               'Pregnancy Trimester, Third', 'Infant, Newborn', 'Fetal Blood', 'Models, Biological']
+_CHEMICALS = [('MESH:D014859', 'warfarin'), ('MESH:D008687', 'metformin'), ('MESH:D007052', 'ibuprofen'),
+              ('MESH:D000082', 'acetaminophen'), ('MESH:D008775', 'methylprednisolone')]
+_DISEASES = [('MESH:D011248', 'pregnancy complications'), ('MESH:D016640', 'diabetes, gestational'),
+             ('MESH:D011225', 'pre-eclampsia'), ('MESH:D006973', 'hypertension')]
+_FULLTEXT_SECTIONS = ['INTRO', 'METHODS', 'RESULTS', 'DISCUSS', 'CONCL', 'TABLE', 'FIG']
+
+
+class ReplayCorpus:
+    """
+    Collection of articles served by a ReplayServer: efetch XML ("PubmedArticle" elements) and PubTator 3 BioC JSON
+    articles, keyed by PMID, along with the dates used to filter searches.
+    """
+
+    def __init__(self, efetch_articles: dict = None, pubtator_articles: dict = None, dates: dict = None,
+                 queries: dict = None):
+        """
+        :param efetch_articles: dict mapping PMIDs onto "PubmedArticle" XML strings
+        :param pubtator_articles: dict mapping PMIDs onto PubTator 3 BioC JSON article dicts
+        :param dates: dict mapping PMIDs onto dicts with 'pdat', 'edat' and 'mdat' dates ("YYYY/MM/DD")
+        :param queries: dict mapping search terms onto lists of PMIDs; unknown terms match every article
+        """
+        self.efetch_articles = efetch_articles or {}
+        self.pubtator_articles = pubtator_articles or {}
+        self.dates = dates or {}
+        self.queries = queries or {}
+
+    @property
+    def pmids(self) -> list:
+        return list(dict.fromkeys(list(self.efetch_articles) + list(self.pubtator_articles)))
+
+    @classmethod
+    def synthetic(cls, n_articles: int, start_pmid: int = 10000000, abstract_words: int = 250,
+                  fulltext_paragraphs: int = 20, paragraph_words: int = 120, seed: int = 0):
+        """
+        Generates a corpus of synthetic (but structurally realistic) articles.
+        :param n_articles: int, number of articles
+        :param start_pmid: int, PMID of first article (following articles have consecutive PMIDs)
+        :param abstract_words: int, number of words per abstract
+        :param fulltext_paragraphs: int, number of full-text paragraphs per PubTator article
+        :param paragraph_words: int, number of words per full-text paragraph
+        :param seed: int, random seed
+        :return: ReplayCorpus
+        """
+        rng = random.Random(seed)
+        corpus = cls()
+        for pmid in range(start_pmid, start_pmid + n_articles):
+            pmid = str(pmid)
+            year, month, day = rng.randint(1990, 2024), rng.randint(1, 12), rng.randint(1, 28)
+            edat = f"{year}/{month:02d}/{day:02d}"
+            corpus.dates[pmid] = {'pdat': edat, 'edat': edat, 'mdat': edat}
+
+            title = ' '.join(rng.choices(_WORDS, k=12)).capitalize() + '.'
+            abstract = ' '.join(rng.choices(_WORDS, k=abstract_words)) + '.'
+            affs = rng.sample(_AFFILIATIONS, k=rng.randint(1, 3))
+            chemical, disease = rng.choice(_CHEMICALS), rng.choice(_DISEASES)
+
+            corpus.efetch_articles[pmid] = synthetic_efetch_article(pmid, title, abstract, (year, month, day), affs,
+                                                                    rng.sample(_MESH_TERMS, k=4))
+
+            passages = [_passage('TITLE', 'title', title, 0, [chemical]),
+                        _passage('ABSTRACT', 'abstract', abstract, len(title) + 1, [disease])]
+            for i in range(fulltext_paragraphs):
+                passages.append(_passage(_FULLTEXT_SECTIONS[i * len(_FULLTEXT_SECTIONS) // fulltext_paragraphs],
+                                         'paragraph', ' '.join(rng.choices(_WORDS, k=paragraph_words)) + '.', 0,
+                                         rng.sample([chemical, disease], k=1)))
+            passages[0]['infons'].update({'article-id_doi': f"10.5555/{pmid}", 'journal': 'J Synth Pharm'})
+            corpus.pubtator_articles[pmid] = {
+                '_id': f"{pmid}|None", 'id': pmid, 'pmid': int(pmid), 'date': f"{year}-{month:02d}-{day:02d}T00:00:00Z",
+                'journal': 'J Synth Pharm', 'authors': [f"Author{i} A" for i in range(len(affs))],
+                'passages': passages,
+            }
+
+        return corpus
+
+    @classmethod
+    def from_recordings(cls, efetch_paths: list = (), pubtator_paths: list = ()):
+        """
+        Builds a corpus from recorded API responses.
+        :param efetch_paths: list of paths to efetch XML responses (rettype="xml")
+        :param pubtator_paths: list of paths to PubTator 3 biocjson responses
+        :return: ReplayCorpus
+        """
+        corpus = cls()
+        for path in efetch_paths:
+            for _, elem in ET.iterparse(path):
+                if elem.tag == 'PubmedArticle':
+                    pmid = elem.findtext('MedlineCitation/PMID')
+                    corpus.efetch_articles[pmid] = ET.tostring(elem, encoding='unicode')
+                    year = elem.findtext('MedlineCitation/Article/Journal/JournalIssue/PubDate/Year') or '1900'
+                    corpus.dates[pmid] = {i: f"{year}/01/01" for i in ('pdat', 'edat', 'mdat')}
+                    elem.clear()
+        for path in pubtator_paths:
+            with open(path, 'r') as pubtator_file:
+                for art in json.load(pubtator_file)['PubTator3']:
+                    corpus.pubtator_articles[str(art['pmid'])] = art
+        return corpus
+
+
+def synthetic_efetch_article(pmid: str, title: str, abstract: str, date: tuple, affiliations: list,
+                             mesh_terms: list) -> str:
+    authors = ''.join(f"<Author ValidYN=\"Y\"><LastName>Author{i}</LastName><ForeName>A</ForeName><Initials>A"
+                      f"</Initials><AffiliationInfo><Affiliation>{escape(aff)}</Affiliation></AffiliationInfo>"
+                      f"</Author>" for i, aff in enumerate(affiliations))
+    mesh = ''.join(f"<MeshHeading><DescriptorName UI=\"D0\" MajorTopicYN=\"N\">{escape(i)}</DescriptorName>"
+                   f"</MeshHeading>" for i in mesh_terms)
+    return (f"<PubmedArticle><MedlineCitation Status=\"MEDLINE\" Owner=\"NLM\"><PMID Version=\"1\">{pmid}</PMID>"
+            f"<Article PubModel=\"Print\"><Journal><JournalIssue CitedMedium=\"Internet\"><PubDate><Year>{date[0]}"
+            f"</Year><Month>{MONTHS[date[1] - 1]}</Month><Day>{date[2]:02d}</Day></PubDate></JournalIssue>"
+            f"<Title>Journal of Synthetic Pharmacology</Title><ISOAbbreviation>J Synth Pharm</ISOAbbreviation>"
+            f"</Journal><ArticleTitle>{escape(title)}</ArticleTitle><ELocationID EIdType=\"doi\" ValidYN=\"Y\">"
+            f"10.5555/{pmid}</ELocationID><Abstract><AbstractText>{escape(abstract)}</AbstractText></Abstract>"
+            f"<AuthorList CompleteYN=\"Y\">{authors}</AuthorList><Language>eng</Language><PublicationTypeList>"
+            f"<PublicationType UI=\"D016428\">Journal Article</PublicationType></PublicationTypeList></Article>"
+            f"<MedlineJournalInfo><MedlineTA>J Synth Pharm</MedlineTA></MedlineJournalInfo><MeshHeadingList>{mesh}"
+            f"</MeshHeadingList></MedlineCitation><PubmedData><ArticleIdList><ArticleId IdType=\"pubmed\">{pmid}"
+            f"</ArticleId><ArticleId IdType=\"doi\">10.5555/{pmid}</ArticleId></ArticleIdList></PubmedData>"
+            f"</PubmedArticle>")
+
+
+def _passage(section_type: str, passage_type: str, text: str, offset: int, entities: list) -> dict:
+    annotations = []
+    for i, (identifier, name) in enumerate(entities):
+        annotations.append({'id': str(i), 'text': name, 'locations': [{'offset': offset, 'length': len(name)}],
+                            'infons': {'identifier': identifier, 'type': 'Chemical' if name in dict(_CHEMICALS).values()
+                                       else 'Disease', 'name': name, 'database': 'ncbi_mesh', 'valid': True}})
+    return {'offset': offset, 'infons': {'section_type': section_type, 'type': passage_type}, 'text': text,
+            'sentences': [], 'annotations': annotations, 'relations': []}
+
+
+class ReplayServer:
+    """
+    Local HTTP stand-in for the Entrez E-utilities (efetch, esummary, esearch, epost, including the history server)
+    and the PubTator 3 biocjson export, serving articles from a ReplayCorpus. Latency, error rates and rate limiting
+    (HTTP 429 with Retry-After) can be configured to benchmark and regression-test the fetch layer without hitting
+    NCBI. Point the fetch layer at it with entrez_url (pregpk.entrez.client.base_url) and pubtator_url
+    (pregpk.pubtator.client.base_url).
+    """
+
+    def __init__(self, corpus: ReplayCorpus, port: int = 0, latency: float = 0., latency_jitter: float = 0.,
+                 error_rate: float = 0., rate_limit: float = None, seed: int = 0):
+        """
+        :param corpus: ReplayCorpus with articles to serve
+        :param port: int, port to listen on (0 to pick a free port)
+        :param latency: float, seconds added to every response
+        :param latency_jitter: float, maximum random seconds added on top of latency
+        :param error_rate: float, fraction of requests answered with HTTP 500
+        :param rate_limit: float, maximum requests per second before answering with HTTP 429; None for no limit
+        :param seed: int, random seed for jitter and errors
+        """
+        self.corpus = corpus
+        self.port = port
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.limiter = TokenBucket(rate_limit) if rate_limit else None
+        self.request_counts = Counter()
+        self.bytes_sent = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._history = {}  # WebEnv -> {query_key: list of PMIDs}
+        self._webenv_ids = itertools.count(1)
+        self._httpd = None
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/"
+
+    @property
+    def entrez_url(self) -> str:
+        return f"{self.url}entrez/eutils/"
+
+    @property
+    def pubtator_url(self) -> str:
+        return f"{self.url}pubtator3-api/"
+
+    def start(self):
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', self.port), _ReplayRequestHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.replay = self
+        self.port = self._httpd.server_address[1]
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def reset_counts(self):
+        with self._lock:
+            self.request_counts = Counter()
+            self.bytes_sent = 0
+
+    def respond(self, path: str, params: dict) -> tuple:
+        """
+        Builds the response to a request.
+        :param path: string, URL path of the request
+        :param params: dict with (single-valued) request parameters
+        :return: tuple (status, content_type, body, extra_headers)
+        """
+        endpoint = path.rstrip('/').split('/')[-1].replace('.fcgi', '')
+        with self._lock:
+            self.request_counts[endpoint] += 1
+            delay = self.latency + self._rng.uniform(0, self.latency_jitter)
+            failed = self._rng.random() < self.error_rate
+
+        if delay:
+            time.sleep(delay)
+        if self.limiter is not None and not self.limiter.try_acquire():
+            with self._lock:
+                self.request_counts['429'] += 1
+            return 429, 'text/plain', b'Too Many Requests', {'Retry-After': '1'}
+        if failed:
+            return 500, 'text/plain', b'Internal Server Error', {}
+
+        if endpoint == 'efetch':
+            return self._efetch(params)
+        if endpoint == 'esummary':
+            return 200, 'text/xml', self._esummary(self._ids(params)).encode(), {}
+        if endpoint == 'esearch':
+            return 200, 'text/xml', self._esearch(params).encode(), {}
+        if endpoint == 'epost':
+            webenv, query_key = self._store_history(self._ids(params), params.get('WebEnv'))
+            body = f"{EPOST_HEADER}<ePostResult><QueryKey>{query_key}</QueryKey><WebEnv>{webenv}</WebEnv></ePostResult>"
+            return 200, 'text/xml', body.encode(), {}
+        if endpoint == 'biocjson':
+            arts = [self.corpus.pubtator_articles[i] for i in params.get('pmids', '').split(',')
+                    if i in self.corpus.pubtator_articles]
+            body = json.dumps({'PubTator3': arts}) if arts else ''  # PubTator returns '' if no PMID is valid
+            return 200, 'application/json', body.encode(), {}
+
+        return 404, 'text/plain', b'Not Found', {}
+
+    @staticmethod
+    def _ids(params: dict) -> list:
+        return [i for i in params.get('id', '').split(',') if i]
+
+    def _history_ids(self, params: dict) -> list:
+        ids = self._history.get(params['WebEnv'], {}).get(params.get('query_key', '1'), [])
+        retstart = int(params.get('retstart', 0))
+        return ids[retstart:retstart + int(params.get('retmax', 10000))]
+
+    def _store_history(self, ids: list, webenv: str = None) -> tuple:
+        with self._lock:
+            if webenv not in self._history:
+                webenv = f"MCID_replay_{next(self._webenv_ids)}"
+                self._history[webenv] = {}
+            query_key = str(len(self._history[webenv]) + 1)
+            self._history[webenv][query_key] = list(ids)
+        return webenv, query_key
+
+    def _efetch(self, params: dict) -> tuple:
+        ids = self._history_ids(params) if 'WebEnv' in params else self._ids(params)
+        if params.get('rettype') == 'uilist':
+            return 200, 'text/plain', ''.join(f"{i}\n" for i in ids).encode(), {}
+        arts = '\n'.join(self.corpus.efetch_articles[i] for i in ids if i in self.corpus.efetch_articles)
+        return 200, 'text/xml', f"{EFETCH_HEADER}<PubmedArticleSet>\n{arts}\n</PubmedArticleSet>".encode(), {}
+
+    def _esummary(self, ids: list) -> str:
+        docsums = []
+        for pmid in ids:
+            if pmid not in self.corpus.dates:
+                continue
+            year, month, day = self.corpus.dates[pmid]['pdat'].split('/')
+            docsums.append(f"<DocSum><Id>{pmid}</Id><Item Name=\"PubDate\" Type=\"Date\">{year} "
+                           f"{MONTHS[int(month) - 1]} {day}</Item><Item Name=\"Source\" Type=\"String\">"
+                           f"J Synth Pharm</Item><Item Name=\"HasAbstract\" Type=\"Integer\">1</Item></DocSum>")
+        return f"{ESUMMARY_HEADER}<eSummaryResult>{''.join(docsums)}</eSummaryResult>"
+
+    def _esearch(self, params: dict) -> str:
+        term = params.get('term', '')
+        pmids = self.corpus.queries.get(term, self.corpus.pmids)
+
+        datetype = params.get('datetype', 'pdat')
+        mindate, maxdate = _normalize_date(params.get('mindate'), False), _normalize_date(params.get('maxdate'), True)
+        dates = {i: self.corpus.dates.get(i, {}).get(datetype, '1900/01/01') for i in pmids}
+        pmids = [i for i in pmids if (mindate is None or dates[i] >= mindate) and (maxdate is None or dates[i] <= maxdate)]
+        if params.get('sort') == 'pub_date':  # Most recent first
+            pmids = sorted(pmids, key=lambda i: (dates[i], int(i)), reverse=True)
+
+        retstart, retmax = int(params.get('retstart', 0)), int(params.get('retmax', 20))
+        history = ''
+        if params.get('usehistory') == 'y':
+            webenv, query_key = self._store_history(pmids, params.get('WebEnv'))
+            history = f"<QueryKey>{query_key}</QueryKey><WebEnv>{webenv}</WebEnv>"
+        ids = ''.join(f"<Id>{i}</Id>" for i in pmids[retstart:retstart + retmax])
+        return (f"{ESEARCH_HEADER}<eSearchResult><Count>{len(pmids)}</Count><RetMax>{min(retmax, len(pmids))}"
+                f"</RetMax><RetStart>{retstart}</RetStart>{history}<IdList>{ids}</IdList><TranslationSet/>"
+                f"<QueryTranslation>{escape(term)}</QueryTranslation></eSearchResult>")
+
+
+def _normalize_date(date: str, is_max: bool):
+    # "YYYY", "YYYY/MM" or "YYYY/MM/DD" -> "YYYY/MM/DD" (start or end of period)
+    if not date or date == '0':
+        return None
+    parts = str(date).replace('-', '/').split('/')
+    default = ['12', '31'] if is_max else ['01', '01']
+    parts = parts + default[len(parts) - 1:]
+    return '/'.join([parts[0].zfill(4)] + [i.zfill(2) for i in parts[1:3]])
+
+
+class _ReplayRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep-alive, like the real APIs
+
+    def do_GET(self):
+        self._handle(parse_qs(urlparse(self.path).query))
+
+    def do_POST(self):
+        params = parse_qs(urlparse(self.path).query)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        params.update(parse_qs(body.decode('utf-8')))
+        self._handle(params)
+
+    def _handle(self, params: dict):
+        replay = self.server.replay
+        status, content_type, body, headers = replay.respond(urlparse(self.path).path,
+                                                             {key: val[-1] for key, val in params.items()})
+        if 'gzip' in self.headers.get('Accept-Encoding', '') and len(body) > 1024:
+            body = gzip.compress(body, compresslevel=1)
+            headers = dict(headers, **{'Content-Encoding': 'gzip'})
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, val in headers.items():
+            self.send_header(key, val)
+        self.end_headers()
+        self.wfile.write(body)
+        with replay._lock:
+            replay.bytes_sent += len(body)
+
+    def log_message(self, format, *args):  # Silence per-request logging
+        pass